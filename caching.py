@@ -0,0 +1,883 @@
+"""
+通用缓存组件
+
+LRUCache是按字节数限制容量的进程内LRU缓存，淘汰的条目可以选择压缩后写入磁盘，
+再次访问时从磁盘读回。用于缓存渲染好的图表等体积较大、生成代价较高的结果。
+
+ResponseCache是基于SQLite的持久化缓存，带TTL和容量淘汰，用于缓存LLM回复。
+
+SharedCache是同一主机上多个进程共享的SQLite缓存，值可以是DataFrame等任意可pickle的对象，
+用于让多个应用进程共用已下载的行情数据。两者都使用WAL模式，写入在事务内完成，可以被多个
+进程同时读写。
+
+SingleFlight合并同一时刻对同一个键的重复请求：第一个调用方执行，其余调用方等待并共享结果。
+
+TieredTTLCache按数据类别设置有效期的进程内缓存，过期不久的条目先返回旧值，同时在后台刷新。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (Any, Callable, Dict, Generator, Hashable, Iterable, Iterator, List,
+                    Optional, Tuple)
+
+logger = logging.getLogger("caching")
+
+# LLM响应缓存的默认位置和有效期
+DEFAULT_RESPONSE_CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite3")
+)
+DEFAULT_RESPONSE_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 12 * 60 * 60))
+
+# 跨进程共享数据缓存的默认位置和容量，位置设为空字符串时只使用进程内缓存
+DEFAULT_SHARED_CACHE_PATH = os.environ.get(
+    "SHARED_CACHE_PATH", os.path.join(".cache", "shared_data.sqlite3")
+)
+DEFAULT_SHARED_CACHE_BYTES = int(os.environ.get("SHARED_CACHE_BYTES", 256 * 1024 * 1024))
+
+# 共享缓存的加载租约有效秒数：持有租约的进程异常退出时，其他进程最多等待这么久后自行加载
+SHARED_LEASE_SECONDS = 30.0
+# 等待其他进程加载时检查结果的间隔（秒）
+SHARED_POLL_INTERVAL = 0.1
+
+
+def _open_database(path: str) -> sqlite3.Connection:
+    """打开可跨线程使用、WAL模式的SQLite连接，必要时创建所在目录"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # timeout使并发写入的进程等待锁释放，而不是立即报错
+    conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """立即取得写锁的事务，块内的多条语句对其他进程原子可见"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _evict_by_access(conn: sqlite3.Connection, table: str, max_bytes: int) -> None:
+    """总字节数超出上限时按最久未访问的顺序删除条目"""
+    total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+    if total <= max_bytes:
+        return
+    rows = conn.execute(f"SELECT key, size FROM {table} ORDER BY accessed_at")
+    stale = []
+    for key, size in rows:
+        if total <= max_bytes:
+            break
+        stale.append((key,))
+        total -= size
+    conn.executemany(f"DELETE FROM {table} WHERE key = ?", stale)
+
+
+class LRUCache:
+    """按字节数限制容量的线程安全LRU缓存，支持可选的压缩磁盘溢出"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, spill_dir: Optional[str] = None,
+                 max_spill_bytes: int = 256 * 1024 * 1024):
+        """
+        初始化缓存
+
+        Args:
+            max_bytes: 内存中缓存内容的总字节数上限
+            spill_dir: 溢出目录，提供时被淘汰的条目会压缩后写入该目录
+            max_spill_bytes: 溢出目录中压缩文件的总字节数上限
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        # 已溢出的条目：键的摘要（即文件名）到压缩后的字节数，按溢出时间排序
+        self._spilled: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._spill_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._load_spilled()
+
+    def _load_spilled(self) -> None:
+        """从溢出目录重建索引，重启前溢出的文件可以继续读取，并计入容量上限"""
+        files = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith(".tmp"):
+                # 写入中途退出留下的临时文件
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith(".z") and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-2], stat.st_size))
+        for _, digest, size in sorted(files):
+            self._spilled[digest] = size
+            self._spill_bytes += size
+        self._evict_spilled()
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _spill_path(self, digest: str) -> str:
+        return os.path.join(self.spill_dir, f"{digest}.z")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        读取缓存
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            缓存的字符串，未命中时返回None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value.decode("utf-8")
+
+            digest = self._digest(key)
+            if digest not in self._spilled:
+                self.misses += 1
+                return None
+
+            # 从磁盘读回并放回内存
+            path = self._spill_path(digest)
+            self._spill_bytes -= self._spilled.pop(digest)
+            try:
+                with open(path, "rb") as f:
+                    value = zlib.decompress(f.read())
+                os.remove(path)
+            except (OSError, zlib.error) as e:
+                logger.warning(f"读取溢出缓存失败: {e}")
+                self.misses += 1
+                return None
+
+            self.spill_hits += 1
+            self._store(key, value)
+            return value.decode("utf-8")
+
+    def put(self, key: str, value: str) -> None:
+        """
+        写入缓存，超出容量时淘汰最久未使用的条目
+
+        Args:
+            key: 缓存键
+            value: 要缓存的字符串
+        """
+        data = value.encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._store(key, data)
+
+    def _store(self, key: str, data: bytes) -> None:
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous)
+        self._entries[key] = data
+        self._bytes += len(data)
+
+        while self._bytes > self.max_bytes:
+            old_key, old_data = self._entries.popitem(last=False)
+            self._bytes -= len(old_data)
+            self._spill(old_key, old_data)
+
+    def _spill(self, key: str, data: bytes) -> None:
+        """把被淘汰的条目压缩写入磁盘，并按总大小清理最早溢出的文件"""
+        if not self.spill_dir:
+            return
+        digest = self._digest(key)
+        try:
+            compressed = zlib.compress(data, 6)
+            path = self._spill_path(digest)
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(compressed)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.warning(f"写入溢出缓存失败: {e}")
+            return
+
+        self._spill_bytes -= self._spilled.pop(digest, 0)
+        self._spilled[digest] = len(compressed)
+        self._spill_bytes += len(compressed)
+        self._evict_spilled()
+
+    def _evict_spilled(self) -> None:
+        """溢出文件的总大小超出上限时删除最早溢出的文件"""
+        while self._spill_bytes > self.max_spill_bytes:
+            digest, size = self._spilled.popitem(last=False)
+            self._spill_bytes -= size
+            try:
+                os.remove(self._spill_path(digest))
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        """清空内存和磁盘中的全部条目"""
+        with self._lock:
+            for digest in list(self._spilled):
+                try:
+                    os.remove(self._spill_path(digest))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._spilled.clear()
+            self._bytes = 0
+            self._spill_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中率和容量统计"""
+        with self._lock:
+            total = self.hits + self.spill_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "spilled_entries": len(self._spilled),
+                "spilled_bytes": self._spill_bytes,
+                "hits": self.hits,
+                "spill_hits": self.spill_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.spill_hits) / total if total else 0.0,
+            }
+
+
+class ResponseCache:
+    """
+    基于SQLite的持久化响应缓存，按TTL过期，按总字节数淘汰最久未访问的条目
+
+    值以zlib压缩的JSON保存，进程重启后仍然有效。用于缓存LLM的完整回复。
+    """
+
+    def __init__(self, path: str = DEFAULT_RESPONSE_CACHE_PATH,
+                 ttl: float = DEFAULT_RESPONSE_CACHE_TTL,
+                 max_bytes: int = 128 * 1024 * 1024):
+        """
+        初始化缓存
+
+        Args:
+            path: SQLite数据库文件路径
+            ttl: 条目的有效秒数
+            max_bytes: 压缩后内容的总字节数上限
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = _open_database(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)"
+        )
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """
+        把任意可JSON序列化的参数规范化后计算哈希，字典按键排序
+
+        Returns:
+            十六进制的SHA-256摘要
+        """
+        normalized = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        读取缓存
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            缓存的对象，未命中或已过期时返回None
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] >= self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            try:
+                value = json.loads(zlib.decompress(row[0]))
+            except (ValueError, zlib.error) as e:
+                logger.warning(f"读取响应缓存失败: {e}")
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        写入缓存，同时清理过期条目，超出容量时淘汰最久未访问的条目
+
+        Args:
+            key: 缓存键
+            value: 可JSON序列化的对象
+        """
+        data = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"), 6)
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, _transaction(self._conn) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+            _evict_by_access(conn, "responses", self.max_bytes)
+
+    def clear(self) -> None:
+        """删除全部条目"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中率和容量统计"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            total = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+_default_response_cache: Optional[ResponseCache] = None
+_default_response_cache_lock = threading.Lock()
+
+
+def get_default_response_cache() -> ResponseCache:
+    """返回进程内共享的默认响应缓存"""
+    global _default_response_cache
+    with _default_response_cache_lock:
+        if _default_response_cache is None:
+            _default_response_cache = ResponseCache()
+        return _default_response_cache
+
+
+class SharedCache:
+    """
+    同一主机上多个进程共享的持久化缓存
+
+    值以zlib压缩的pickle保存在SQLite（WAL模式）中，按总字节数淘汰最久未访问的条目。
+    pickle只用于本应用自己写入的缓存文件，不要指向不受信任的文件。
+    多个进程同时未命中同一个键时，通过租约只让一个进程调用加载函数，其余进程等待其写入；
+    同一进程内的并发未命中先经SingleFlight合并，每个进程只有一个线程轮询租约或加载。
+    """
+
+    def __init__(self, path: str = DEFAULT_SHARED_CACHE_PATH,
+                 max_bytes: int = DEFAULT_SHARED_CACHE_BYTES,
+                 lease_seconds: float = SHARED_LEASE_SECONDS):
+        """
+        初始化缓存
+
+        Args:
+            path: SQLite数据库文件路径，需要共享缓存的进程使用同一个路径
+            max_bytes: 压缩后内容的总字节数上限
+            lease_seconds: 加载租约的有效秒数
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lease_seconds = lease_seconds
+        self._owner = f"{os.getpid()}:{id(self)}"
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
+
+        self._conn = _open_database(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str, max_age: float) -> Optional[Tuple[Any, float]]:
+        """
+        读取缓存
+
+        Args:
+            key: 缓存键
+            max_age: 可接受的最长存在时间（秒）
+
+        Returns:
+            (缓存的对象, 写入时间戳)，未命中、过旧或无法反序列化时返回None
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] >= max_age:
+                return None
+            try:
+                value = pickle.loads(zlib.decompress(row[0]))
+            except Exception as e:
+                logger.warning(f"读取共享缓存失败: {e}")
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            return value, row[1]
+
+    def put(self, key: str, value: Any) -> float:
+        """
+        写入缓存，超出容量时淘汰最久未访问的条目；无法序列化的对象不写入
+
+        Args:
+            key: 缓存键
+            value: 可pickle的对象
+
+        Returns:
+            写入时间戳
+        """
+        now = time.time()
+        try:
+            data = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        except Exception as e:
+            logger.warning(f"无法写入共享缓存: {e}")
+            return now
+        if len(data) > self.max_bytes:
+            return now
+        with self._lock, _transaction(self._conn) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now, now),
+            )
+            _evict_by_access(conn, "entries", self.max_bytes)
+        return now
+
+    def _try_lease(self, key: str) -> bool:
+        """尝试取得键的加载租约，过期的租约视为已释放"""
+        now = time.time()
+        with self._lock, _transaction(self._conn) as conn:
+            conn.execute("DELETE FROM leases WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, self._owner, now + self.lease_seconds),
+            )
+            return cursor.rowcount == 1
+
+    def _release(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?",
+                               (key, self._owner))
+
+    def load(self, key: str, loader: Callable[[], Any], max_age: float) -> Tuple[Any, float]:
+        """
+        读取缓存，未命中时由取得租约的一个进程调用loader加载，其他进程等待其结果
+
+        租约被其他进程持有超过lease_seconds仍未写入时，不再等待，直接调用loader。
+
+        Args:
+            key: 缓存键
+            loader: 无参数的加载函数，异常会直接抛给调用方且不缓存
+            max_age: 可接受的最长存在时间（秒）
+
+        Returns:
+            (值, 写入时间戳)
+        """
+        entry = self.get(key, max_age)
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry
+
+        leader = []
+
+        def lease_and_load() -> Tuple[Any, float]:
+            leader.append(True)
+            return self._lease_and_load(key, loader, max_age)
+
+        entry = self._flights.do(key, lease_and_load)
+        if not leader:
+            # 同一进程内的其他线程已经取得结果
+            with self._lock:
+                self.waits += 1
+        return entry
+
+    def _lease_and_load(self, key: str, loader: Callable[[], Any],
+                        max_age: float) -> Tuple[Any, float]:
+        """取得租约后加载，或等待持有租约的进程写入，直到租约期限"""
+        leased = self._try_lease(key)
+        deadline = time.time() + self.lease_seconds
+        while not leased and time.time() < deadline:
+            time.sleep(SHARED_POLL_INTERVAL)
+            entry = self.get(key, max_age)
+            if entry is not None:
+                with self._lock:
+                    self.waits += 1
+                return entry
+            leased = self._try_lease(key)
+
+        try:
+            # 取得租约前其他进程可能刚刚写入
+            entry = self.get(key, max_age) if leased else None
+            if entry is not None:
+                with self._lock:
+                    self.hits += 1
+                return entry
+            with self._lock:
+                self.misses += 1
+            value = loader()
+            return value, self.put(key, value)
+        finally:
+            if leased:
+                self._release(key)
+
+    def clear(self) -> None:
+        """删除全部条目"""
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回本进程的命中情况和缓存的整体容量，等待其他进程加载的结果计入命中率"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            total = self.hits + self.waits + self.misses
+            return {
+                "entries": entries,
+                "bytes": size,
+                "hits": self.hits,
+                "waits": self.waits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.waits) / total if total else 0.0,
+            }
+
+
+_default_shared_cache: Optional[SharedCache] = None
+_default_shared_cache_lock = threading.Lock()
+
+
+def get_default_shared_cache() -> Optional[SharedCache]:
+    """
+    返回进程内共享的默认跨进程缓存
+
+    Returns:
+        SharedCache；SHARED_CACHE_PATH为空或无法打开数据库（如只读文件系统）时返回None
+    """
+    global _default_shared_cache
+    with _default_shared_cache_lock:
+        if _default_shared_cache is None and DEFAULT_SHARED_CACHE_PATH:
+            try:
+                _default_shared_cache = SharedCache()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"无法打开共享缓存，只使用进程内缓存: {e}")
+        return _default_shared_cache
+
+
+class _SharedStream:
+    """由后台线程生产、可被多个调用方从头读取的事件序列"""
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.condition = threading.Condition()
+
+    def produce(self, factory: Callable[[], Iterable[Any]]) -> None:
+        try:
+            for item in factory():
+                with self.condition:
+                    self.items.append(item)
+                    self.condition.notify_all()
+        except BaseException as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def consume(self) -> Generator[Any, None, None]:
+        position = 0
+        while True:
+            with self.condition:
+                while position >= len(self.items) and not self.done:
+                    self.condition.wait()
+                if position < len(self.items):
+                    item = self.items[position]
+                    position += 1
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield item
+
+
+class SingleFlight:
+    """
+    合并并发的重复请求
+
+    同一个键同时只执行一次：第一个调用方执行函数，执行期间到达的调用方等待同一个Future，
+    得到相同的结果或异常。执行结束后键即被移除，不缓存结果。
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._streams: Dict[Hashable, _SharedStream] = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """
+        执行func，同一个键的并发调用共享同一次执行的结果
+
+        Args:
+            key: 请求的键
+            func: 无参数的函数
+
+        Returns:
+            func的返回值
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stream(self, key: Hashable,
+               factory: Callable[[], Iterable[Any]]) -> Generator[Any, None, None]:
+        """
+        流式版本的do：同一个键的并发调用共享同一个事件序列
+
+        序列在后台线程中生产，每个调用方都从第一个事件开始读取，
+        某个调用方提前停止读取不影响其他调用方。
+
+        Args:
+            key: 请求的键
+            factory: 返回可迭代事件序列的无参数函数
+
+        Returns:
+            事件生成器
+        """
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is None:
+                shared = _SharedStream()
+                self._streams[key] = shared
+                self.executed += 1
+
+                def produce() -> None:
+                    try:
+                        shared.produce(factory)
+                    finally:
+                        with self._lock:
+                            if self._streams.get(key) is shared:
+                                del self._streams[key]
+
+                threading.Thread(target=produce, daemon=True).start()
+            else:
+                self.coalesced += 1
+        return shared.consume()
+
+    def stats(self) -> Dict[str, int]:
+        """返回执行次数和被合并的请求数"""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._streams),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+            }
+
+
+class TieredTTLCache:
+    """
+    按数据类别设置有效期的线程安全缓存，支持过期后先返回旧值再后台刷新
+
+    每个类别的策略为{"open": 交易时段内的有效秒数, "closed": 交易时段外的有效秒数,
+    "stale": 过期后仍可返回旧值的秒数}。条目过期但仍在stale窗口内时立即返回旧值，
+    并在后台线程中重新加载；超出窗口或不存在时同步加载。后台刷新失败时保留旧值。
+    提供shared时加载前先读取其他进程写入的结果，自己加载的结果也写入shared。
+    """
+
+    def __init__(self, policies: Dict[str, Dict[str, float]], max_entries: int = 4096,
+                 refresh_workers: int = 4, shared: Optional[SharedCache] = None):
+        """
+        初始化缓存
+
+        Args:
+            policies: 数据类别到有效期策略的字典
+            max_entries: 条目数上限，超出时淘汰最久未使用的条目
+            refresh_workers: 后台刷新的最大并发数
+            shared: 可选的跨进程缓存，缓存键的repr作为其中的键
+        """
+        self.policies = policies
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._refreshing: set = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=refresh_workers,
+                                            thread_name_prefix="cache-refresh")
+        self._counts: Dict[str, Dict[str, int]] = {
+            data_class: dict.fromkeys(("hits", "stale_hits", "misses", "refreshes",
+                                       "refresh_errors"), 0)
+            for data_class in policies
+        }
+
+    def ttl(self, data_class: str, market_open: bool = True) -> float:
+        """返回类别在当前交易状态下的有效秒数"""
+        return self.policies[data_class]["open" if market_open else "closed"]
+
+    def get(self, data_class: str, key: Hashable, loader: Callable[[], Any],
+            market_open: bool = True) -> Any:
+        """
+        读取缓存，未命中时调用loader加载
+
+        Args:
+            data_class: 数据类别，必须是policies中的键
+            key: 缓存键，同一个键只应属于一个类别
+            loader: 无参数的加载函数，异常会直接抛给调用方且不缓存
+            market_open: 当前是否处于交易时段，决定使用哪个有效期
+
+        Returns:
+            缓存的值或新加载的值
+        """
+        policy = self.policies[data_class]
+        counts = self._counts[data_class]
+        ttl = self.ttl(data_class, market_open)
+        cache_key = (data_class, key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                value, loaded_at = entry
+                age = now - loaded_at
+                if age < ttl:
+                    self._entries.move_to_end(cache_key)
+                    counts["hits"] += 1
+                    return value
+                if age < ttl + policy["stale"]:
+                    self._entries.move_to_end(cache_key)
+                    counts["stale_hits"] += 1
+                    if cache_key not in self._refreshing:
+                        self._refreshing.add(cache_key)
+                        self._executor.submit(self._refresh, data_class, cache_key, loader, ttl)
+                    return value
+            counts["misses"] += 1
+
+        value, loaded_at = self._load(cache_key, loader, ttl)
+        self._store(cache_key, value, loaded_at)
+        return value
+
+    def _load(self, cache_key: Hashable, loader: Callable[[], Any],
+              ttl: float) -> Tuple[Any, float]:
+        """加载值，有共享缓存时优先使用其他进程在有效期内写入的结果"""
+        if self.shared is None:
+            return loader(), time.time()
+        return self.shared.load(repr(cache_key), loader, ttl)
+
+    def _refresh(self, data_class: str, cache_key: Hashable, loader: Callable[[], Any],
+                 ttl: float) -> None:
+        try:
+            value, loaded_at = self._load(cache_key, loader, ttl)
+        except Exception as e:
+            logger.warning(f"后台刷新{data_class}缓存失败: {e}")
+            with self._lock:
+                self._counts[data_class]["refresh_errors"] += 1
+                self._refreshing.discard(cache_key)
+            return
+        self._store(cache_key, value, loaded_at)
+        with self._lock:
+            self._counts[data_class]["refreshes"] += 1
+            self._refreshing.discard(cache_key)
+
+    def _store(self, cache_key: Hashable, value: Any, loaded_at: float) -> None:
+        with self._lock:
+            self._entries[cache_key] = (value, loaded_at)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, data_class: Optional[str] = None) -> None:
+        """删除指定类别的条目，不指定时删除全部条目"""
+        with self._lock:
+            for cache_key in list(self._entries):
+                if data_class is None or cache_key[0] == data_class:
+                    del self._entries[cache_key]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """返回各类别的条目数和命中情况，旧值命中计入命中率"""
+        with self._lock:
+            entries = {data_class: 0 for data_class in self.policies}
+            for data_class, _ in self._entries:
+                entries[data_class] += 1
+            result = {}
+            for data_class, counts in self._counts.items():
+                total = counts["hits"] + counts["stale_hits"] + counts["misses"]
+                result[data_class] = dict(
+                    counts, entries=entries[data_class],
+                    hit_rate=(counts["hits"] + counts["stale_hits"]) / total if total else 0.0,
+                )
+            return result
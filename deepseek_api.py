@@ -1,40 +1,463 @@
 import requests
+import asyncio
+import collections.abc
+import inspect
 import os
+import json
 import logging
-from typing import Dict, Any, Generator, Optional, List, Union
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from typing import (Dict, Any, AsyncGenerator, AsyncIterator, Callable, Deque, Generator, Iterator,
+                    Optional, List, Tuple, Union)
+
+from caching import ResponseCache
+from token_budget import compact_text, context_budget, estimate_message_tokens
+
+try:
+    import aiohttp
+except ImportError:  # 异步客户端为可选功能
+    aiohttp = None
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("deepseek_api")
 
+# 连接池和重试的默认配置
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 1.0
+DEFAULT_MAX_BACKOFF = 30.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 300.0
+
+# 异步客户端同时进行中的请求数上限
+DEFAULT_MAX_CONCURRENCY = 16
+
+# 进程内LLM请求调度：同时进行中的请求数上限、排队请求数上限、单个会话的排队请求数上限
+# （未设置时为排队上限的四分之一）、首次估算等待时间使用的单次请求耗时（秒），
+# 以及排队时报告位置的间隔（秒）
+DEFAULT_SCHEDULER_CONCURRENCY = int(os.environ.get("DEEPSEEK_MAX_CONCURRENT_REQUESTS", 4))
+DEFAULT_MAX_QUEUE_DEPTH = int(os.environ.get("DEEPSEEK_MAX_QUEUE_DEPTH", 32))
+DEFAULT_MAX_SESSION_QUEUE_DEPTH = (int(os.environ["DEEPSEEK_MAX_SESSION_QUEUE_DEPTH"])
+                                   if os.environ.get("DEEPSEEK_MAX_SESSION_QUEUE_DEPTH")
+                                   else None)
+DEFAULT_SERVICE_TIME = 30.0
+QUEUE_REPORT_INTERVAL = 1.0
+
+# 需要重试的HTTP状态码：限流和服务端临时错误
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 工具调用：使用的模型（deepseek-reasoner不支持Function Calling）、最大轮数、
+# 同一轮内并发执行的工具数上限，以及单个工具结果写入对话的最大字符数和表格行数
+TOOL_CALLING_MODEL = "deepseek-chat"
+DEFAULT_MAX_TOOL_ROUNDS = 5
+DEFAULT_TOOL_WORKERS = 8
+MAX_TOOL_RESULT_CHARS = 8000
+MAX_TOOL_RESULT_ROWS = 60
+
+# 工具函数参数类型到JSON Schema类型的映射，未列出的类型按字符串处理
+_JSON_SCHEMA_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean",
+                      list: "array", collections.abc.Iterable: "array",
+                      collections.abc.Sequence: "array", dict: "object"}
+
+# 由调用方注入、不暴露给模型的工具函数参数
+_INTERNAL_TOOL_PARAMS = {"session"}
+
+# 并行流程中同时执行的任务数上限
+DEFAULT_MAX_PARALLEL_TASKS = 4
+
+# 模型分级：每个级别使用的模型、最大生成令牌数和温度。Task或Agent通过tier声明级别，
+# 可用环境变量DEEPSEEK_MODEL_TIERS（JSON，按级别覆盖或新增）或Crew的model_tiers参数调整
+MODEL_TIERS = {
+    # 复杂分析和推理
+    "reasoning": {"model": "deepseek-reasoner", "max_tokens": 4000, "temperature": 0.7},
+    # 报告撰写等以整理和格式化为主的任务
+    "fast": {"model": "deepseek-chat", "max_tokens": 4000, "temperature": 0.7},
+}
+DEFAULT_MODEL_TIER = "reasoning"
+
+# 按连接池大小共享的HTTP会话，多个DeepSeekAPI实例复用同一组长连接
+_sessions: Dict[int, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_shared_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    获取进程内共享的HTTP会话，连接保持复用，避免每次请求都重新进行TCP和TLS握手
+
+    Args:
+        pool_size: 每个主机的最大连接数
+
+    Returns:
+        共享的requests.Session
+    """
+    with _sessions_lock:
+        session = _sessions.get(pool_size)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[pool_size] = session
+        return session
+
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """解析Retry-After响应头，支持秒数和HTTP日期两种格式"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _copy_messages(messages: Optional[List[Dict[str, Any]]]) -> Optional[List[Dict[str, Any]]]:
+    """复制消息列表，工具调用循环向副本追加消息，不修改调用方的列表"""
+    return list(messages) if messages is not None else None
+
+
+class QueueFullError(RuntimeError):
+    """LLM请求队列已满，请求被立即拒绝"""
+
+
+class _Ticket:
+    """调度器中的一个请求"""
+
+    def __init__(self, session_id: str, priority: int):
+        self.session_id = session_id
+        self.priority = priority
+        self.granted = False
+        self.started = 0.0
+
+
+class LLMScheduler:
+    """
+    进程内的LLM请求调度器
+
+    - 同时进行中的请求数不超过max_concurrency，其余请求排队
+    - 优先级数值越小越先执行，交互请求（INTERACTIVE）先于批量请求（BATCH）
+    - 同一优先级内按会话轮转，单个会话的大量请求不会饿死其他会话
+    - 排队请求数达到max_queue_depth，或同一会话的排队请求数达到max_session_queue_depth时
+      立即拒绝，抛出QueueFullError；单个会话无法占满整个队列
+    - 可以查询请求的排队位置和按平均耗时估算的等待时间
+    """
+
+    INTERACTIVE = 0
+    BATCH = 1
+
+    def __init__(self, max_concurrency: int = DEFAULT_SCHEDULER_CONCURRENCY,
+                 max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH,
+                 service_time: float = DEFAULT_SERVICE_TIME,
+                 max_session_queue_depth: Optional[int] = DEFAULT_MAX_SESSION_QUEUE_DEPTH):
+        """
+        初始化调度器
+
+        Args:
+            max_concurrency: 同时进行中的请求数上限
+            max_queue_depth: 排队请求数上限
+            max_session_queue_depth: 单个会话的排队请求数上限，默认为max_queue_depth的四分之一
+            service_time: 单次请求耗时的初始估计（秒），之后按实际耗时的滑动平均更新
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue_depth = max_queue_depth
+        if max_session_queue_depth is None:
+            max_session_queue_depth = max_queue_depth // 4
+        self.max_session_queue_depth = max(1, min(max_session_queue_depth, max_queue_depth))
+        self.service_time = service_time
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Ticket]]"] = {}
+        self._running = 0
+        self._queued = 0
+        self._rejected = 0
+        self._condition = threading.Condition()
+
+    def _dispatch_order(self) -> List[_Ticket]:
+        """排队请求的预计执行顺序：按优先级，同一优先级内按会话轮转"""
+        order = []
+        for priority in sorted(self._queues):
+            pending = [list(tickets) for tickets in self._queues[priority].values()]
+            for round_index in range(max((len(tickets) for tickets in pending), default=0)):
+                order.extend(tickets[round_index] for tickets in pending
+                             if round_index < len(tickets))
+        return order
+
+    def _pop_next(self) -> _Ticket:
+        priority = min(p for p, sessions in self._queues.items() if sessions)
+        sessions = self._queues[priority]
+        session_id, tickets = next(iter(sessions.items()))
+        ticket = tickets.popleft()
+        # 取出一个请求后该会话排到队尾，实现会话间轮转
+        if tickets:
+            sessions.move_to_end(session_id)
+        else:
+            del sessions[session_id]
+        return ticket
+
+    def _grant(self) -> None:
+        while self._running < self.max_concurrency and self._queued:
+            ticket = self._pop_next()
+            ticket.granted = True
+            ticket.started = time.monotonic()
+            self._running += 1
+            self._queued -= 1
+        self._condition.notify_all()
+
+    def _session_queued(self, session_id: str) -> int:
+        return sum(len(sessions.get(session_id, ())) for sessions in self._queues.values())
+
+    def _wait_estimate(self, position: int) -> float:
+        return (position // self.max_concurrency + 1) * self.service_time
+
+    def acquire(self, session_id: str = "default", priority: int = INTERACTIVE,
+                on_wait: Optional[Callable[[int, float], None]] = None) -> _Ticket:
+        """
+        申请执行名额，排队时阻塞
+
+        Args:
+            session_id: 发起请求的会话标识，用于会话间轮转
+            priority: 优先级，数值越小越先执行
+            on_wait: 排队期间位置变化时的回调，参数为前面的请求数和估算的等待秒数
+
+        Returns:
+            执行名额，用完后必须调用release
+
+        Raises:
+            QueueFullError: 排队请求数或该会话的排队请求数已达上限
+        """
+        with self._condition:
+            if self._running >= self.max_concurrency:
+                if self._queued >= self.max_queue_depth:
+                    self._rejected += 1
+                    raise QueueFullError(f"当前请求过多（排队{self._queued}个），请稍后再试")
+                if self._session_queued(session_id) >= self.max_session_queue_depth:
+                    self._rejected += 1
+                    raise QueueFullError("当前会话排队的请求过多"
+                                         f"（{self.max_session_queue_depth}个），请稍后再试")
+            ticket = _Ticket(session_id, priority)
+            self._queues.setdefault(priority, OrderedDict()).setdefault(
+                session_id, deque()).append(ticket)
+            self._queued += 1
+            self._grant()
+
+            reported = None
+            while not ticket.granted:
+                if on_wait is not None:
+                    position = self._dispatch_order().index(ticket)
+                    if position != reported:
+                        on_wait(position, self._wait_estimate(position))
+                        reported = position
+                self._condition.wait(QUEUE_REPORT_INTERVAL)
+            return ticket
+
+    def release(self, ticket: _Ticket) -> None:
+        """归还执行名额，并用本次耗时更新平均耗时"""
+        with self._condition:
+            self._running -= 1
+            elapsed = time.monotonic() - ticket.started
+            self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+            self._grant()
+
+    @contextmanager
+    def slot(self, session_id: str = "default", priority: int = INTERACTIVE,
+             on_wait: Optional[Callable[[int, float], None]] = None) -> Iterator[_Ticket]:
+        """在with块内占用一个执行名额，参数与acquire相同"""
+        ticket = self.acquire(session_id, priority, on_wait)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def status(self, session_id: str) -> Dict[str, Any]:
+        """
+        查询会话的排队情况
+
+        Returns:
+            {"queued": 该会话排队中的请求数, "position": 最靠前的请求前面还有多少请求，
+             "estimated_wait": 估算的等待秒数}；没有排队请求时position和estimated_wait为None
+        """
+        with self._condition:
+            order = self._dispatch_order()
+            positions = [index for index, ticket in enumerate(order)
+                         if ticket.session_id == session_id]
+            position = positions[0] if positions else None
+            return {
+                "queued": len(positions),
+                "position": position,
+                "estimated_wait": self._wait_estimate(position) if positions else None,
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        """返回整体的运行和排队情况"""
+        with self._condition:
+            return {
+                "running": self._running,
+                "queued": self._queued,
+                "rejected": self._rejected,
+                "max_concurrency": self.max_concurrency,
+                "service_time": self.service_time,
+            }
+
+
+_default_scheduler: Optional[LLMScheduler] = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler() -> LLMScheduler:
+    """返回进程内共享的默认调度器"""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = LLMScheduler()
+        return _default_scheduler
+
+
 class DeepSeekAPI:
     """DeepSeek API客户端，提供与OpenAI API类似的接口"""
     
-    def __init__(self, api_key: str = None, base_url: str = "https://api.deepseek.com"):
+    def __init__(self, api_key: str = None, base_url: str = "https://api.deepseek.com",
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 cache: Optional[ResponseCache] = None,
+                 scheduler: Optional[LLMScheduler] = None,
+                 session_id: str = "default",
+                 priority: int = LLMScheduler.INTERACTIVE):
         """
         初始化DeepSeek API客户端
         
         Args:
             api_key: DeepSeek API密钥
             base_url: API基础URL，默认为https://api.deepseek.com
+            pool_size: 共享连接池中每个主机的最大连接数
+            max_retries: 遇到429、5xx或连接失败时的最大重试次数
+            backoff_factor: 指数退避的基础等待秒数
+            max_backoff: 单次退避的最长等待秒数
+            connect_timeout: 建立连接的超时秒数
+            read_timeout: 等待响应数据的超时秒数
+            cache: 可选的响应缓存，提供时相同请求直接返回缓存的回复
+            scheduler: 可选的请求调度器，提供时每个请求先申请执行名额
+            session_id: 调度时使用的会话标识
+            priority: 调度优先级，交互请求为LLMScheduler.INTERACTIVE，批量请求为BATCH
         """
         self.api_key = api_key or os.environ.get("DEEPSEEK_API_KEY")
         if not self.api_key:
             raise ValueError("必须提供DeepSeek API密钥")
             
-        self.base_url = base_url
+        self.base_url = base_url or "https://api.deepseek.com"
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
+        self.pool_size = pool_size
+        self.session = get_shared_session(pool_size)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache = cache
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.priority = priority
+
+    def _slot(self, on_wait: Optional[Callable[[int, float], None]] = None):
+        """申请调度器的执行名额，未配置调度器时不做限制"""
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.slot(self.session_id, self.priority, on_wait)
+
+    def _backoff_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """计算第attempt次重试前的等待时间：优先遵循Retry-After，否则使用带抖动的指数退避"""
+        if response is not None:
+            retry_after = _retry_after_seconds(response)
+            if retry_after is not None:
+                return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+
+    def _post(self, url: str, data: Dict[str, Any], stream: bool = False) -> requests.Response:
+        """
+        通过共享连接池发送请求，对限流、服务端临时错误和连接失败进行重试
+
+        读取超时不重试，避免重复生成已在服务端处理中的长回复。
+
+        Args:
+            url: API URL
+            data: 请求数据
+            stream: 是否流式读取响应
+
+        Returns:
+            状态码为2xx的响应
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, headers=self.headers, json=data,
+                                             timeout=self.timeout, stream=stream)
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+                logger.warning(f"连接API失败，{delay:.1f}秒后重试 ({attempt + 1}/{self.max_retries}): {e}")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response
+                delay = self._backoff_delay(attempt, response)
+                logger.warning(f"API返回{response.status_code}，{delay:.1f}秒后重试 "
+                               f"({attempt + 1}/{self.max_retries})")
+                response.close()
+
+            time.sleep(delay)
+            attempt += 1
+    
+    @staticmethod
+    def _build_payload(messages: List[Dict[str, str]], model: str, temperature: float,
+                       max_tokens: int, stream: bool, **kwargs) -> Dict[str, Any]:
+        """构建对话请求体"""
+        return {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": stream,
+            **kwargs
+        }
     
+    @staticmethod
+    def _cache_key(messages: List[Dict[str, str]], model: str, temperature: float,
+                   max_tokens: int, cache_token: Optional[str], **kwargs) -> str:
+        """按规范化的请求参数和数据新鲜度标记计算缓存键，与是否流式输出无关"""
+        normalized = [
+            {**message, "content": (message.get("content") or "").strip()}
+            for message in messages
+        ]
+        return ResponseCache.make_key(model, normalized, temperature, max_tokens, kwargs,
+                                      cache_token)
+
     def chat(self, 
              messages: List[Dict[str, str]], 
              model: str = "deepseek-chat", 
              temperature: float = 0.7,
              max_tokens: int = 1024,
              stream: bool = False,
+             cache_token: Optional[str] = None,
+             on_wait: Optional[Callable[[int, float], None]] = None,
+             cache_messages: Optional[List[Dict[str, Any]]] = None,
              **kwargs) -> Union[Dict[str, Any], Generator[Dict[str, Any], None, None]]:
         """
         发送对话请求到DeepSeek API
@@ -45,6 +468,11 @@ class DeepSeekAPI:
             temperature: 温度参数，控制创造性，范围0-1
             max_tokens: 最大生成令牌数
             stream: 是否使用流式输出
+            cache_token: 数据新鲜度标记（如最后一根K线的日期），启用缓存时参与缓存键计算，
+                数据更新后自动失效
+            on_wait: 配置了调度器时，排队期间位置变化的回调，参数为前面的请求数和估算的等待秒数
+            cache_messages: 提供时代替messages计算缓存键，用于消息中包含在cache_token有效期内
+                不断变化、但不应影响缓存的内容（如实时行情）
             **kwargs: 其他参数
             
         Returns:
@@ -52,171 +480,978 @@ class DeepSeekAPI:
             如果stream=True，返回响应生成器
         """
         url = f"{self.base_url}/chat/completions"
+        data = self._build_payload(messages, model, temperature, max_tokens, stream, **kwargs)
         
-        data = {
-            "model": model,
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": stream,
-            **kwargs
-        }
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(cache_messages or messages, model, temperature,
+                                        max_tokens, cache_token, **kwargs)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info("命中响应缓存")
+                return self._replay_stream(cached) if stream else cached
         
         if not stream:
             # 非流式输出
             try:
-                response = requests.post(url, headers=self.headers, json=data)
-                response.raise_for_status()
-                return response.json()
+                with self._slot(on_wait):
+                    response = self._post(url, data).json()
             except Exception as e:
                 logger.error(f"请求API时出错: {str(e)}")
                 raise
+            if cache_key is not None and self._cacheable(response):
+                self.cache.put(cache_key, response)
+            return response
         else:
             # 流式输出
-            return self._stream_response(url, data)
+            return self._stream_response(url, data, cache_key, on_wait)
     
-    def _stream_response(self, url: str, data: Dict[str, Any]) -> Generator[Dict[str, Any], None, None]:
+    @staticmethod
+    def _cacheable(response: Dict[str, Any]) -> bool:
+        """只缓存有内容的回复：包含文本或工具调用，空回复通常是出错或被截断"""
+        try:
+            message = response['choices'][0]['message']
+        except (KeyError, IndexError, TypeError):
+            return False
+        return bool(message.get('content') or message.get('tool_calls'))
+    
+    @staticmethod
+    def _replay_stream(response: Dict[str, Any]) -> Generator[Dict[str, Any], None, None]:
+        """把缓存的完整响应作为单个流式块返回，工具调用按流式增量的格式带上序号"""
+        choice = response['choices'][0]
+        message = choice['message']
+        delta = {key: message[key] for key in ("role", "reasoning_content", "content")
+                 if message.get(key)}
+        if message.get('tool_calls'):
+            delta['tool_calls'] = [dict(call, index=index)
+                                   for index, call in enumerate(message['tool_calls'])]
+        finish_reason = choice.get('finish_reason') or \
+            ("tool_calls" if message.get('tool_calls') else "stop")
+        yield {"choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    
+    def _stream_response(self, url: str, data: Dict[str, Any],
+                         cache_key: Optional[str] = None,
+                         on_wait: Optional[Callable[[int, float], None]] = None
+                         ) -> Generator[Dict[str, Any], None, None]:
         """
         处理流式响应
         
         Args:
             url: API URL
             data: 请求数据
+            cache_key: 提供时在流完整结束后把拼接好的回复写入缓存
+            on_wait: 排队期间的回调，与chat相同
             
         Returns:
             响应生成器
         """
+        parts = {"reasoning_content": [], "content": []}
         try:
-            response = requests.post(url, headers=self.headers, json=data, stream=True)
-            response.raise_for_status()
+            # 执行名额在读取结束前一直占用；使用with确保读取结束后连接归还连接池
+            with self._slot(on_wait), self._post(url, data, stream=True) as response:
+                for line in response.iter_lines():
+                    if line:
+                        line = line.decode('utf-8')
+                        if line.startswith('data: '):
+                            if line == 'data: [DONE]':
+                                break
+                            try:
+                                # 去掉'data: '前缀并解析JSON
+                                chunk = line[6:]
+                                chunk = json.loads(chunk)
+                            except json.JSONDecodeError:
+                                continue
+                            if cache_key is not None:
+                                delta = (chunk.get('choices') or [{}])[0].get('delta') or {}
+                                for key, texts in parts.items():
+                                    if delta.get(key):
+                                        texts.append(delta[key])
+                                # 缓存只保存文本回复，包含工具调用的回复不缓存
+                                if delta.get('tool_calls'):
+                                    cache_key = None
+                            yield chunk
+        except Exception as e:
+            logger.error(f"处理流式响应时出错: {str(e)}")
+            raise
+        
+        if cache_key is not None and parts["content"]:
+            message = {"role": "assistant", **{key: "".join(texts) for key, texts in parts.items()}}
+            self.cache.put(cache_key, {"choices": [{"index": 0, "message": message}]})
+    
+    def chat_with_tools(self,
+                        messages: List[Dict[str, Any]],
+                        runner: "ToolRunner",
+                        model: str = TOOL_CALLING_MODEL,
+                        max_rounds: int = DEFAULT_MAX_TOOL_ROUNDS,
+                        stream: bool = False,
+                        **kwargs) -> Union[Dict[str, Any], Generator[Dict[str, Any], None, None]]:
+        """
+        带工具调用的对话：模型请求工具时执行工具并把结果加入对话，直到模型给出最终回复
+        
+        Args:
+            messages: 对话消息列表，不会被修改
+            runner: 执行工具调用的ToolRunner
+            model: 支持Function Calling的模型名称
+            max_rounds: 最多执行的工具调用轮数，达到后要求模型直接回复
+            stream: 是否使用流式输出
+            **kwargs: 传给chat的其他参数，如temperature、max_tokens、cache_token和
+                cache_messages；每轮的工具调用和结果会同时追加到cache_messages
+            
+        Returns:
+            如果stream=False，返回最终回复的响应字典
+            如果stream=True，返回响应生成器；每轮工具执行完成后额外产生一个
+            {"tool_calls": [...], "tool_results": [...]}块
+        """
+        if stream:
+            return self._stream_with_tools(list(messages), runner, model, max_rounds, **kwargs)
+        
+        messages = list(messages)
+        cache_messages = _copy_messages(kwargs.pop('cache_messages', None))
+        tools = runner.schemas()
+        for _ in range(max_rounds):
+            response = self.chat(messages, model=model, tools=tools,
+                                 cache_messages=cache_messages, **kwargs)
+            message = response['choices'][0]['message']
+            if not message.get('tool_calls'):
+                return response
+            round_messages = [message] + runner.run(message['tool_calls'])
+            for history in (messages, cache_messages):
+                if history is not None:
+                    history.extend(round_messages)
+        
+        # 达到最大轮数，不再提供工具
+        return self.chat(messages, model=model, cache_messages=cache_messages, **kwargs)
+    
+    def _stream_with_tools(self, messages: List[Dict[str, Any]], runner: "ToolRunner",
+                           model: str, max_rounds: int,
+                           **kwargs) -> Generator[Dict[str, Any], None, None]:
+        """流式版本的chat_with_tools，工具调用的增量按index拼接"""
+        cache_messages = _copy_messages(kwargs.pop('cache_messages', None))
+        tools = runner.schemas()
+        for round_index in range(max_rounds + 1):
+            # 达到最大轮数后不再提供工具，要求模型直接回复
+            extra = {"tools": tools} if round_index < max_rounds else {}
+            content = []
+            calls: Dict[int, Dict[str, Any]] = {}
+            for chunk in self.chat(messages, model=model, stream=True,
+                                   cache_messages=cache_messages, **extra, **kwargs):
+                delta = (chunk.get('choices') or [{}])[0].get('delta') or {}
+                if delta.get('content'):
+                    content.append(delta['content'])
+                for part in delta.get('tool_calls') or []:
+                    call = calls.setdefault(part.get('index', 0), {
+                        "id": "", "type": "function", "function": {"name": "", "arguments": ""}
+                    })
+                    call["id"] = part.get('id') or call["id"]
+                    function = part.get('function') or {}
+                    call["function"]["name"] += function.get('name') or ""
+                    call["function"]["arguments"] += function.get('arguments') or ""
+                yield chunk
             
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
+            if not calls:
+                return
+            tool_calls = [calls[index] for index in sorted(calls)]
+            results = runner.run(tool_calls)
+            round_messages = [{"role": "assistant", "content": "".join(content),
+                               "tool_calls": tool_calls}] + results
+            for history in (messages, cache_messages):
+                if history is not None:
+                    history.extend(round_messages)
+            yield {"tool_calls": tool_calls, "tool_results": results}
+
+
+class _LoopResources:
+    """异步客户端在一个事件循环中使用的aiohttp会话、并发信号量和负责关闭会话的任务"""
+
+    def __init__(self, session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore):
+        self.session = session
+        self.semaphore = semaphore
+        self.closer: Optional[asyncio.Task] = None
+
+
+class AsyncDeepSeekAPI(DeepSeekAPI):
+    """
+    DeepSeek API的asyncio客户端，请求和响应格式与DeepSeekAPI.chat相同
+
+    基于aiohttp，通过信号量限制同时进行中的请求数，一个进程可以并发等待大量
+    长时间运行的推理请求而不占用线程。
+
+    aiohttp会话和信号量只能在创建它们的事件循环中使用，因此按事件循环分别创建，
+    同一个客户端可以先后在多次asyncio.run中使用。asyncio.run结束时会取消剩余的任务，
+    会话随之关闭；自行管理事件循环时需要在关闭循环前调用aclose。
+    配置了调度器时请求同样经过调度器排队，并与同步请求共用响应缓存。
+    """
+
+    def __init__(self, api_key: str = None, base_url: str = "https://api.deepseek.com",
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY, **kwargs):
+        """
+        初始化异步客户端
+
+        Args:
+            api_key: DeepSeek API密钥
+            base_url: API基础URL
+            max_concurrency: 每个事件循环中同时进行中的请求数上限，流式请求在读取结束前
+                一直占用名额；跨事件循环和线程的总并发由调度器限制
+            **kwargs: 连接池、重试、超时、缓存和调度器配置，与DeepSeekAPI相同
+        """
+        if aiohttp is None:
+            raise ImportError("异步客户端需要安装aiohttp")
+        super().__init__(api_key, base_url, **kwargs)
+        self.max_concurrency = max_concurrency
+        self._loop_resources: Dict[asyncio.AbstractEventLoop, _LoopResources] = {}
+        self._resources_lock = threading.Lock()
+        # 等待调度器名额的线程；不使用事件循环的默认线程池，
+        # 否则asyncio.run结束时会等待仍在排队的请求
+        self._acquire_executor: Optional[ThreadPoolExecutor] = None
+
+    def _resources(self) -> _LoopResources:
+        """返回当前事件循环的会话和信号量，首次使用时创建"""
+        loop = asyncio.get_running_loop()
+        with self._resources_lock:
+            resources = self._loop_resources.get(loop)
+            if resources is not None and not resources.session.closed:
+                return resources
+            connect_timeout, read_timeout = self.timeout
+            session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                              sock_read=read_timeout),
+            )
+            resources = _LoopResources(session, asyncio.Semaphore(self.max_concurrency))
+            resources.closer = loop.create_task(self._close_with_loop(loop, resources))
+            self._loop_resources[loop] = resources
+            return resources
+
+    async def _close_with_loop(self, loop: asyncio.AbstractEventLoop,
+                               resources: _LoopResources) -> None:
+        """一直等待到被取消（事件循环结束或aclose），然后关闭会话"""
+        try:
+            await loop.create_future()
+        finally:
+            with self._resources_lock:
+                if self._loop_resources.get(loop) is resources:
+                    del self._loop_resources[loop]
+            await resources.session.close()
+
+    async def aclose(self) -> None:
+        """关闭当前事件循环中的aiohttp会话"""
+        with self._resources_lock:
+            resources = self._loop_resources.get(asyncio.get_running_loop())
+        if resources is not None:
+            resources.closer.cancel()
+            await asyncio.gather(resources.closer, return_exceptions=True)
+
+    async def __aenter__(self) -> "AsyncDeepSeekAPI":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.aclose()
+
+    @asynccontextmanager
+    async def _aslot(self) -> AsyncIterator[None]:
+        """
+        先占用当前事件循环的并发名额，再申请调度器的执行名额
+
+        调度器的acquire会阻塞，在线程池中等待；先取得信号量使每个事件循环最多只有
+        max_concurrency个线程在排队。
+        """
+        async with self._resources().semaphore:
+            if self.scheduler is None:
+                yield
+                return
+            with self._resources_lock:
+                if self._acquire_executor is None:
+                    self._acquire_executor = ThreadPoolExecutor(
+                        max_workers=self.max_concurrency, thread_name_prefix="llm-acquire")
+            pending = self._acquire_executor.submit(self.scheduler.acquire, self.session_id,
+                                                    self.priority)
+            try:
+                ticket = await asyncio.wrap_future(pending)
+            except asyncio.CancelledError:
+                # 调用方已取消，仍在排队的请求得到名额后立即归还
+                pending.add_done_callback(self._release_granted)
+                raise
+            try:
+                yield
+            finally:
+                self.scheduler.release(ticket)
+
+    def _release_granted(self, pending: Future) -> None:
+        if not pending.cancelled() and pending.exception() is None:
+            self.scheduler.release(pending.result())
+
+    async def _apost(self, url: str, data: Dict[str, Any]) -> "aiohttp.ClientResponse":
+        """
+        异步发送请求，重试策略与DeepSeekAPI._post相同
+
+        Returns:
+            状态码为2xx的响应，调用方负责release
+        """
+        session = self._resources().session
+        attempt = 0
+        while True:
+            try:
+                response = await session.post(url, json=data)
+            except (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+                logger.warning(f"连接API失败，{delay:.1f}秒后重试 ({attempt + 1}/{self.max_retries}): {e}")
+            else:
+                if response.status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    if response.status >= 400:
+                        response.release()
+                    response.raise_for_status()
+                    return response
+                delay = self._backoff_delay(attempt, response)
+                logger.warning(f"API返回{response.status}，{delay:.1f}秒后重试 "
+                               f"({attempt + 1}/{self.max_retries})")
+                response.release()
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def achat(self,
+                    messages: List[Dict[str, str]],
+                    model: str = "deepseek-chat",
+                    temperature: float = 0.7,
+                    max_tokens: int = 1024,
+                    stream: bool = False,
+                    cache_token: Optional[str] = None,
+                    cache_messages: Optional[List[Dict[str, Any]]] = None,
+                    **kwargs) -> Union[Dict[str, Any], AsyncGenerator[Dict[str, Any], None]]:
+        """
+        异步发送对话请求，参数、缓存和调度与DeepSeekAPI.chat相同（不支持排队位置回调）
+
+        Returns:
+            如果stream=False，返回完整的响应字典
+            如果stream=True，返回异步响应生成器
+        """
+        url = f"{self.base_url}/chat/completions"
+        data = self._build_payload(messages, model, temperature, max_tokens, stream, **kwargs)
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(cache_messages or messages, model, temperature,
+                                        max_tokens, cache_token, **kwargs)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info("命中响应缓存")
+                return self._areplay_stream(cached) if stream else cached
+
+        if stream:
+            return self.astream(url, data, cache_key)
+
+        async with self._aslot():
+            try:
+                response = await self._apost(url, data)
+                try:
+                    result = await response.json()
+                finally:
+                    response.release()
+            except Exception as e:
+                logger.error(f"请求API时出错: {str(e)}")
+                raise
+        if cache_key is not None and self._cacheable(result):
+            self.cache.put(cache_key, result)
+        return result
+
+    async def _areplay_stream(self, response: Dict[str, Any]
+                              ) -> AsyncGenerator[Dict[str, Any], None]:
+        """异步版本的_replay_stream"""
+        for chunk in self._replay_stream(response):
+            yield chunk
+
+    async def astream(self, url: str, data: Dict[str, Any], cache_key: Optional[str] = None
+                      ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        处理异步流式响应，读取结束前一直占用并发名额
+
+        Args:
+            url: API URL
+            data: 请求数据
+            cache_key: 提供时在流完整结束后把拼接好的回复写入缓存
+
+        Returns:
+            异步响应生成器，每个元素与DeepSeekAPI流式输出的块相同
+        """
+        parts = {"reasoning_content": [], "content": []}
+        async with self._aslot():
+            try:
+                response = await self._apost(url, data)
+                try:
+                    async for raw_line in response.content:
+                        line = raw_line.decode('utf-8').strip()
+                        if not line.startswith('data: '):
+                            continue
                         if line == 'data: [DONE]':
                             break
                         try:
-                            # 去掉'data: '前缀并解析JSON
-                            chunk = line[6:]
-                            yield json.loads(chunk)
+                            chunk = json.loads(line[6:])
                         except json.JSONDecodeError:
                             continue
+                        if cache_key is not None:
+                            delta = (chunk.get('choices') or [{}])[0].get('delta') or {}
+                            for key, texts in parts.items():
+                                if delta.get(key):
+                                    texts.append(delta[key])
+                            # 缓存只保存文本回复，包含工具调用的回复不缓存
+                            if delta.get('tool_calls'):
+                                cache_key = None
+                        yield chunk
+                finally:
+                    response.release()
+            except Exception as e:
+                logger.error(f"处理流式响应时出错: {str(e)}")
+                raise
+
+        if cache_key is not None and parts["content"]:
+            message = {"role": "assistant", **{key: "".join(texts) for key, texts in parts.items()}}
+            self.cache.put(cache_key, {"choices": [{"index": 0, "message": message}]})
+
+
+def load_model_tiers(overrides: Optional[Dict[str, Dict[str, Any]]] = None
+                     ) -> Dict[str, Dict[str, Any]]:
+    """
+    合并默认的模型分级、环境变量DEEPSEEK_MODEL_TIERS和overrides中的配置
+
+    Args:
+        overrides: 按级别覆盖的配置，如{"fast": {"max_tokens": 2000}}
+
+    Returns:
+        级别名称到{"model", "max_tokens", "temperature"}的映射
+    """
+    tiers = {name: dict(settings) for name, settings in MODEL_TIERS.items()}
+    layers = []
+    if os.environ.get("DEEPSEEK_MODEL_TIERS"):
+        try:
+            layers.append(json.loads(os.environ["DEEPSEEK_MODEL_TIERS"]))
+        except json.JSONDecodeError as e:
+            logger.warning(f"无法解析DEEPSEEK_MODEL_TIERS: {e}")
+    layers.append(overrides or {})
+    for layer in layers:
+        for name, settings in layer.items():
+            tiers.setdefault(name, dict(MODEL_TIERS[DEFAULT_MODEL_TIER])).update(settings)
+    return tiers
+
+
+def tool_schema(tool) -> Dict[str, Any]:
+    """
+    根据工具函数的签名生成OpenAI兼容的工具定义
+
+    Args:
+        tool: 带有name、description和func属性的工具对象
+
+    Returns:
+        {"type": "function", "function": {...}}格式的工具定义
+    """
+    properties = {}
+    required = []
+    for name, param in inspect.signature(tool.func).parameters.items():
+        if name in _INTERNAL_TOOL_PARAMS or param.kind in (param.VAR_POSITIONAL,
+                                                           param.VAR_KEYWORD):
+            continue
+        # Optional[X]、List[X]等泛型取其原始类型
+        annotation = param.annotation
+        args = [arg for arg in getattr(annotation, "__args__", ()) if arg is not type(None)]
+        origin = getattr(annotation, "__origin__", None)
+        if origin is Union and args:
+            annotation = getattr(args[0], "__origin__", None) or args[0]
+        elif origin is not None:
+            annotation = origin
+        properties[name] = {"type": _JSON_SCHEMA_TYPES.get(annotation, "string")}
+        if properties[name]["type"] == "array":
+            properties[name]["items"] = {"type": "string"}
+        if param.default is param.empty:
+            required.append(name)
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description,
+            "parameters": {"type": "object", "properties": properties, "required": required},
+        },
+    }
+
+
+def _tool_result_text(result: Any) -> str:
+    """把工具返回值转换为写入对话的文本，表格只保留最近的行，过长时截断"""
+    if hasattr(result, "tail") and hasattr(result, "to_json"):
+        text = result.tail(MAX_TOOL_RESULT_ROWS).to_json(orient="split", date_format="iso")
+    elif isinstance(result, str):
+        text = result
+    else:
+        text = json.dumps(result, ensure_ascii=False, default=str)
+    if len(text) > MAX_TOOL_RESULT_CHARS:
+        text = text[:MAX_TOOL_RESULT_CHARS] + "...(已截断)"
+    return text
+
+
+class ToolRunner:
+    """
+    执行模型请求的工具调用
+
+    同一轮的多个工具调用在线程池中并发执行；同一次运行中相同工具和参数的调用只执行一次，
+    并发的重复调用等待同一个结果。
+    """
+
+    def __init__(self, tools: List[Any], max_workers: int = DEFAULT_TOOL_WORKERS):
+        """
+        初始化工具执行器
+
+        Args:
+            tools: 带有name、description和func属性的工具对象列表
+            max_workers: 并发执行的工具数上限
+        """
+        self.tools = {tool.name: tool for tool in tools}
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._results: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "ToolRunner":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """关闭线程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def schemas(self) -> List[Dict[str, Any]]:
+        """返回全部工具的定义，用作请求的tools参数"""
+        return [tool_schema(tool) for tool in self.tools.values()]
+
+    def _invoke(self, name: str, arguments: Dict[str, Any]) -> str:
+        tool = self.tools.get(name)
+        if tool is None:
+            return json.dumps({"error": f"未知的工具: {name}"}, ensure_ascii=False)
+        try:
+            return _tool_result_text(tool.func(**arguments))
         except Exception as e:
-            logger.error(f"处理流式响应时出错: {str(e)}")
-            raise
+            logger.warning(f"执行工具{name}时出错: {e}")
+            return json.dumps({"error": f"执行工具{name}时出错: {str(e)}"}, ensure_ascii=False)
+
+    def _submit(self, name: str, raw_arguments: str) -> Future:
+        """提交一次工具调用，相同工具和参数复用已有结果"""
+        try:
+            arguments = json.loads(raw_arguments or "{}")
+        except json.JSONDecodeError:
+            future = Future()
+            future.set_result(json.dumps({"error": "工具参数不是合法的JSON"}, ensure_ascii=False))
+            return future
+
+        key = json.dumps([name, arguments], sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            future = self._results.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+                future = self._executor.submit(self._invoke, name, arguments)
+                self._results[key] = future
+            return future
+
+    def run(self, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """
+        并发执行一轮工具调用
+
+        Args:
+            tool_calls: 助手消息中的tool_calls列表
+
+        Returns:
+            与调用顺序一致的tool角色消息列表
+        """
+        futures = [
+            (call["id"], self._submit(call["function"]["name"], call["function"].get("arguments")))
+            for call in tool_calls
+        ]
+        return [
+            {"role": "tool", "tool_call_id": call_id, "content": future.result()}
+            for call_id, future in futures
+        ]
 
 
 class Agent:
     """
     兼容crewai的Agent类接口的简化版本
     """
-    def __init__(self, role, goal, backstory, verbose=True, allow_delegation=False, tools=None):
+    def __init__(self, role, goal, backstory, verbose=True, allow_delegation=False, tools=None,
+                 tier=None):
         self.role = role
         self.goal = goal
         self.backstory = backstory
         self.verbose = verbose
         self.allow_delegation = allow_delegation
         self.tools = tools or []
+        # 模型级别，对应MODEL_TIERS中的名称，未设置时使用默认级别
+        self.tier = tier
 
 
 class Task:
     """
     兼容crewai的Task类接口的简化版本
     """
-    def __init__(self, description, agent, expected_output, context=None):
+    def __init__(self, description, agent, expected_output, context=None, tier=None,
+                 cache_key=None):
         self.description = description
         self.agent = agent
         self.expected_output = expected_output
         self.context = context or []
+        self.output = None
+        # 模型级别，优先于智能体的设置
+        self.tier = tier
+        # 计算响应缓存键时代替description的文本；description包含在cache_token有效期内
+        # 不断变化的数据（如实时行情）时设置，使同一数据日期内的相同任务可以命中缓存
+        self.cache_key = cache_key
 
 
 class Process:
     """
     兼容crewai的Process类接口的简化版本
+
+    sequential按顺序逐个执行，未指定context的任务以上一个任务的结果为上下文；
+    parallel按context构建依赖图，依赖已完成的任务并发执行。
     """
     sequential = "sequential"
+    parallel = "parallel"
 
 
 class Crew:
     """
     兼容crewai的Crew类接口的简化版本
     """
-    def __init__(self, agents, tasks, verbose=2, process=Process.sequential):
+    def __init__(self, agents, tasks, verbose=2, process=Process.sequential, cache=None,
+                 cache_token=None, max_parallel_tasks=DEFAULT_MAX_PARALLEL_TASKS,
+                 model_tiers=None, scheduler=None, session_id="default",
+                 priority=LLMScheduler.INTERACTIVE):
         self.agents = agents
         self.tasks = tasks
         self.verbose = verbose
         self.process = process
-        self.deepseek_api = DeepSeekAPI()
+        # cache为可选的ResponseCache，cache_token为数据新鲜度标记，数据更新后缓存自动失效
+        self.cache_token = cache_token
+        self.max_parallel_tasks = max_parallel_tasks
+        # scheduler为可选的LLMScheduler，多个会话共用时按会话公平分配API请求名额
+        self.deepseek_api = DeepSeekAPI(cache=cache, scheduler=scheduler,
+                                        session_id=session_id, priority=priority)
+        # model_tiers按级别覆盖默认的模型分级配置
+        self.model_tiers = load_model_tiers(model_tiers)
+        for task in tasks:
+            tier_model = self.model_tiers[self._task_tier(task)]["model"]
+            if task.agent.tools and tier_model == "deepseek-reasoner":
+                logger.warning(f"{task.agent.role}配置了工具，deepseek-reasoner不支持Function "
+                               f"Calling，该任务改用{TOOL_CALLING_MODEL}")
+        # 最近一次运行的令牌统计，以及按模型级别统计的调用次数、耗时和令牌用量
+        self.usage_metrics: Dict[str, int] = {}
+        self.tier_metrics: Dict[str, Dict[str, float]] = {}
+        self._usage_lock = threading.Lock()
     
-    def kickoff(self):
-        """
-        执行任务
-        """
-        # 创建系统消息
+    def _system_content(self, agents: List[Agent]) -> str:
+        """构建包含指定智能体信息的系统消息"""
         system_content = f"你是一个多智能体系统。\n\n"
         
-        # 添加第一个智能体信息
-        analyst = self.agents[0]
-        system_content += f"智能体角色：{analyst.role}\n"
-        system_content += f"目标：{analyst.goal}\n"
-        system_content += f"背景：{analyst.backstory}\n\n"
+        for agent in agents:
+            system_content += f"智能体角色：{agent.role}\n"
+            system_content += f"目标：{agent.goal}\n"
+            system_content += f"背景：{agent.backstory}\n\n"
         
-        # 添加第二个智能体信息
-        if len(self.agents) > 1:
-            writer = self.agents[1]
-            system_content += f"智能体角色：{writer.role}\n"
-            system_content += f"目标：{writer.goal}\n"
-            system_content += f"背景：{writer.backstory}\n\n"
-        
-        # 添加第一个任务
-        first_task = self.tasks[0]
-        user_content = f"请执行以下任务：\n{first_task.description}"
+        return system_content
+    
+    def _task_messages(self, system_content: str, task: Task,
+                       context: Optional[List[Tuple[str, str]]] = None,
+                       description: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        构建任务的对话消息，context为上游任务的(智能体角色, 结果)列表，
+        description用于代替任务描述（如计算缓存键时使用task.cache_key）
+        """
+        description = task.description if description is None else description
+        if not context:
+            user_content = f"请执行以下任务：\n{description}"
+        else:
+            # 将上游任务的结果作为上下文，多个上游任务时标注来源
+            if len(context) == 1:
+                results = context[0][1]
+            else:
+                results = "\n\n".join(f"【{role}】\n{result}" for role, result in context)
+            user_content = f"基于以下分析结果：\n\n{results}\n\n请执行以下任务：\n{description}"
         
-        messages = [
+        return [
             {"role": "system", "content": system_content},
             {"role": "user", "content": user_content}
         ]
+    
+    def _dependencies(self) -> List[List[int]]:
+        """
+        根据Task.context和执行流程构建依赖图
         
-        # 调用DeepSeek API
-        response = self.deepseek_api.chat(
-            messages=messages,
-            model="deepseek-reasoner",  # 使用DeepSeek-R1模型，它更适合复杂推理任务
-            temperature=0.7,
-            max_tokens=4000,
-            stream=False
+        Returns:
+            每个任务依赖的上游任务序号列表
+        """
+        positions = {id(task): index for index, task in enumerate(self.tasks)}
+        dependencies = []
+        for index, task in enumerate(self.tasks):
+            if task.context:
+                if any(id(upstream) not in positions for upstream in task.context):
+                    raise ValueError(f"任务{index}的context包含不属于该Crew的任务")
+                dependencies.append([positions[id(upstream)] for upstream in task.context])
+            elif self.process == Process.sequential and index > 0:
+                dependencies.append([index - 1])
+            else:
+                dependencies.append([])
+        
+        # 检查循环依赖
+        done = set()
+        while len(done) < len(dependencies):
+            ready = {index for index, upstream in enumerate(dependencies)
+                     if index not in done and all(d in done for d in upstream)}
+            if not ready:
+                raise ValueError("任务的context存在循环依赖")
+            done |= ready
+        return dependencies
+    
+    def _execute(self, run: Callable[[int, List[int]], str]) -> List[str]:
+        """
+        按依赖图调度任务，依赖全部完成的任务提交到线程池执行
+        
+        Args:
+            run: 执行单个任务的函数，参数为任务序号和上游任务序号列表，返回任务结果
+            
+        Returns:
+            与self.tasks顺序一致的任务结果
+        """
+        dependencies = self._dependencies()
+        workers = 1 if self.process == Process.sequential else self.max_parallel_tasks
+        results: Dict[int, str] = {}
+        remaining = set(range(len(self.tasks)))
+        
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending: Dict[Future, int] = {}
+            while remaining or pending:
+                for index in sorted(remaining):
+                    if all(upstream in results for upstream in dependencies[index]):
+                        remaining.discard(index)
+                        future = executor.submit(run, index, dependencies[index])
+                        pending[future] = index
+                
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index = pending.pop(future)
+                    results[index] = future.result()
+                    self.tasks[index].output = results[index]
+        
+        return [results[index] for index in range(len(self.tasks))]
+    
+    def _context(self, upstream: List[int]) -> List[Tuple[str, str]]:
+        """上游任务的(智能体角色, 结果)列表"""
+        return [(self.tasks[index].agent.role, self.tasks[index].output) for index in upstream]
+    
+    def _prepare_messages(self, task: Task, upstream: List[int]
+                          ) -> Tuple[List[Dict[str, str]], Optional[List[Dict[str, str]]]]:
+        """
+        构建任务消息：系统消息只包含执行该任务的智能体，上游结果压缩到下游模型的令牌预算以内
+        
+        与发送全部智能体信息和完整上游结果相比节省的令牌数计入usage_metrics。
+        
+        Returns:
+            (发送的消息, 计算缓存键的消息)；任务没有设置cache_key时后者为None
+        """
+        context = self._context(upstream)
+        budget = context_budget(self._task_model(task)) // max(len(context), 1)
+        compacted = [(role, compact_text(result, budget)[0]) for role, result in context]
+        system_content = self._system_content([task.agent])
+        messages = self._task_messages(system_content, task, compacted)
+        cache_messages = None
+        if task.cache_key is not None:
+            cache_messages = self._task_messages(system_content, task, compacted, task.cache_key)
+        
+        full = estimate_message_tokens(
+            self._task_messages(self._system_content(self.agents), task, context)
         )
+        sent = estimate_message_tokens(messages)
+        self._record_usage(self._task_tier(task), estimated_prompt_tokens=sent,
+                           context_tokens_saved=full - sent)
+        return messages, cache_messages
+    
+    def _record_usage(self, tier: str, usage: Optional[Dict[str, Any]] = None,
+                      **values: float) -> None:
+        """累加API返回的令牌用量和其他统计值，同时计入运行总计和对应的模型级别"""
+        values.update({key: usage[key] for key in ("prompt_tokens", "completion_tokens")
+                       if usage and usage.get(key)})
+        with self._usage_lock:
+            tier_metrics = self.tier_metrics.setdefault(tier, {})
+            for key, value in values.items():
+                tier_metrics[key] = tier_metrics.get(key, 0) + value
+                if key not in ("calls", "seconds"):
+                    self.usage_metrics[key] = self.usage_metrics.get(key, 0) + value
+    
+    def _reset_usage(self) -> None:
+        self.usage_metrics = {}
+        self.tier_metrics = {}
+    
+    def _log_usage(self) -> None:
+        logger.info(f"本次运行令牌统计: {self.usage_metrics}，"
+                    f"上下文压缩约节省{self.usage_metrics.get('context_tokens_saved', 0)}个令牌")
+        for tier, metrics in self.tier_metrics.items():
+            logger.info(f"模型级别{tier}: 调用{metrics.get('calls', 0):.0f}次，"
+                        f"耗时{metrics.get('seconds', 0):.1f}秒，令牌用量{metrics}")
+    
+    def _task_tier(self, task: Task) -> str:
+        """任务的模型级别：任务设置优先，其次是智能体设置，最后是默认级别"""
+        tier = task.tier or task.agent.tier or DEFAULT_MODEL_TIER
+        if tier not in self.model_tiers:
+            raise ValueError(f"未知的模型级别: {tier}")
+        return tier
+    
+    def _task_settings(self, task: Task) -> Dict[str, Any]:
+        """
+        任务使用的模型、最大生成令牌数和温度
         
-        # 提取回复内容
-        first_result = response['choices'][0]['message']['content']
+        deepseek-reasoner不支持Function Calling，带工具的智能体改用TOOL_CALLING_MODEL，
+        创建Crew时会记录警告；需要推理模型的任务应预取数据写入任务描述，而不是给智能体配置工具。
+        """
+        settings = dict(self.model_tiers[self._task_tier(task)])
+        if task.agent.tools and settings["model"] == "deepseek-reasoner":
+            settings["model"] = TOOL_CALLING_MODEL
+        return settings
+    
+    def _task_model(self, task: Task) -> str:
+        return self._task_settings(task)["model"]
+    
+    def _run_task(self, messages: List[Dict[str, str]], task: Task,
+                  runner: Optional[ToolRunner], stream: bool = False,
+                  on_wait: Optional[Callable[[int, float], None]] = None,
+                  cache_messages: Optional[List[Dict[str, str]]] = None):
+        """执行单个任务，按模型级别选择模型，智能体带工具时进入工具调用循环"""
+        options = dict(self._task_settings(task), stream=stream, cache_token=self.cache_token,
+                       on_wait=on_wait, cache_messages=cache_messages)
+        if runner is not None:
+            return self.deepseek_api.chat_with_tools(messages, runner, **options)
+        return self.deepseek_api.chat(messages=messages, **options)
+    
+    def _runners(self) -> Dict[int, ToolRunner]:
+        """为本次运行中每个带工具的智能体创建工具执行器，工具结果在本次运行内复用"""
+        return {
+            id(task.agent): ToolRunner(task.agent.tools)
+            for task in self.tasks if task.agent.tools
+        }
+    
+    def kickoff(self):
+        """
+        执行任务，返回最后一个任务的结果
+        """
+        runners = self._runners()
+        self._reset_usage()
+        
+        def run(index: int, upstream: List[int]) -> str:
+            task = self.tasks[index]
+            started = time.perf_counter()
+            messages, cache_messages = self._prepare_messages(task, upstream)
+            response = self._run_task(messages, task, runners.get(id(task.agent)),
+                                      cache_messages=cache_messages)
+            self._record_usage(self._task_tier(task), response.get('usage'), calls=1,
+                               seconds=time.perf_counter() - started)
+            return response['choices'][0]['message']['content']
+        
+        try:
+            result = self._execute(run)[-1]
+            self._log_usage()
+            return result
+        finally:
+            for runner in runners.values():
+                runner.close()
+    
+    def kickoff_stream(self) -> Generator[Dict[str, Any], None, None]:
+        """
+        流式执行任务，边生成边返回增量内容；并行流程中不同任务的事件交错产生
+        
+        Returns:
+            事件生成器，每个事件为字典：
+            {"task": 任务序号, "agent": 智能体角色, "final": 是否为最后一个任务,
+             "type": 事件类型, "text": 文本}
+            type为"reasoning"（deepseek-reasoner的思考过程增量）、"content"（回复内容增量）、
+            "tool"（一轮工具调用执行完成，text为调用的工具列表）、
+            "queued"（配置了调度器时等待API请求名额，另有position和wait字段，
+            分别为前面的请求数和估算的等待秒数）
+            或"task_complete"（任务完成，text为该任务的完整结果）。
+            最后一个任务的content拼接起来即为最终报告。
+        """
+        runners = self._runners()
+        self._reset_usage()
+        events: "queue.Queue" = queue.Queue()
+        cancelled = threading.Event()
+        finished = object()
+        last = len(self.tasks) - 1
         
-        # 如果有第二个任务（报告任务）
-        if len(self.tasks) > 1:
-            second_task = self.tasks[1]
+        def run(index: int, upstream: List[int]) -> str:
+            task = self.tasks[index]
+            started = time.perf_counter()
+            messages, cache_messages = self._prepare_messages(task, upstream)
+            header = {"task": index, "agent": task.agent.role, "final": index == last}
             
-            # 将第一个任务的结果作为上下文
-            user_content = f"基于以下分析结果：\n\n{first_result}\n\n请执行以下任务：\n{second_task.description}"
+            def on_wait(position: int, wait: float) -> None:
+                events.put({**header, "type": "queued", "position": position, "wait": wait,
+                            "text": f"排队中，前面还有{position}个请求"})
             
-            messages = [
-                {"role": "system", "content": system_content},
-                {"role": "user", "content": user_content}
-            ]
+            stream = self._run_task(messages, task, runners.get(id(task.agent)), stream=True,
+                                    on_wait=on_wait, cache_messages=cache_messages)
             
-            # 调用DeepSeek API
-            response = self.deepseek_api.chat(
-                messages=messages,
-                model="deepseek-reasoner",
-                temperature=0.7,
-                max_tokens=4000,
-                stream=False
-            )
+            usage = None
+            content = []
+            for chunk in stream:
+                if cancelled.is_set():
+                    break
+                if "tool_calls" in chunk:
+                    # 工具调用前模型输出的过渡文本不计入任务结果
+                    content = []
+                    names = ", ".join(call["function"]["name"] for call in chunk["tool_calls"])
+                    events.put({**header, "type": "tool", "text": names})
+                    continue
+                # 流式响应的用量在最后一个块中返回
+                usage = chunk.get('usage') or usage
+                choices = chunk.get('choices') or [{}]
+                delta = choices[0].get('delta') or {}
+                for event_type, key in (("reasoning", "reasoning_content"), ("content", "content")):
+                    text = delta.get(key)
+                    if text:
+                        if event_type == "content":
+                            content.append(text)
+                        events.put({**header, "type": event_type, "text": text})
             
-            # 返回最终结果
-            return response['choices'][0]['message']['content']
+            result = "".join(content)
+            self._record_usage(self._task_tier(task), usage, calls=1,
+                               seconds=time.perf_counter() - started)
+            events.put({**header, "type": "task_complete", "text": result})
+            return result
+        
+        def schedule() -> None:
+            try:
+                self._execute(run)
+                self._log_usage()
+            except Exception as e:
+                events.put(e)
+            finally:
+                events.put(finished)
         
-        return first_result
+        worker = threading.Thread(target=schedule, daemon=True)
+        worker.start()
+        try:
+            while True:
+                event = events.get()
+                if event is finished:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            # 调用方提前结束迭代时通知正在执行的任务停止读取
+            cancelled.set()
+            for runner in runners.values():
+                runner.close()
 
-import json
 
 # 添加与OpenAI兼容的接口
 class OpenAI:
@@ -235,6 +1470,7 @@ class ChatCompletions:
         self.api_key = api_key
         self.base_url = base_url
         self.deepseek_api = DeepSeekAPI(api_key, base_url)
+        self._async_api = None
     
     def create(self, model="deepseek-chat", messages=None, stream=False, **kwargs):
         """
@@ -255,4 +1491,21 @@ class ChatCompletions:
             messages=messages,
             stream=stream,
             **kwargs
-        ) 
\ No newline at end of file
+        )
+
+    async def acreate(self, model="deepseek-chat", messages=None, stream=False, **kwargs):
+        """
+        异步创建聊天完成，参数与create相同
+
+        Returns:
+            如果stream=False，返回完整响应
+            如果stream=True，返回异步流式响应生成器
+        """
+        if self._async_api is None:
+            self._async_api = AsyncDeepSeekAPI(self.api_key, self.base_url)
+        return await self._async_api.achat(
+            model=model,
+            messages=messages,
+            stream=stream,
+            **kwargs
+        )
@@ -1,14 +1,27 @@
 import streamlit as st
 import os
 import json
+import time
+from datetime import date, datetime
 from dotenv import load_dotenv
 # 导入新的DeepSeek API模块中的类
-from deepseek_api import Agent, Task, Crew, Process, OpenAI
-from financial_tools import get_stock_tools
+from deepseek_api import (Agent, Task, Crew, Process, OpenAI, QueueFullError,
+                          get_default_scheduler, load_model_tiers)
+from caching import SingleFlight, get_default_response_cache
+from financial_tools import prefetch_analysis_data, to_compact_json
+from ohlcv_store import get_default_store
+from report_renderer import NARRATIVE_SECTIONS, render_report
+from report_store import get_default_report_store
 
 # 加载环境变量
 load_dotenv()
 
+# 合并多个会话对同一股票、同一数据日期的并发分析，只执行一次并共享报告
+ANALYSIS_FLIGHTS = SingleFlight()
+
+# 提示词版本，修改智能体或任务的提示词后递增，已保存的旧版本报告不再复用
+PROMPT_VERSION = "1"
+
 # 配置DeepSeek
 def setup_deepseek():
     # 尝试从 Streamlit Secrets 获取 API 密钥
@@ -27,6 +40,15 @@ def setup_deepseek():
         st.error("未找到DeepSeek API密钥。请在Streamlit Cloud中设置Secrets或在本地设置环境变量。")
         return False
 
+# 当前Streamlit会话的标识，调度器按会话轮转分配API请求名额；不在Streamlit中运行时共用默认标识
+def current_session_id():
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+    except Exception:
+        ctx = None
+    return ctx.session_id if ctx is not None else "default"
+
 # 定义分析师智能体
 def create_stock_analyst_agent():
     return Agent(
@@ -36,7 +58,8 @@ def create_stock_analyst_agent():
         行业趋势和技术指标。你综合多种因素做出准确的投资建议，并以客观中立的态度提供分析。""",
         verbose=True,
         allow_delegation=False,
-        tools=get_stock_tools()
+        # 分析所需的数据已预取并写入任务描述，不配置工具，分析任务才能使用推理模型
+        tier="reasoning"
     )
 
 # 定义报告编写智能体
@@ -48,15 +71,16 @@ def create_report_writer_agent():
         你擅长将复杂的财务和技术数据转化为清晰、结构化的内容，并能突出关键投资要点。
         你的报告简明扼要，重点突出，格式规范，便于投资者快速把握要点。""",
         verbose=True,
-        allow_delegation=False
+        allow_delegation=False,
+        # 报告撰写以整理和格式化为主，不需要推理模型
+        tier="fast"
     )
 
-# 创建分析任务
-def create_analysis_task(agent, ticker_symbol):
-    return Task(
-        description=f"""
+# 创建分析任务，data为预取的股票数据
+def create_analysis_task(agent, ticker_symbol, data=None):
+    description = f"""
         对{ticker_symbol}股票进行全面深入的分析，你需要:
-        1. 获取并分析公司基本信息（行业、市值、主营业务等）
+        1. 分析公司基本信息（行业、市值、主营业务等）
         2. 分析最新财务数据（收入、利润、现金流等）
         3. 分析技术指标（均线、RSI、MACD等）
         4. 评估市场情绪和新闻影响
@@ -64,63 +88,237 @@ def create_analysis_task(agent, ticker_symbol):
         6. 综合上述因素，给出明确的投资建议（买入/持有/卖出）
         
         分析中应包含量化数据和定性判断，确保全面客观。
-        """,
+        """
+    cache_key = None
+    if data is not None:
+        # 数据中的实时行情每次请求都不同，缓存键只包含任务模板和各数据项的获取结果，
+        # 数据的新鲜度由Crew的cache_token（最后一根K线的交易日）区分
+        failed = sorted(name for name, value in data.items()
+                        if isinstance(value, dict) and "error" in value)
+        cache_key = f"{description}\n数据项：{sorted(data)}\n获取失败：{failed}"
+        description += f"""
+        以下是已获取的{ticker_symbol}数据（JSON格式），请直接基于这些数据进行分析，不要编造数据；
+        包含error字段的数据项表示获取失败：
+        {to_compact_json(data)}
+        """
+    return Task(
+        description=description,
         agent=agent,
-        expected_output=f"关于{ticker_symbol}的全面分析结果，包含基本面和技术面数据以及综合评估"
+        expected_output=f"关于{ticker_symbol}的全面分析结果，包含基本面和技术面数据以及综合评估",
+        cache_key=cache_key
     )
 
-# 创建报告任务
+# 创建报告任务：只撰写文字部分，标题和数据表格由report_renderer根据数据生成
 def create_report_task(agent, ticker_symbol):
+    sections = "\n".join(f"        ## {name}\n        {requirement}"
+                          for name, requirement in NARRATIVE_SECTIONS.items())
     return Task(
         description=f"""
-        基于股票分析师提供的{ticker_symbol}分析结果，撰写一份专业的投资报告。报告应包含：
+        基于股票分析师提供的{ticker_symbol}分析结果，撰写投资报告的文字部分。
+        报告标题、公司概况、财务数据表、技术指标表和同业比较表会由系统根据数据自动生成，
+        不要输出标题，也不要重复列出这些数据和表格。
         
-        1. 报告标题：包含公司名称、当前股价和投资建议
-        2. 公司概况：简介公司背景、行业和主要业务
-        3. 投资要点：突出3-5个关键投资理由或风险因素
-        4. 财务分析：解读关键财务指标及趋势
-        5. 技术分析：解读价格走势和技术指标
-        6. 风险因素：列出潜在风险和不确定性
-        7. 投资建议：给出明确的买入/持有/卖出建议，并注明目标价位
-        
-        报告格式必须使用Markdown格式，便于在网页中显示。确保报告结构清晰、重点突出，便于快速阅读。
+        请严格按以下二级标题顺序输出Markdown，每部分简明扼要、重点突出：
+{sections}
         """,
         agent=agent,
-        expected_output=f"一份关于{ticker_symbol}的专业投资报告，采用Markdown格式"
+        expected_output=f"关于{ticker_symbol}的投资报告文字部分，按指定的二级标题组织，采用Markdown格式"
     )
 
-# 分析股票并生成报告
-def analyze_stock(ticker_symbol):
+# 数据新鲜度标记：本地最后一根K线在交易所时区的交易日，没有本地数据时取当天日期；
+# 本地数据超过刷新间隔时先增量同步，避免在新交易日读到上一交易日的报告和缓存
+def data_freshness_token(ticker_symbol):
+    return get_default_store().current_trading_day(ticker_symbol) or date.today().isoformat()
+
+# 创建分析团队，data为prefetch_analysis_data预取的数据，session_id为发起分析的会话，
+# regenerate为True时不使用响应缓存，重新调用LLM
+def create_crew(ticker_symbol, data=None, session_id="default", regenerate=False):
+    # 创建智能体
+    analyst = create_stock_analyst_agent()
+    writer = create_report_writer_agent()
+    
+    # 预取的数据写入分析任务的提示词
+    analysis_task = create_analysis_task(analyst, ticker_symbol, data)
+    report_task = create_report_task(writer, ticker_symbol)
+    
+    # 设置任务依赖关系
+    report_task.context = [analysis_task]
+    
+    # 创建多智能体团队
+    return Crew(
+        agents=[analyst, writer],
+        tasks=[analysis_task, report_task],
+        verbose=2,
+        process=Process.sequential,
+        # 同一天对同一股票的分析直接复用缓存的回复
+        cache=None if regenerate else get_default_response_cache(),
+        cache_token=data_freshness_token(ticker_symbol),
+        # 所有会话共用进程内的调度器，限制同时进行的API请求数并在会话间公平排队
+        scheduler=get_default_scheduler(),
+        session_id=session_id
+    )
+
+# 合并并发分析的键：股票代码、数据日期和是否重新生成，重新生成的请求不与普通请求合并
+def analysis_key(ticker_symbol, regenerate=False):
+    return (ticker_symbol.upper(), data_freshness_token(ticker_symbol), regenerate)
+
+# 报告库的键：股票代码、数据日期、各级别使用的模型和提示词版本
+def report_key(ticker_symbol):
+    models = "+".join(sorted({tier["model"] for tier in load_model_tiers().values()}))
+    return (ticker_symbol.upper(), data_freshness_token(ticker_symbol), models, PROMPT_VERSION)
+
+# 读取同一交易日内已生成的报告，没有或已过期时返回None
+def load_stored_report(ticker_symbol):
+    try:
+        return get_default_report_store().get(*report_key(ticker_symbol))
+    except Exception as e:
+        print(f"读取已保存的报告失败: {str(e)}")
+        return None
+
+# 保存生成的报告，保存失败不影响本次分析结果
+def save_report(ticker_symbol, report):
     try:
+        get_default_report_store().put(*report_key(ticker_symbol), report)
+    except Exception as e:
+        print(f"保存报告失败: {str(e)}")
+
+# 执行完整的分析流程：并发预取数据，LLM只撰写文字部分，再与本地生成的数据表格合并
+def run_analysis(ticker_symbol, session_id="default", regenerate=False):
+    data = prefetch_analysis_data(ticker_symbol)
+    narrative = create_crew(ticker_symbol, data, session_id, regenerate).kickoff()
+    report = render_report(ticker_symbol, data, narrative)
+    save_report(ticker_symbol, report)
+    return report
+
+# 分析股票并生成报告，regenerate为True时忽略已保存的报告
+def analyze_stock(ticker_symbol, regenerate=False):
+    try:
+        # 同一交易日内已生成的报告直接返回
+        stored = None if regenerate else load_stored_report(ticker_symbol)
+        if stored is not None:
+            return stored["report"]
+        
         # 确保 DeepSeek 配置完成
         if not setup_deepseek():
             return "API密钥配置错误，无法进行分析"
-            
-        # 创建智能体
-        analyst = create_stock_analyst_agent()
-        writer = create_report_writer_agent()
         
-        # 创建任务
-        analysis_task = create_analysis_task(analyst, ticker_symbol)
-        report_task = create_report_task(writer, ticker_symbol)
+        # 同时到达的相同分析请求共享同一次执行的结果
+        session_id = current_session_id()
+        return ANALYSIS_FLIGHTS.do(analysis_key(ticker_symbol, regenerate),
+                                   lambda: run_analysis(ticker_symbol, session_id, regenerate))
+    except QueueFullError as e:
+        return f"服务繁忙: {str(e)}"
+    except Exception as e:
+        return f"分析过程中出错: {str(e)}"
+
+# 流式执行完整的分析流程
+def run_analysis_stream(ticker_symbol, session_id="default", regenerate=False):
+    data = prefetch_analysis_data(ticker_symbol)
+    narrative = ""
+    crew = create_crew(ticker_symbol, data, session_id, regenerate)
+    for event in crew.kickoff_stream():
+        if event.get("final") and event["type"] == "task_complete":
+            narrative = event["text"]
+        yield event
+    report = render_report(ticker_symbol, data, narrative)
+    if narrative:
+        save_report(ticker_symbol, report)
+    yield {"type": "report", "final": True, "text": report}
+
+# 流式分析股票，逐步返回生成的内容
+def analyze_stock_stream(ticker_symbol, regenerate=False):
+    """
+    流式执行分析，事件格式与Crew.kickoff_stream相同；出错时产生type为error的事件，
+    全部任务完成后产生type为report的事件，text为合并了数据表格的完整报告。
+    regenerate为False且同一交易日内已有报告时只产生一个report事件，
+    created_at字段为该报告的生成时间戳
+    """
+    try:
+        stored = None if regenerate else load_stored_report(ticker_symbol)
+        if stored is not None:
+            yield {"type": "report", "final": True, "text": stored["report"],
+                   "created_at": stored["created_at"]}
+            return
         
-        # 设置任务依赖关系
-        report_task.context = [analysis_task]
+        # 确保 DeepSeek 配置完成
+        if not setup_deepseek():
+            yield {"type": "error", "text": "API密钥配置错误，无法进行分析"}
+            return
         
-        # 创建多智能体团队
-        crew = Crew(
-            agents=[analyst, writer],
-            tasks=[analysis_task, report_task],
-            verbose=2,
-            process=Process.sequential
+        # 同时到达的相同分析请求共享同一个事件序列，后到的会话从头重放已生成的内容；
+        # 事件在后台线程中生成，会话标识需要在这里取得
+        session_id = current_session_id()
+        yield from ANALYSIS_FLIGHTS.stream(
+            analysis_key(ticker_symbol, regenerate),
+            lambda: run_analysis_stream(ticker_symbol, session_id, regenerate),
         )
+    except QueueFullError as e:
+        yield {"type": "error", "text": f"服务繁忙: {str(e)}"}
+    except Exception as e:
+        yield {"type": "error", "text": f"分析过程中出错: {str(e)}"}
+
+# 流式渲染分析过程和报告，返回最终报告
+def render_analysis_stream(events, refresh_interval=0.1):
+    status = st.empty()
+    with st.expander("🧠 分析过程", expanded=False):
+        analysis_placeholder = st.empty()
+    st.markdown("## 📝 AI分析报告")
+    report_placeholder = st.empty()
+    
+    # 并行执行的任务事件会交错到达，分析过程按任务分别累积
+    analyses = {}
+    report = ""
+    final_result = ""
+    last_render = 0.0
+    for event in events:
+        event_type = event.get("type")
+        if event_type == "error":
+            final_result = event["text"]
+            st.error(final_result)
+            break
         
-        # 执行分析
-        result = crew.kickoff()
+        # 最后一个任务（报告撰写）的内容作为报告，其余内容显示在分析过程中
+        is_report = event.get("final", False)
+        if not is_report and event.get("task") not in analyses:
+            analyses[event.get("task")] = f"### {event.get('agent', '')}\n\n"
+        if event_type == "reasoning":
+            status.info(f"🤔 {event['agent']}正在思考...")
+            if not is_report:
+                analyses[event["task"]] += event["text"]
+        elif event_type == "content":
+            status.info(f"✍️ {event['agent']}正在输出...")
+            if is_report:
+                report += event["text"]
+            else:
+                analyses[event["task"]] += event["text"]
+        elif event_type == "queued":
+            status.info(f"⏳ {event['agent']}排队中：前面还有{event['position']}个请求，"
+                        f"预计等待约{event['wait']:.0f}秒")
+        elif event_type == "tool":
+            status.info(f"🔧 {event['agent']}正在调用工具...")
+            if not is_report:
+                analyses[event["task"]] += f"\n\n*🔧 已调用工具: {event['text']}*\n\n"
+        elif event_type == "task_complete" and is_report:
+            final_result = event["text"]
+        elif event_type == "report":
+            final_result = event["text"]
+            if "created_at" in event:
+                generated = datetime.fromtimestamp(event["created_at"]).strftime("%H:%M")
+                st.info(f"📁 已显示今天{generated}生成的报告，如需最新分析请勾选“重新生成报告”后再次提交")
         
-        return result
-    except Exception as e:
-        return f"分析过程中出错: {str(e)}"
+        # 限制刷新频率，避免每个token都重绘页面
+        now = time.time()
+        if now - last_render >= refresh_interval:
+            analysis_placeholder.markdown("\n\n---\n\n".join(analyses.values()))
+            report_placeholder.markdown(report)
+            last_render = now
+    
+    status.empty()
+    analysis_placeholder.markdown("\n\n---\n\n".join(analyses.values()))
+    # 最后完成的任务结果即为最终报告
+    report = final_result or report
+    report_placeholder.markdown(report)
+    return report
 
 # 直接运行此文件时显示Streamlit界面
 def main():
@@ -141,20 +339,17 @@ def main():
     # 股票代码输入
     with st.form("stock_form"):
         ticker_symbol = st.text_input("输入股票代码 (例如: AAPL, MSFT)", placeholder="AAPL")
+        regenerate = st.checkbox("重新生成报告", help="默认复用今天已生成的同一股票报告")
         col1, col2 = st.columns([1, 5])
         with col1:
             submit_button = st.form_submit_button("智能分析")
         with col2:
-            st.markdown("*分析过程可能需要30-60秒，请耐心等待*")
+            st.markdown("*分析内容会边生成边显示，完整报告约需30-60秒*")
 
     # 当用户提交股票代码
     if submit_button and ticker_symbol:
-        with st.spinner(f"AI智能体正在分析 {ticker_symbol} 股票..."):
-            report = analyze_stock(ticker_symbol)
-        
-        # 显示报告
-        st.markdown("## 📝 AI分析报告")
-        st.markdown(report)
+        # 边生成边显示分析过程和报告
+        report = render_analysis_stream(analyze_stock_stream(ticker_symbol, regenerate))
         
         # 提供下载选项
         st.download_button(
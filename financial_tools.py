@@ -1,20 +1,446 @@
 import yfinance as yf
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
+import plotly.utils
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
 from crewai import Tool
-from typing import Dict, Any, List, Union
+from typing import Dict, Any, List, Union, Optional, Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+import base64
 import datetime
 import io
+import json
+import os
+import threading
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from caching import LRUCache, SingleFlight, TieredTTLCache, get_default_shared_cache
+from indicators import (DEFAULT_INDICATORS, canonical_name, compute_indicators, lookback_period,
+                        trend_signals)
+from ohlcv_store import OHLCVStore, get_default_store
+
+# 批量下载历史数据时的最大并发数，避免触发数据源限流
+BATCH_MAX_WORKERS = 8
+
+# 分析前预取的数据项及对应的工具方法名，同一只股票的数据项并发获取
+PREFETCH_TOOLS = (
+    ('stock_info', 'get_stock_info'),
+    ('financial_data', 'get_financial_data'),
+    ('technical_indicators', 'calculate_technical_indicators'),
+    ('peer_comparison', 'get_peer_comparison'),
+    ('news_sentiment', 'get_news_sentiment'),
+)
+
+# 写入提示词的浮点数保留的有效数字位数
+PROMPT_FLOAT_DIGITS = 6
+
+# 图表默认宽度（像素）及每根K线至少占用的像素数，用于估算可显示的K线数量
+CHART_WIDTH_PX = 1200
+PX_PER_CANDLE = 4
+
+# 长周期图表从细到粗依次尝试的聚合周期及其显示名称
+LOD_LEVELS = (('W', '周线'), ('M', '月线'), ('Q', '季线'), ('Y', '年线'))
+
+# 图表叠加的技术指标
+CHART_OVERLAYS = ('sma20', 'sma50')
+
+# 渲染结果缓存：内存上限及可选的压缩溢出目录
+CHART_CACHE_BYTES = int(os.environ.get("CHART_CACHE_BYTES", 64 * 1024 * 1024))
+CHART_CACHE = LRUCache(max_bytes=CHART_CACHE_BYTES,
+                       spill_dir=os.environ.get("CHART_CACHE_DIR") or None)
+
+# 合并不同会话对同一股票同一数据的并发下载，如多个用户同时分析同一只股票
+FETCH_FLIGHTS = SingleFlight()
+
+# 各类数据的缓存有效期（秒）：open/closed为交易时段内/外的有效期，stale为过期后仍先返回旧值、
+# 同时在后台刷新的时长。quote为行情（ticker.info），daily_bars为日线历史数据，
+# statements为三张财务报表，profile为公司概况、行业和估值比率等变化很慢的信息
+DATA_CACHE_POLICIES = {
+    'quote': {'open': 60, 'closed': 30 * 60, 'stale': 2 * 60},
+    'daily_bars': {'open': 15 * 60, 'closed': 6 * 60 * 60, 'stale': 60 * 60},
+    'statements': {'open': 24 * 60 * 60, 'closed': 24 * 60 * 60, 'stale': 7 * 24 * 60 * 60},
+    'profile': {'open': 6 * 60 * 60, 'closed': 24 * 60 * 60, 'stale': 7 * 24 * 60 * 60},
+}
+# 同一主机上的多个应用进程通过共享缓存复用已下载的数据，位置由环境变量SHARED_CACHE_PATH设置
+DATA_CACHE = TieredTTLCache(DATA_CACHE_POLICIES, shared=get_default_shared_cache())
+
+# 各交易所的时区和常规交易时段，按股票代码后缀匹配，其他代码按美股处理；不考虑节假日和午休
+MARKET_SESSIONS = {
+    '': ('America/New_York', (9, 30), (16, 0)),
+    '.SS': ('Asia/Shanghai', (9, 30), (15, 0)),
+    '.SZ': ('Asia/Shanghai', (9, 30), (15, 0)),
+    '.HK': ('Asia/Hong_Kong', (9, 30), (16, 0)),
+    '.T': ('Asia/Tokyo', (9, 0), (15, 0)),
+    '.L': ('Europe/London', (8, 0), (16, 30)),
+}
+
+# 精简图表引用plotly.js的方式：cdn使用官方CDN，static使用Streamlit静态文件服务
+PLOTLYJS_SOURCE = os.environ.get("PLOTLYJS_SOURCE", "cdn")
+STATIC_DIR = "static"
+
+
+def plotlyjs_src() -> str:
+    """
+    返回精简图表中plotly.js的引用地址
+
+    使用static时，首次调用会把plotly.js写入static目录，
+    由.streamlit/config.toml中的enableStaticServing提供服务。
+    """
+    version = get_plotlyjs_version()
+    if PLOTLYJS_SOURCE != "static":
+        return f"https://cdn.plot.ly/plotly-{version}.min.js"
+
+    file_name = f"plotly-{version}.min.js"
+    path = os.path.join(STATIC_DIR, file_name)
+    if not os.path.exists(path):
+        os.makedirs(STATIC_DIR, exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+        os.replace(f"{path}.tmp", path)
+    # 使用绝对路径，不在根路径下的页面也能加载
+    return f"/app/static/{file_name}"
+
+
+def _typed_array(values: Any) -> Dict[str, str]:
+    """把数值序列编码为plotly.js的typed array格式（base64），比JSON文本小得多"""
+    if isinstance(values, dict):
+        # 较新版本的plotly已经完成编码
+        return values
+    data = np.ascontiguousarray(np.asarray(values, dtype='<f8'))
+    return {'dtype': 'f8', 'bdata': base64.b64encode(data.tobytes()).decode('ascii')}
+
+
+def figure_to_compact_json(fig: go.Figure) -> str:
+    """
+    把图表序列化为精简的JSON
+
+    日期轴转换为毫秒时间戳，所有数值数组使用base64编码的typed array，
+    需要plotly.js 2.28及以上版本解码。
+
+    Args:
+        fig: Plotly图表
+
+    Returns:
+        包含data和layout的JSON字符串
+    """
+    figure = fig.to_plotly_json()
+    for trace in figure['data']:
+        if 'x' in trace and not isinstance(trace['x'], dict):
+            dates = pd.DatetimeIndex(trace['x'])
+            if dates.tz is not None:
+                dates = dates.tz_localize(None)
+            trace['x'] = _typed_array(np.asarray(dates, dtype='datetime64[ms]').astype('<f8'))
+        for key in ('open', 'high', 'low', 'close', 'y'):
+            if key in trace:
+                trace[key] = _typed_array(trace[key])
+    figure['layout'].setdefault('xaxis', {})['type'] = 'date'
+    return json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder, separators=(',', ':'))
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets降采样，保留折线形状的关键点
+
+    Args:
+        x: 横坐标（单调递增的数值）
+        y: 纵坐标
+        threshold: 保留的点数
+
+    Returns:
+        保留点的下标，首尾两点总是保留
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (threshold - 2)
+    indices = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a])
+                      - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices.append(a)
+    indices.append(n - 1)
+    return np.asarray(indices)
+
+
+def aggregate_ohlcv(df: pd.DataFrame, rule: str) -> pd.DataFrame:
+    """
+    把日K线聚合为周、月、季或年K线
+
+    Args:
+        df: 日K线数据
+        rule: 聚合周期，W、M、Q或Y
+
+    Returns:
+        聚合后的K线，索引为每个周期的第一个交易日，成交量为周期内的日均成交量
+    """
+    index = df.index.tz_localize(None) if df.index.tz is not None else df.index
+    keys = np.asarray(index.to_period(rule))
+    aggregated = df.groupby(keys).agg({
+        'Open': 'first',
+        'High': 'max',
+        'Low': 'min',
+        'Close': 'last',
+        'Volume': 'mean',
+    })
+    aggregated.index = pd.DatetimeIndex(df.index.to_series().groupby(keys).first().to_numpy(),
+                                        tz=df.index.tz)
+    return aggregated
+
+
+def level_of_detail(df: pd.DataFrame, width_px: int = CHART_WIDTH_PX) -> Dict[str, Any]:
+    """
+    按图表宽度为长周期K线选择细节层级
+
+    最近的一段保留日K线，更早的部分按LOD_LEVELS聚合到能放下的最细周期，
+    使图表的点数只取决于宽度而与历史长短无关。
+
+    Args:
+        df: 日K线数据
+        width_px: 图表宽度（像素）
+
+    Returns:
+        {'older': 聚合后的早期K线（可能为空）, 'label': 聚合周期名称, 'recent': 日K线部分,
+         'budget': 早期部分可用的点数}
+    """
+    budget = max(width_px // PX_PER_CANDLE, 20)
+    if len(df) <= budget:
+        return {'older': df.iloc[:0], 'label': '', 'recent': df, 'budget': 0}
+
+    recent_bars = budget // 2
+    older, recent = df.iloc[:-recent_bars], df.iloc[-recent_bars:]
+    older_budget = budget - recent_bars
+    for rule, label in LOD_LEVELS:
+        aggregated = aggregate_ohlcv(older, rule)
+        if len(aggregated) <= older_budget:
+            break
+    return {'older': aggregated, 'label': label, 'recent': recent, 'budget': older_budget}
+
+
+def decimate_series(series: pd.Series, threshold: int) -> pd.Series:
+    """用LTTB把序列降到threshold个点，缺失值不参与采样"""
+    series = series.dropna()
+    if len(series) <= threshold:
+        return series
+    x = np.asarray(series.index.tz_localize(None) if series.index.tz is not None
+                   else series.index, dtype='datetime64[ns]').view(np.int64).astype(float)
+    return series.iloc[lttb_indices(x, series.to_numpy(dtype=float), threshold)]
+
+
+def render_chart(fig: go.Figure, output: str = 'html') -> str:
+    """
+    按输出模式序列化图表
+
+    Args:
+        fig: Plotly图表
+        output: html为内嵌plotly.js的完整HTML；compact为引用外部plotly.js、
+            数据使用typed array的HTML片段；json为精简的图表JSON，
+            可通过plotly.io.from_json还原后交给st.plotly_chart
+
+    Returns:
+        序列化后的字符串
+    """
+    if output == 'json':
+        return figure_to_compact_json(fig)
+
+    if output == 'compact':
+        div_id = f"chart-{id(fig):x}"
+        height = fig.layout.height or 600
+        return (
+            f'<div id="{div_id}" style="height:{height}px"></div>\n'
+            f'<script src="{plotlyjs_src()}"></script>\n'
+            f'<script>(function(){{var f={figure_to_compact_json(fig)};'
+            f'Plotly.newPlot("{div_id}",f.data,f.layout,{{"responsive":true}});}})();</script>'
+        )
+
+    buffer = io.StringIO()
+    fig.write_html(buffer)
+    return buffer.getvalue()
+
+def is_market_open(ticker_symbol: str, now: Optional[datetime.datetime] = None) -> bool:
+    """判断股票所在交易所当前是否处于常规交易时段
+    
+    Args:
+        ticker_symbol: 股票代码
+        now: 判断的时间点，默认为当前时间
+        
+    Returns:
+        是否处于交易时段；无法确定时区时按交易时段处理，使用较短的缓存有效期
+    """
+    suffix = ticker_symbol[ticker_symbol.rfind('.'):].upper() if '.' in ticker_symbol else ''
+    zone, (open_hour, open_minute), (close_hour, close_minute) = \
+        MARKET_SESSIONS.get(suffix, MARKET_SESSIONS[''])
+    try:
+        local = (now or datetime.datetime.now(datetime.timezone.utc)).astimezone(ZoneInfo(zone))
+    except ZoneInfoNotFoundError:
+        return True
+    if local.weekday() >= 5:
+        return False
+    minutes = local.hour * 60 + local.minute
+    return open_hour * 60 + open_minute <= minutes < close_hour * 60 + close_minute
+
+
+class TickerSession:
+    """单次分析内共享的股票数据会话
+
+    同一会话内只创建一个yf.Ticker对象，并缓存info、历史数据和财务报表，
+    YFinanceStockTool的各个方法传入同一个会话即可避免重复的网络请求。
+    会话是线程安全的，可以在多个工具并发调用时共享。
+    跨会话的数据按类别缓存在DATA_CACHE中，有效期见DATA_CACHE_POLICIES。
+    """
+
+    def __init__(self, ticker_symbol: str, store: Optional[OHLCVStore] = None):
+        """
+        初始化数据会话
+
+        Args:
+            ticker_symbol: 股票代码
+            store: 本地OHLCV存储，默认使用进程共享的存储
+        """
+        self.ticker_symbol = ticker_symbol
+        self.store = store or get_default_store()
+        self._ticker = None
+        self._cache: Dict[Any, Any] = {}
+        self._locks: Dict[Any, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def __enter__(self) -> 'TickerSession':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        """清空会话内缓存的所有数据"""
+        with self._guard:
+            self._cache.clear()
+            self._locks.clear()
+
+    def _memoize(self, key: Any, loader: Callable[[], Any]) -> Any:
+        """按键缓存加载结果，同一个键只加载一次，不同键之间互不阻塞"""
+        with self._guard:
+            if key in self._cache:
+                return self._cache[key]
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._cache:
+                self._cache[key] = loader()
+            return self._cache[key]
+
+    def _fetch(self, key: Any, loader: Callable[[], Any], data_class: str) -> Any:
+        """需要网络请求的数据：会话内缓存，跨会话按类别缓存，并合并对同一数据的并发请求"""
+        shared_key = (self.ticker_symbol.upper(), key)
+
+        def load() -> Any:
+            return DATA_CACHE.get(data_class, shared_key,
+                                  lambda: FETCH_FLIGHTS.do(shared_key, loader),
+                                  market_open=is_market_open(self.ticker_symbol))
+
+        return self._memoize(key, load)
+
+    @property
+    def ticker(self) -> yf.Ticker:
+        """会话共享的yf.Ticker对象"""
+        return self._memoize('ticker', lambda: yf.Ticker(self.ticker_symbol))
+
+    @property
+    def info(self) -> Dict[str, Any]:
+        """股票基本信息（ticker.info），每个会话只请求一次"""
+        return self._fetch('info', lambda: self.ticker.info, 'quote')
+
+    @property
+    def profile(self) -> Dict[str, Any]:
+        """按profile类别缓存的ticker.info，用于行业、公司概况和估值比率等变化很慢的字段"""
+        return self._fetch('profile', lambda: self.info, 'profile')
+
+    def history(self, period: str = '1y') -> pd.DataFrame:
+        """
+        获取历史股价数据，同一时间段只下载一次
+
+        Args:
+            period: 时间段 (1d, 5d, 1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max)
+
+        Returns:
+            历史数据的副本，调用方可以自由添加列而不影响缓存
+        """
+        return self._history(period).copy()
+
+    def _history(self, period: str) -> pd.DataFrame:
+        """返回缓存中的历史数据本身，调用方不得修改"""
+        return self._fetch(('history', period), lambda: self._load_history(period),
+                           'daily_bars')
+
+    def indicators(self, requested: Iterable[str], period: str = '1y') -> Dict[str, Any]:
+        """
+        计算技术指标，同一会话内已算过的指标和中间结果（如EMA12/EMA26）直接复用
+
+        Args:
+            requested: 需要的指标名称，如{'rsi14', 'macd'}，可用名称见indicators.INDICATORS
+            period: 计算所用的历史数据时间段
+
+        Returns:
+            指标名称到一维数组的字典，数组与history(period)的索引对齐
+        """
+        hist = self._history(period)
+        cache = self._memoize(('indicators', period), dict)
+        with self._memoize(('indicators_lock', period), threading.Lock):
+            values = compute_indicators({'close': hist['Close'].to_numpy(),
+                                         'volume': hist['Volume'].to_numpy()},
+                                        requested, cache=cache)
+        return {name: series[0] for name, series in values.items()}
+
+    def _load_history(self, period: str) -> pd.DataFrame:
+        """优先通过本地存储增量获取历史数据，存储不可用时直接下载"""
+        try:
+            return self.store.history(self.ticker_symbol, period, ticker=self.ticker)
+        except Exception as e:
+            print(f"读取本地历史数据时出错，改为直接下载: {str(e)}")
+            return self.ticker.history(period=period)
+
+    @property
+    def balance_sheet(self) -> pd.DataFrame:
+        """资产负债表"""
+        return self._fetch('balance_sheet', lambda: self.ticker.balance_sheet, 'statements')
+
+    @property
+    def income_stmt(self) -> pd.DataFrame:
+        """利润表"""
+        return self._fetch('income_stmt', lambda: self.ticker.income_stmt, 'statements')
+
+    @property
+    def cashflow(self) -> pd.DataFrame:
+        """现金流量表"""
+        return self._fetch('cashflow', lambda: self.ticker.cashflow, 'statements')
+
 
 class YFinanceStockTool:
-    """用于从yfinance API获取股票数据的工具类"""
+    """用于从yfinance API获取股票数据的工具类
+
+    所有方法都接受可选的session参数，传入同一个TickerSession即可在一次分析中
+    共享已获取的数据；不传时每次调用都会创建临时会话。
+    """
+
+    @staticmethod
+    def _get_session(ticker_symbol: str, session: Optional[TickerSession] = None) -> TickerSession:
+        """返回可用的数据会话，未提供或股票代码不匹配时创建新会话"""
+        if session is not None and session.ticker_symbol == ticker_symbol:
+            return session
+        return TickerSession(ticker_symbol)
     
     @staticmethod
-    def get_stock_info(ticker_symbol: str) -> Dict[str, Any]:
+    def get_stock_info(ticker_symbol: str,
+                       session: Optional[TickerSession] = None) -> Dict[str, Any]:
         """获取股票的基本信息"""
         try:
-            ticker = yf.Ticker(ticker_symbol)
-            info = ticker.info
+            info = YFinanceStockTool._get_session(ticker_symbol, session).info
             return {
                 'longName': info.get('longName', '未知'),
                 'sector': info.get('sector', '未知'),
@@ -37,35 +463,84 @@ class YFinanceStockTool:
             return {'error': f"获取股票信息时出错: {str(e)}"}
 
     @staticmethod
-    def get_historical_data(ticker_symbol: str, period: str = '1y') -> pd.DataFrame:
+    def get_historical_data(ticker_symbol: str, period: str = '1y',
+                            session: Optional[TickerSession] = None) -> pd.DataFrame:
         """获取历史股价数据
         
         Args:
             ticker_symbol: 股票代码
             period: 时间段 (1d, 5d, 1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max)
+            session: 可选的数据会话，用于复用已下载的数据
         """
         try:
-            ticker = yf.Ticker(ticker_symbol)
-            hist = ticker.history(period=period)
-            return hist
+            return YFinanceStockTool._get_session(ticker_symbol, session).history(period)
         except Exception as e:
             print(f"获取历史数据时出错: {str(e)}")
             return pd.DataFrame()
 
     @staticmethod
-    def get_financial_data(ticker_symbol: str) -> Dict[str, Any]:
+    def get_historical_data_batch(ticker_symbols: List[str], period: str = '1y',
+                                  max_workers: int = BATCH_MAX_WORKERS) -> Dict[str, Any]:
+        """批量获取多只股票的历史股价数据
+        
+        使用有界线程池并发下载，单只股票失败不会中断整个批次。
+        
+        Args:
+            ticker_symbols: 股票代码列表
+            period: 时间段 (1d, 5d, 1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max)
+            max_workers: 最大并发下载数
+            
+        Returns:
+            {'data': 按日期对齐的DataFrame，列为(股票代码, 字段)的MultiIndex,
+             'errors': 下载失败的股票代码及错误信息}
+        """
+        # 去重并保持原有顺序
+        symbols = list(dict.fromkeys(ticker_symbols))
+        frames = {}
+        errors = {}
+
+        def fetch(symbol: str) -> pd.DataFrame:
+            return TickerSession(symbol).history(period)
+
+        workers = max(1, min(max_workers, len(symbols)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {symbol: executor.submit(fetch, symbol) for symbol in symbols}
+            for symbol, future in futures.items():
+                try:
+                    hist = future.result()
+                except Exception as e:
+                    errors[symbol] = f"获取历史数据时出错: {str(e)}"
+                    continue
+                if hist.empty:
+                    errors[symbol] = '无历史数据'
+                    continue
+                # 不同交易所时区不同，按本地交易日对齐
+                if hist.index.tz is not None:
+                    hist.index = hist.index.tz_localize(None)
+                frames[symbol] = hist
+
+        if frames:
+            data = pd.concat(frames, axis=1, names=['Ticker', 'Field']).sort_index()
+        else:
+            data = pd.DataFrame()
+
+        return {'data': data, 'errors': errors}
+
+    @staticmethod
+    def get_financial_data(ticker_symbol: str,
+                           session: Optional[TickerSession] = None) -> Dict[str, Any]:
         """获取财务数据，包括资产负债表、利润表和现金流量表"""
         try:
-            ticker = yf.Ticker(ticker_symbol)
+            session = YFinanceStockTool._get_session(ticker_symbol, session)
             
             # 获取资产负债表
-            balance_sheet = ticker.balance_sheet
+            balance_sheet = session.balance_sheet
             
             # 获取利润表
-            income_stmt = ticker.income_stmt
+            income_stmt = session.income_stmt
             
             # 获取现金流量表
-            cash_flow = ticker.cashflow
+            cash_flow = session.cashflow
             
             # 提取关键指标
             financial_data = {
@@ -106,57 +581,41 @@ class YFinanceStockTool:
             return {'error': f"获取财务数据时出错: {str(e)}"}
 
     @staticmethod
-    def calculate_technical_indicators(ticker_symbol: str) -> Dict[str, Any]:
-        """计算技术指标，如RSI、MACD和移动平均线"""
+    def calculate_technical_indicators(
+            ticker_symbol: str,
+            session: Optional[TickerSession] = None,
+            indicators: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """计算技术指标，如RSI、MACD和移动平均线
+        
+        Args:
+            ticker_symbol: 股票代码
+            session: 可选的数据会话，用于复用已下载的数据和已计算的指标
+            indicators: 需要的指标名称，默认为全部默认指标；只计算这些指标及其依赖
+        """
         try:
-            # 获取历史数据
-            df = YFinanceStockTool.get_historical_data(ticker_symbol)
+            session = YFinanceStockTool._get_session(ticker_symbol, session)
+            requested = [canonical_name(name) for name in (indicators or DEFAULT_INDICATORS)]
+            
+            # 按指标所需的K线数（含预热）获取最短的历史数据，例如只算RSI时只需1mo
+            period = lookback_period(requested)
+            df = session.history(period)
             
             if df.empty:
                 return {'error': '无法获取数据来计算技术指标'}
             
-            # 计算简单移动平均线 (SMA)
-            df['SMA20'] = df['Close'].rolling(window=20).mean()
-            df['SMA50'] = df['Close'].rolling(window=50).mean()
-            df['SMA200'] = df['Close'].rolling(window=200).mean()
-            
-            # 计算相对强弱指数 (RSI)
-            delta = df['Close'].diff()
-            gain = delta.where(delta > 0, 0).rolling(window=14).mean()
-            loss = -delta.where(delta < 0, 0).rolling(window=14).mean()
-            rs = gain / loss
-            df['RSI'] = 100 - (100 / (1 + rs))
-            
-            # 计算MACD
-            exp1 = df['Close'].ewm(span=12, adjust=False).mean()
-            exp2 = df['Close'].ewm(span=26, adjust=False).mean()
-            df['MACD'] = exp1 - exp2
-            df['Signal_Line'] = df['MACD'].ewm(span=9, adjust=False).mean()
-            df['MACD_Histogram'] = df['MACD'] - df['Signal_Line']
+            # 只计算请求的指标，共享的中间结果只计算一次
+            values = session.indicators(requested, period)
             
             # 提取最新值
-            latest = df.iloc[-1]
+            latest = {name: float(series[-1]) for name, series in values.items()}
+            latest['close'] = float(df['Close'].iloc[-1])
             
-            result = {
-                'current_price': float(latest['Close']),
-                'sma20': float(latest['SMA20']),
-                'sma50': float(latest['SMA50']),
-                'sma200': float(latest['SMA200']),
-                'rsi': float(latest['RSI']),
-                'macd': float(latest['MACD']),
-                'signal_line': float(latest['Signal_Line']),
-                'macd_histogram': float(latest['MACD_Histogram']),
-                'volume': float(latest['Volume']),
-                # 简单的趋势信号
-                'trend_signals': {
-                    'price_above_sma20': latest['Close'] > latest['SMA20'],
-                    'price_above_sma50': latest['Close'] > latest['SMA50'],
-                    'price_above_sma200': latest['Close'] > latest['SMA200'],
-                    'sma20_above_sma50': latest['SMA20'] > latest['SMA50'],
-                    'rsi_oversold': latest['RSI'] < 30,
-                    'rsi_overbought': latest['RSI'] > 70,
-                    'macd_above_signal': latest['MACD'] > latest['Signal_Line'],
-                }
+            result = {'current_price': latest['close']}
+            result.update({name: latest[name] for name in requested})
+            result['volume'] = float(df['Volume'].iloc[-1])
+            # 简单的趋势信号
+            result['trend_signals'] = {
+                name: bool(signal) for name, signal in trend_signals(latest).items()
             }
             
             return result
@@ -164,7 +623,8 @@ class YFinanceStockTool:
             return {'error': f"计算技术指标时出错: {str(e)}"}
 
     @staticmethod
-    def get_news_sentiment(ticker_symbol: str) -> Dict[str, Any]:
+    def get_news_sentiment(ticker_symbol: str,
+                           session: Optional[TickerSession] = None) -> Dict[str, Any]:
         """模拟获取新闻情绪分析（实际实现中可以使用新闻API）"""
         try:
             # 这里只是模拟数据，实际应用中应连接到新闻API
@@ -180,55 +640,104 @@ class YFinanceStockTool:
             return {'error': f"获取新闻情绪时出错: {str(e)}"}
 
     @staticmethod
-    def generate_stock_chart(ticker_symbol: str) -> str:
-        """生成股票图表并返回base64编码的图像"""
+    def _chart_cache_key(ticker_symbol: str, period: str, output: str, width_px: int,
+                         last_bar: int) -> str:
+        """图表缓存键：股票代码、时间段、输出模式、宽度、叠加指标和最后一根K线的时间戳"""
+        overlays = ','.join(CHART_OVERLAYS)
+        return f"{ticker_symbol.upper()}|{period}|{output}|{width_px}|{overlays}|{last_bar}"
+
+    @staticmethod
+    def generate_stock_chart(ticker_symbol: str, session: Optional[TickerSession] = None,
+                             period: str = '1y', output: str = 'html',
+                             width_px: int = CHART_WIDTH_PX) -> str:
+        """生成股票图表并返回HTML或图表JSON
+        
+        Args:
+            ticker_symbol: 股票代码
+            session: 可选的数据会话
+            period: 图表显示的时间段，只下载该时间段的数据
+            output: 输出模式，html（默认，内嵌plotly.js）、compact（引用外部plotly.js）
+                或json（精简图表JSON），详见render_chart
+            width_px: 图表宽度（像素），决定长周期图表的细节层级
+        """
         try:
-            # 获取历史数据
-            df = YFinanceStockTool.get_historical_data(ticker_symbol)
+            session = YFinanceStockTool._get_session(ticker_symbol, session)
+            
+            # 图表只在新K线出现时变化：本地数据无需同步时，直接按最后一根K线查找缓存，
+            # 跳过数据获取和图表构建
+            checked_key = None
+            last_bar = session.store.fresh_last_date(ticker_symbol)
+            if last_bar is not None:
+                checked_key = YFinanceStockTool._chart_cache_key(
+                    ticker_symbol, period, output, width_px, last_bar)
+                cached = CHART_CACHE.get(checked_key)
+                if cached is not None:
+                    return cached
+            
+            # 获取显示范围内的历史数据
+            df = session.history(period)
             
             if df.empty:
                 return ""
             
-            # 计算技术指标
-            df['SMA20'] = df['Close'].rolling(window=20).mean()
-            df['SMA50'] = df['Close'].rolling(window=50).mean()
+            # 本地数据需要同步时，历史数据可能来自DATA_CACHE，按实际的最后一根K线再查找一次
+            cache_key = YFinanceStockTool._chart_cache_key(
+                ticker_symbol, period, output, width_px, df.index[-1].value)
+            if cache_key != checked_key:
+                cached = CHART_CACHE.get(cache_key)
+                if cached is not None:
+                    return cached
+            
+            # 计算技术指标，与calculate_technical_indicators共享同一会话内的计算结果
+            values = session.indicators(CHART_OVERLAYS, period)
+            df['SMA20'] = values['sma20']
+            df['SMA50'] = values['sma50']
+            
+            # 长周期图表：早期部分聚合为周/月K线，均线做LTTB降采样，只保留最近一段日K线
+            lod = level_of_detail(df, width_px)
+            older, recent = lod['older'], lod['recent']
+            segments = [(recent, '')]
+            if not older.empty:
+                segments.insert(0, (older, f"（{lod['label']}）"))
             
             # 创建Plotly图表
             fig = go.Figure()
             
-            # 添加蜡烛图
-            fig.add_trace(go.Candlestick(
-                x=df.index,
-                open=df['Open'],
-                high=df['High'],
-                low=df['Low'],
-                close=df['Close'],
-                name='K线'
-            ))
+            # 添加蜡烛图，不同层级分开绘制以便各自计算K线宽度
+            for segment, suffix in segments:
+                fig.add_trace(go.Candlestick(
+                    x=segment.index,
+                    open=segment['Open'],
+                    high=segment['High'],
+                    low=segment['Low'],
+                    close=segment['Close'],
+                    name=f'K线{suffix}',
+                    legendgroup='K线'
+                ))
             
             # 添加移动平均线
-            fig.add_trace(go.Scatter(
-                x=df.index,
-                y=df['SMA20'],
-                line=dict(color='blue', width=1.5),
-                name='20日均线'
-            ))
+            for column, color, name in (('SMA20', 'blue', '20日均线'), ('SMA50', 'red', '50日均线')):
+                line = df[column]
+                if not older.empty:
+                    line = pd.concat([decimate_series(line.iloc[:-len(recent)], lod['budget']),
+                                      line.iloc[-len(recent):]])
+                fig.add_trace(go.Scatter(
+                    x=line.index,
+                    y=line,
+                    line=dict(color=color, width=1.5),
+                    name=name
+                ))
             
-            fig.add_trace(go.Scatter(
-                x=df.index,
-                y=df['SMA50'],
-                line=dict(color='red', width=1.5),
-                name='50日均线'
-            ))
-            
-            # 添加成交量
-            fig.add_trace(go.Bar(
-                x=df.index,
-                y=df['Volume'],
-                name='成交量',
-                marker_color='rgba(0,0,0,0.2)',
-                yaxis='y2'
-            ))
+            # 添加成交量，聚合部分为日均成交量，与日K线处于同一量级
+            for segment, suffix in segments:
+                fig.add_trace(go.Bar(
+                    x=segment.index,
+                    y=segment['Volume'],
+                    name=f'成交量{suffix}',
+                    legendgroup='成交量',
+                    marker_color='rgba(0,0,0,0.2)',
+                    yaxis='y2'
+                ))
             
             # 更新布局
             fig.update_layout(
@@ -244,22 +753,21 @@ class YFinanceStockTool:
                 margin=dict(l=50, r=50, b=100, t=100, pad=4),
             )
             
-            # 将图表转换为HTML
-            buffer = io.StringIO()
-            fig.write_html(buffer)
-            html_str = buffer.getvalue()
-            
-            return html_str
+            # 按输出模式序列化图表并缓存
+            rendered = render_chart(fig, output)
+            CHART_CACHE.put(cache_key, rendered)
+            return rendered
         except Exception as e:
             print(f"生成股票图表时出错: {str(e)}")
             return ""
 
     @staticmethod
-    def get_peer_comparison(ticker_symbol: str) -> Dict[str, Any]:
+    def get_peer_comparison(ticker_symbol: str,
+                            session: Optional[TickerSession] = None) -> Dict[str, Any]:
         """获取与同行业公司的比较数据"""
         try:
-            ticker = yf.Ticker(ticker_symbol)
-            info = ticker.info
+            # 行业和估值比率变化很慢，使用长有效期的profile数据
+            info = YFinanceStockTool._get_session(ticker_symbol, session).profile
             
             # 获取行业信息
             industry = info.get('industry', '')
@@ -282,8 +790,63 @@ class YFinanceStockTool:
         except Exception as e:
             return {'error': f"获取同行业比较数据时出错: {str(e)}"}
 
+def _compact_value(value: Any) -> Any:
+    """把数据转换为便于JSON序列化的紧凑形式：浮点数保留有限位有效数字，NaN转为None"""
+    if isinstance(value, dict):
+        return {key: _compact_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_compact_value(item) for item in value]
+    if isinstance(value, (np.floating, float)):
+        value = float(value)
+        if not np.isfinite(value):
+            return None
+        if value.is_integer():
+            return int(value)
+        return float(f"{value:.{PROMPT_FLOAT_DIGITS}g}")
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    return value
+
+
+def to_compact_json(data: Dict[str, Any]) -> str:
+    """把预取的数据序列化为紧凑的JSON字符串，用于写入提示词"""
+    return json.dumps(_compact_value(data), ensure_ascii=False, separators=(',', ':'))
+
+
+def prefetch_analysis_data(ticker_symbol: str, session: Optional[TickerSession] = None,
+                           max_workers: int = len(PREFETCH_TOOLS)) -> Dict[str, Any]:
+    """并发调用分析所需的各个工具，预取一只股票的全部分析数据
+    
+    所有工具共享同一个TickerSession，同一份原始数据（如info）只下载一次；
+    总耗时取决于最慢的单项数据而不是各项之和。单项失败时该项为错误字典。
+    
+    Args:
+        ticker_symbol: 股票代码
+        session: 可选的数据会话，用于复用已下载的数据
+        max_workers: 最大并发数
+        
+    Returns:
+        以PREFETCH_TOOLS中的数据项名称为键的字典
+    """
+    session = YFinanceStockTool._get_session(ticker_symbol, session)
+    workers = max(1, min(max_workers, len(PREFETCH_TOOLS)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(getattr(YFinanceStockTool, method), ticker_symbol,
+                                  session=session)
+            for name, method in PREFETCH_TOOLS
+        }
+        # 工具方法自行捕获异常并返回错误字典
+        return {name: future.result() for name, future in futures.items()}
+
+
 def get_stock_tools() -> List[Tool]:
-    """创建并返回一组用于股票分析的工具"""
+    """创建并返回一组供LLM调用的股票分析工具
+
+    generate_stock_chart返回的是供页面显示的HTML或图表JSON，对模型没有信息量，不作为工具提供。
+    """
     stock_tools = [
         Tool(
             name="GetStockInfo",
@@ -310,11 +873,6 @@ def get_stock_tools() -> List[Tool]:
             description="获取与股票相关的新闻情绪分析",
             func=YFinanceStockTool.get_news_sentiment
         ),
-        Tool(
-            name="GenerateStockChart",
-            description="生成股票价格和技术指标的图表",
-            func=YFinanceStockTool.generate_stock_chart
-        ),
         Tool(
             name="GetPeerComparison",
             description="获取与同行业公司的比较数据",
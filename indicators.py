@@ -0,0 +1,647 @@
+"""
+向量化技术指标引擎
+
+输入为按日期对齐的二维矩阵（行是股票，列是日期），一次计算全部股票的
+SMA20/50/200、RSI、MACD和信号线，结果与YFinanceStockTool.calculate_technical_indicators
+中基于pandas的逐只计算一致。
+
+- 滚动均值使用累加和实现，整段矩阵只需几次向量运算
+- EWM按时间逐列递推，每一步都是对全部股票的向量运算
+- 指标通过注册表声明输入和窗口长度，只计算请求的指标及其依赖，共享的中间结果只算一次
+- 缺失值（上市前的日期、批量面板中各交易所不同的休市日）被跳过：每只股票只在自己的有效K线上
+  计算，与对单只股票的历史数据调用pandas的结果相同，缺失日期的结果为NaN
+
+对于逐根K线的流式刷新，IndicatorState保存每只股票的滚动窗口和EMA状态，
+每根新K线只需常数时间即可更新最新指标值，并且可以序列化保存。
+"""
+
+import math
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ohlcv_store import period_for_bars
+
+
+def _pack_valid(values: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    把每行的有效值按原顺序移到行尾，缺失值移到行首，使每行成为没有中间缺口的序列
+
+    Returns:
+        (重排后的矩阵, 重排顺序)；已经没有中间缺口时原样返回，顺序为None
+    """
+    valid = np.isfinite(values)
+    if np.all(valid[..., 1:] >= valid[..., :-1]):
+        return values, None
+    order = np.argsort(valid, axis=-1, kind="stable")
+    return np.take_along_axis(values, order, axis=-1), order
+
+
+def _unpack_valid(packed: np.ndarray, order: Optional[np.ndarray],
+                  valid: np.ndarray) -> np.ndarray:
+    """把按_pack_valid顺序计算的结果放回原来的日期，原来缺失的日期为NaN"""
+    if order is None:
+        return packed
+    result = np.empty_like(packed)
+    np.put_along_axis(result, order, packed, axis=-1)
+    return np.where(valid, result, np.nan)
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """
+    沿时间轴计算简单移动平均，只使用每只股票自己的有效K线
+
+    等价于对去掉缺失日期后的序列执行pandas的rolling(window).mean()，没有缺失值时与直接
+    调用pandas相同。
+
+    Args:
+        values: 形状为(股票数, 日期数)的矩阵
+        window: 窗口长度
+
+    Returns:
+        与输入同形状的矩阵，有效K线不足window根或该日期缺失的位置为NaN
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    packed, order = _pack_valid(values)
+    return _unpack_valid(_rolling_mean_packed(packed, window), order, valid)
+
+
+def _rolling_mean_packed(values: np.ndarray, window: int) -> np.ndarray:
+    """对只在行首有缺失值的矩阵计算滚动均值"""
+    valid = np.isfinite(values)
+    zero_pad = np.zeros(values.shape[:-1] + (1,))
+
+    sums = np.concatenate([zero_pad, np.cumsum(np.where(valid, values, 0.0), axis=-1)], axis=-1)
+    counts = np.concatenate([zero_pad, np.cumsum(valid, axis=-1)], axis=-1)
+
+    result = np.full(values.shape, np.nan)
+    if values.shape[-1] < window:
+        return result
+
+    window_sums = sums[..., window:] - sums[..., :-window]
+    window_counts = counts[..., window:] - counts[..., :-window]
+    result[..., window - 1:] = np.where(window_counts == window, window_sums / window, np.nan)
+    return result
+
+
+def ewm_mean(values: np.ndarray, span: int) -> np.ndarray:
+    """
+    沿时间轴计算指数移动平均，只使用每只股票自己的有效K线
+
+    等价于对去掉缺失日期后的序列执行pandas的ewm(span=span, adjust=False).mean()；
+    序列中间有缺失值时与直接调用pandas（ignore_na=False会按缺口长度衰减权重）不同。
+
+    Args:
+        values: 形状为(股票数, 日期数)的矩阵
+        span: 跨度
+
+    Returns:
+        与输入同形状的矩阵，第一个有效值之前和缺失日期的位置为NaN
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    packed, order = _pack_valid(values)
+    return _unpack_valid(_ewm_mean_packed(packed, span), order, valid)
+
+
+def _ewm_mean_packed(values: np.ndarray, span: int) -> np.ndarray:
+    """对只在行首有缺失值的矩阵逐列递推指数移动平均"""
+    alpha = 2.0 / (span + 1.0)
+    result = np.empty_like(values)
+
+    current = np.full(values.shape[:-1], np.nan)
+    for t in range(values.shape[-1]):
+        column = values[..., t]
+        updated = np.where(np.isnan(current), column, current + alpha * (column - current))
+        current = np.where(np.isnan(column), current, updated)
+        result[..., t] = current
+    return result
+
+
+def rsi(close: np.ndarray, window: int = 14) -> np.ndarray:
+    """
+    计算相对强弱指数，与calculate_technical_indicators相同，使用涨跌幅的简单移动平均
+
+    涨跌幅按每只股票相邻的两根有效K线计算，跨过休市日。
+
+    Args:
+        close: 收盘价矩阵
+        window: 窗口长度
+
+    Returns:
+        RSI矩阵，缺失日期的位置为NaN
+    """
+    close = np.asarray(close, dtype=np.float64)
+    valid = np.isfinite(close)
+    packed, order = _pack_valid(close)
+    return _unpack_valid(_rsi_packed(packed, window), order, valid)
+
+
+def _rsi_packed(close: np.ndarray, window: int) -> np.ndarray:
+    """对只在行首有缺失值的收盘价矩阵计算RSI"""
+    delta = np.full(close.shape, np.nan)
+    delta[..., 1:] = np.diff(close, axis=-1)
+
+    # 与pandas一致，第一根K线的涨跌幅记为0；上市前的日期不计入窗口
+    listed = np.isfinite(close)
+    with np.errstate(invalid="ignore"):
+        gain = _rolling_mean_packed(np.where(listed, np.where(delta > 0, delta, 0.0), np.nan),
+                                    window)
+        loss = _rolling_mean_packed(np.where(listed, np.where(delta < 0, -delta, 0.0), np.nan),
+                                    window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rs = gain / loss
+        return 100 - (100 / (1 + rs))
+
+
+class IndicatorSpec:
+    """已注册指标的描述：输入、自身窗口长度和EWM预热长度"""
+
+    def __init__(self, name: str, inputs: Tuple[str, ...], window: int, warmup: int,
+                 func: Callable[..., np.ndarray]):
+        self.name = name
+        self.inputs = inputs
+        self.window = window
+        self.warmup = warmup
+        self.func = func
+
+
+# 基础输入序列，由调用方提供
+BASE_SERIES = ("close", "volume")
+
+# 指标注册表与别名
+INDICATORS: Dict[str, IndicatorSpec] = {}
+ALIASES = {"rsi14": "rsi"}
+
+# calculate_technical_indicators默认计算的指标
+DEFAULT_INDICATORS = ("sma20", "sma50", "sma200", "rsi", "macd", "signal_line", "macd_histogram")
+
+
+def register_indicator(name: str, inputs: Iterable[str], window: int = 1,
+                       warmup: int = 0) -> Callable[[Callable[..., np.ndarray]],
+                                                    Callable[..., np.ndarray]]:
+    """
+    注册一个指标，用作装饰器
+
+    Args:
+        name: 指标名称
+        inputs: 输入序列或其他指标的名称，按顺序作为函数参数传入
+        window: 指标自身需要的K线数，如SMA20为20
+        warmup: EWM类指标为收敛额外需要的K线数
+
+    Returns:
+        装饰器，原样返回被装饰的函数
+    """
+    def decorator(func: Callable[..., np.ndarray]) -> Callable[..., np.ndarray]:
+        INDICATORS[name] = IndicatorSpec(name, tuple(inputs), window, warmup, func)
+        return func
+    return decorator
+
+
+def canonical_name(name: str) -> str:
+    """把别名转换为注册表中的指标名称，未知名称抛出ValueError"""
+    name = ALIASES.get(name, name)
+    if name not in INDICATORS and name not in BASE_SERIES:
+        raise ValueError(f"未知的技术指标: {name}")
+    return name
+
+
+def resolve(requested: Iterable[str]) -> List[str]:
+    """
+    按依赖关系排序，返回计算requested所需的全部指标（不含基础序列）
+
+    Args:
+        requested: 需要的指标名称
+
+    Returns:
+        拓扑排序后的指标名称列表，每个共享的中间指标只出现一次
+    """
+    order: List[str] = []
+    visited = set()
+
+    def visit(name: str) -> None:
+        name = canonical_name(name)
+        if name in visited or name in BASE_SERIES:
+            return
+        visited.add(name)
+        for dependency in INDICATORS[name].inputs:
+            visit(dependency)
+        order.append(name)
+
+    for name in requested:
+        visit(name)
+    return order
+
+
+def required_bars(requested: Iterable[str]) -> int:
+    """
+    计算requested中所有指标得到稳定最新值所需的最少K线数（含EWM预热）
+
+    Args:
+        requested: 需要的指标名称
+
+    Returns:
+        K线数
+    """
+    bars = {name: 1 for name in BASE_SERIES}
+    for name in resolve(requested):
+        spec = INDICATORS[name]
+        upstream = max(bars[dependency] for dependency in spec.inputs)
+        bars[name] = upstream + spec.window - 1 + spec.warmup
+    return max((bars[canonical_name(name)] for name in requested), default=1)
+
+
+def lookback_period(requested: Iterable[str]) -> str:
+    """
+    返回计算requested所需的最短历史数据时间段
+
+    Args:
+        requested: 需要的指标名称
+
+    Returns:
+        yfinance时间段字符串，如RSI只需要1mo，SMA200需要1y
+    """
+    return period_for_bars(required_bars(requested))
+
+
+def compute_indicators(series: Dict[str, np.ndarray], requested: Iterable[str],
+                       cache: Optional[Dict[str, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+    """
+    只计算requested及其依赖的指标，共享的中间结果只计算一次
+
+    Args:
+        series: 基础序列，如{"close": 收盘价矩阵, "volume": 成交量矩阵}
+        requested: 需要的指标名称
+        cache: 可选的结果缓存，多次调用传入同一个字典即可复用已算好的指标
+
+    Returns:
+        requested中每个名称到矩阵的字典，矩阵形状与输入相同
+    """
+    requested = list(requested)
+    cache = cache if cache is not None else {}
+    for name, values in series.items():
+        if name not in cache:
+            cache[name] = np.atleast_2d(np.asarray(values, dtype=np.float64))
+
+    for name in resolve(requested):
+        if name in cache:
+            continue
+        spec = INDICATORS[name]
+        missing = [dependency for dependency in spec.inputs if dependency not in cache]
+        if missing:
+            raise ValueError(f"计算{name}缺少输入序列: {', '.join(missing)}")
+        cache[name] = spec.func(*(cache[dependency] for dependency in spec.inputs))
+
+    return {name: cache[canonical_name(name)] for name in requested}
+
+
+def _register_sma(window: int) -> None:
+    register_indicator(f"sma{window}", ["close"], window)(
+        lambda close: rolling_mean(close, window))
+
+
+for _window in (20, 50, 200):
+    _register_sma(_window)
+
+
+@register_indicator("rsi", ["close"], window=15)
+def _rsi14(close: np.ndarray) -> np.ndarray:
+    return rsi(close, 14)
+
+
+# EWM在自身跨度之外再预热3倍跨度，初始值的剩余权重约为e^-8
+@register_indicator("ema12", ["close"], window=12, warmup=36)
+def _ema12(close: np.ndarray) -> np.ndarray:
+    return ewm_mean(close, 12)
+
+
+@register_indicator("ema26", ["close"], window=26, warmup=78)
+def _ema26(close: np.ndarray) -> np.ndarray:
+    return ewm_mean(close, 26)
+
+
+@register_indicator("macd", ["ema12", "ema26"])
+def _macd(ema12: np.ndarray, ema26: np.ndarray) -> np.ndarray:
+    return ema12 - ema26
+
+
+@register_indicator("signal_line", ["macd"], window=9, warmup=27)
+def _signal_line(macd: np.ndarray) -> np.ndarray:
+    return ewm_mean(macd, 9)
+
+
+@register_indicator("macd_histogram", ["macd", "signal_line"])
+def _macd_histogram(macd: np.ndarray, signal_line: np.ndarray) -> np.ndarray:
+    return macd - signal_line
+
+
+def compute_indicator_matrix(close: np.ndarray,
+                             volume: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """
+    对整个股票池一次性计算全部默认技术指标
+
+    Args:
+        close: 形状为(股票数, 日期数)的收盘价矩阵
+        volume: 可选的成交量矩阵，形状与close相同
+
+    Returns:
+        指标名称到矩阵的字典，每个矩阵的形状与close相同
+    """
+    series = {"close": close}
+    if volume is not None:
+        series["volume"] = volume
+    return compute_indicators(series, list(series) + list(DEFAULT_INDICATORS))
+
+
+# 趋势信号：名称 -> (所需指标, 判断函数)
+TREND_SIGNALS: Dict[str, Tuple[Tuple[str, ...], Callable[..., np.ndarray]]] = {
+    "price_above_sma20": (("close", "sma20"), lambda close, sma: close > sma),
+    "price_above_sma50": (("close", "sma50"), lambda close, sma: close > sma),
+    "price_above_sma200": (("close", "sma200"), lambda close, sma: close > sma),
+    "sma20_above_sma50": (("sma20", "sma50"), lambda fast, slow: fast > slow),
+    "rsi_oversold": (("rsi",), lambda value: value < 30),
+    "rsi_overbought": (("rsi",), lambda value: value > 70),
+    "macd_above_signal": (("macd", "signal_line"), lambda macd, signal: macd > signal),
+}
+
+
+def trend_signals(latest: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    根据最新指标值计算趋势信号，与calculate_technical_indicators中的trend_signals一致
+
+    Args:
+        latest: 指标名称到一维数组（每只股票一个值）的字典
+
+    Returns:
+        信号名称到布尔数组的字典；只包含所需指标都已提供的信号，指标为NaN时信号为False
+    """
+    signals = {}
+    with np.errstate(invalid="ignore"):
+        for name, (inputs, predicate) in TREND_SIGNALS.items():
+            if all(dependency in latest for dependency in inputs):
+                signals[name] = predicate(*(latest[dependency] for dependency in inputs))
+    return signals
+
+
+def scan_universe(close: np.ndarray, volume: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    计算股票池中每只股票的最新指标值和趋势信号
+
+    Args:
+        close: 形状为(股票数, 日期数)的收盘价矩阵
+        volume: 可选的成交量矩阵
+
+    Returns:
+        与calculate_technical_indicators相同的键，但每个值都是长度为股票数的数组：
+        current_price、sma20、sma50、sma200、rsi、macd、signal_line、macd_histogram、
+        volume（如提供）以及trend_signals
+    """
+    matrix = compute_indicator_matrix(close, volume)
+    # 每只股票取自己最后一根有效K线，批量面板中各交易所的休市日不同
+    valid = np.isfinite(matrix["close"])
+    last = valid.shape[-1] - 1 - np.argmax(valid[:, ::-1], axis=-1)
+    rows = np.arange(len(last))
+    latest = {name: values[rows, last] for name, values in matrix.items()}
+
+    result = {"current_price": latest["close"]}
+    result.update({name: values for name, values in latest.items() if name != "close"})
+    result["trend_signals"] = trend_signals(latest)
+    return result
+
+
+def panel_to_matrix(panel: pd.DataFrame,
+                    field: str = "Close") -> Tuple[List[str], pd.DatetimeIndex, np.ndarray]:
+    """
+    把get_historical_data_batch返回的面板转换为(股票数, 日期数)的矩阵
+
+    Args:
+        panel: 列为(股票代码, 字段)MultiIndex的DataFrame
+        field: 要提取的字段，如Close或Volume
+
+    Returns:
+        (股票代码列表, 日期索引, 矩阵)
+    """
+    frame = panel.xs(field, axis=1, level=-1)
+    return list(frame.columns), frame.index, frame.to_numpy(dtype=np.float64).T
+
+
+class IndicatorState:
+    """
+    单只股票的增量指标状态
+
+    保存SMA窗口的累加和、RSI涨跌幅窗口、MACD快慢线和信号线的EMA值，
+    追加一根K线或修正最后一根K线都只需常数时间，结果与批量计算一致。
+    """
+
+    SMA_WINDOWS = (20, 50, 200)
+    RSI_WINDOW = 14
+    MACD_FAST = 12
+    MACD_SLOW = 26
+    MACD_SIGNAL = 9
+
+    # 每追加这么多根K线，按窗口重新求和一次，消除浮点累加误差
+    RESYNC_INTERVAL = 1000
+
+    def __init__(self):
+        self.count = 0
+        self.volume = math.nan
+        self.closes: deque = deque(maxlen=max(self.SMA_WINDOWS))
+        self.gains: deque = deque(maxlen=self.RSI_WINDOW)
+        self.losses: deque = deque(maxlen=self.RSI_WINDOW)
+        self.sma_sums = {window: 0.0 for window in self.SMA_WINDOWS}
+        self.gain_sum = 0.0
+        self.loss_sum = 0.0
+        self.ema_fast = math.nan
+        self.ema_slow = math.nan
+        self.signal = math.nan
+        # 最后一根K线之前的状态，用于修正最后一根K线
+        self.previous_close = math.nan
+        self.previous_emas = (math.nan, math.nan, math.nan)
+
+    @staticmethod
+    def _ema(previous: float, value: float, span: int) -> float:
+        if math.isnan(previous):
+            return value
+        return previous + 2.0 / (span + 1.0) * (value - previous)
+
+    def _update_emas(self, close: float) -> None:
+        ema_fast, ema_slow, signal = self.previous_emas
+        self.ema_fast = self._ema(ema_fast, close, self.MACD_FAST)
+        self.ema_slow = self._ema(ema_slow, close, self.MACD_SLOW)
+        self.signal = self._ema(signal, self.ema_fast - self.ema_slow, self.MACD_SIGNAL)
+
+    def _resync(self) -> None:
+        closes = list(self.closes)
+        for window in self.SMA_WINDOWS:
+            self.sma_sums[window] = math.fsum(closes[-window:])
+        self.gain_sum = math.fsum(self.gains)
+        self.loss_sum = math.fsum(self.losses)
+
+    def update(self, close: float, volume: float = math.nan) -> Dict[str, Any]:
+        """
+        追加一根新K线
+
+        Args:
+            close: 收盘价
+            volume: 成交量
+
+        Returns:
+            最新指标值，格式与calculate_technical_indicators相同
+        """
+        close = float(close)
+        if not math.isfinite(close):
+            raise ValueError(f"收盘价无效: {close}")
+
+        # 窗口已满时，先减去即将移出窗口的值
+        for window in self.SMA_WINDOWS:
+            if len(self.closes) >= window:
+                self.sma_sums[window] -= self.closes[-window]
+        if len(self.gains) == self.RSI_WINDOW:
+            self.gain_sum -= self.gains[0]
+            self.loss_sum -= self.losses[0]
+
+        # 与pandas一致，第一根K线的涨跌幅记为0
+        self.previous_close = self.closes[-1] if self.closes else math.nan
+        delta = close - self.previous_close if self.closes else 0.0
+        self.gains.append(max(delta, 0.0))
+        self.losses.append(max(-delta, 0.0))
+        self.gain_sum += self.gains[-1]
+        self.loss_sum += self.losses[-1]
+
+        self.closes.append(close)
+        for window in self.SMA_WINDOWS:
+            self.sma_sums[window] += close
+
+        self.previous_emas = (self.ema_fast, self.ema_slow, self.signal)
+        self._update_emas(close)
+        self.volume = float(volume)
+        self.count += 1
+
+        if self.count % self.RESYNC_INTERVAL == 0:
+            self._resync()
+        return self.latest()
+
+    def update_last(self, close: float, volume: float = math.nan) -> Dict[str, Any]:
+        """
+        修正最后一根K线（例如盘中刷新尚未收盘的当日K线）
+
+        Args:
+            close: 最新收盘价
+            volume: 最新成交量
+
+        Returns:
+            最新指标值
+        """
+        if self.count == 0:
+            return self.update(close, volume)
+
+        close = float(close)
+        if not math.isfinite(close):
+            raise ValueError(f"收盘价无效: {close}")
+
+        old_close = self.closes[-1]
+        for window in self.SMA_WINDOWS:
+            self.sma_sums[window] += close - old_close
+        self.closes[-1] = close
+
+        delta = close - self.previous_close if not math.isnan(self.previous_close) else 0.0
+        self.gain_sum += max(delta, 0.0) - self.gains[-1]
+        self.loss_sum += max(-delta, 0.0) - self.losses[-1]
+        self.gains[-1] = max(delta, 0.0)
+        self.losses[-1] = max(-delta, 0.0)
+
+        self._update_emas(close)
+        self.volume = float(volume)
+        return self.latest()
+
+    def latest(self) -> Dict[str, Any]:
+        """
+        返回当前的最新指标值
+
+        Returns:
+            current_price、sma20、sma50、sma200、rsi、macd、signal_line、macd_histogram、
+            volume以及trend_signals，窗口未满的指标为NaN
+        """
+        values = {"close": self.closes[-1] if self.closes else math.nan}
+        for window in self.SMA_WINDOWS:
+            values[f"sma{window}"] = (self.sma_sums[window] / window
+                                      if self.count >= window else math.nan)
+
+        if self.count < self.RSI_WINDOW or (self.gain_sum == 0 and self.loss_sum == 0):
+            values["rsi"] = math.nan
+        elif self.loss_sum == 0:
+            values["rsi"] = 100.0
+        else:
+            values["rsi"] = 100 - (100 / (1 + self.gain_sum / self.loss_sum))
+
+        values["macd"] = self.ema_fast - self.ema_slow
+        values["signal_line"] = self.signal
+
+        result = {
+            "current_price": values["close"],
+            "sma20": values["sma20"],
+            "sma50": values["sma50"],
+            "sma200": values["sma200"],
+            "rsi": values["rsi"],
+            "macd": values["macd"],
+            "signal_line": values["signal_line"],
+            "macd_histogram": values["macd"] - values["signal_line"],
+            "volume": self.volume,
+        }
+        signals = trend_signals({name: np.float64(value) for name, value in values.items()})
+        result["trend_signals"] = {name: bool(signal) for name, signal in signals.items()}
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        """序列化为可以JSON保存的字典"""
+        return {
+            "count": self.count,
+            "volume": self.volume,
+            "closes": list(self.closes),
+            "gains": list(self.gains),
+            "losses": list(self.losses),
+            "ema_fast": self.ema_fast,
+            "ema_slow": self.ema_slow,
+            "signal": self.signal,
+            "previous_close": self.previous_close,
+            "previous_emas": list(self.previous_emas),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "IndicatorState":
+        """从to_dict()的结果恢复状态"""
+        state = cls()
+        state.count = data["count"]
+        state.volume = data["volume"]
+        state.closes.extend(data["closes"])
+        state.gains.extend(data["gains"])
+        state.losses.extend(data["losses"])
+        state.ema_fast = data["ema_fast"]
+        state.ema_slow = data["ema_slow"]
+        state.signal = data["signal"]
+        state.previous_close = data["previous_close"]
+        state.previous_emas = tuple(data["previous_emas"])
+        state._resync()
+        return state
+
+    @classmethod
+    def from_history(cls, close: np.ndarray,
+                     volume: Optional[np.ndarray] = None) -> "IndicatorState":
+        """
+        用一段历史收盘价初始化状态
+
+        Args:
+            close: 按时间排序的收盘价序列
+            volume: 可选的成交量序列
+
+        Returns:
+            已处理完整段历史的状态
+        """
+        state = cls()
+        volume = volume if volume is not None else np.full(len(close), np.nan)
+        for bar_close, bar_volume in zip(close, volume):
+            state.update(bar_close, bar_volume)
+        return state
@@ -0,0 +1,469 @@
+"""
+本地OHLCV列式存储
+
+每个股票代码对应一个目录，每一列保存为一个原始二进制文件（日期为int64纳秒时间戳，
+价格和成交量为float64），另有一个meta.json记录行数、时区和覆盖范围。
+
+- 读取时通过np.memmap映射文件，只复制时间段对应的切片，不需要把整段历史读入内存
+- 更新时只下载最后一根K线之后的数据并追加，最后一根K线（可能是未收盘的当日K线）会被覆盖
+- 出现分红或拆股时，复权价格会整体变化，此时重新下载全部历史
+- 同步和读取时除进程内的锁外还对目录中的锁文件加fcntl文件锁，多个应用进程共用同一目录时，
+  读取方不会看到另一个进程写了一半的列文件；返回的数组是持有锁时复制的，不受之后写入的影响
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+try:
+    import fcntl
+except ImportError:  # Windows上没有fcntl，只使用进程内的锁
+    fcntl = None
+
+logger = logging.getLogger("ohlcv_store")
+
+# 存储目录，可以通过环境变量覆盖
+DEFAULT_STORE_DIR = os.environ.get("OHLCV_STORE_DIR", os.path.join(".cache", "ohlcv"))
+
+# 距离上次同步不足该秒数时直接读取本地数据
+DEFAULT_REFRESH_INTERVAL = 15 * 60
+
+# 列名与文件名、数据类型的对应关系
+COLUMNS = {
+    "Open": ("open.f8", np.float64),
+    "High": ("high.f8", np.float64),
+    "Low": ("low.f8", np.float64),
+    "Close": ("close.f8", np.float64),
+    "Volume": ("volume.f8", np.float64),
+    "Dividends": ("dividends.f8", np.float64),
+    "Stock Splits": ("splits.f8", np.float64),
+}
+DATE_FILE = "date.i8"
+LOCK_FILE = ".lock"
+
+_PERIOD_PATTERN = re.compile(r"^(\d+)(d|wk|mo|y)$")
+
+# yfinance时间段至少包含的交易日数（按节假日较多的情况保守估计），按从短到长排列
+PERIOD_BARS = (
+    ("5d", 5),
+    ("1mo", 19),
+    ("3mo", 60),
+    ("6mo", 122),
+    ("1y", 248),
+    ("2y", 500),
+    ("5y", 1250),
+    ("10y", 2500),
+)
+
+
+def period_for_bars(bars: int) -> str:
+    """
+    返回至少包含bars根日K线的最短yfinance时间段
+
+    Args:
+        bars: 需要的K线数
+
+    Returns:
+        时间段字符串，超出10y时返回max
+    """
+    for period, count in PERIOD_BARS:
+        if count >= bars:
+            return period
+    return "max"
+
+
+def period_start(period: str, last_date: pd.Timestamp) -> Optional[pd.Timestamp]:
+    """
+    把yfinance的时间段字符串换算成起始日期
+
+    Args:
+        period: 时间段 (1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max)
+        last_date: 数据的最后日期，作为换算的基准
+
+    Returns:
+        起始日期；period为max时返回None
+    """
+    if period == "max":
+        return None
+    if period == "ytd":
+        return last_date.normalize().replace(month=1, day=1)
+
+    match = _PERIOD_PATTERN.match(period)
+    if not match:
+        raise ValueError(f"不支持的时间段: {period}")
+
+    count, unit = int(match.group(1)), match.group(2)
+    if unit == "d":
+        return last_date - pd.Timedelta(days=count)
+    if unit == "wk":
+        return last_date - pd.Timedelta(weeks=count)
+    if unit == "mo":
+        return last_date - pd.DateOffset(months=count)
+    return last_date - pd.DateOffset(years=count)
+
+
+def _to_epoch_ns(index: pd.DatetimeIndex) -> np.ndarray:
+    """把时间索引转换为UTC纳秒时间戳"""
+    if index.tz is not None:
+        index = index.tz_convert("UTC").tz_localize(None)
+    return np.asarray(index, dtype="datetime64[ns]").view(np.int64)
+
+
+class OHLCVStore:
+    """按股票代码组织的本地OHLCV列式存储，支持增量追加和内存映射读取"""
+
+    def __init__(self, root: str = DEFAULT_STORE_DIR,
+                 refresh_interval: float = DEFAULT_REFRESH_INTERVAL):
+        """
+        初始化存储
+
+        Args:
+            root: 存储根目录
+            refresh_interval: 两次向数据源同步之间的最短间隔（秒）
+        """
+        self.root = root
+        self.refresh_interval = refresh_interval
+        self._locks: Dict[str, threading.RLock] = {}
+        self._lock_depths: Dict[str, int] = {}
+        self._guard = threading.Lock()
+
+    def _lock(self, ticker_symbol: str) -> threading.RLock:
+        with self._guard:
+            return self._locks.setdefault(self._key(ticker_symbol), threading.RLock())
+
+    @contextmanager
+    def _locked(self, ticker_symbol: str, shared: bool = False) -> Iterator[None]:
+        """
+        持有进程内的线程锁和跨进程的文件锁
+
+        同一线程内可以重入，只有最外层加文件锁；shared为True时加共享锁，只用于读取。
+        """
+        key = self._key(ticker_symbol)
+        with self._lock(ticker_symbol):
+            depth = self._lock_depths.get(key, 0)
+            handle = None
+            directory = self._dir(ticker_symbol)
+            if depth == 0 and fcntl is not None and (not shared or os.path.isdir(directory)):
+                os.makedirs(directory, exist_ok=True)
+                handle = open(os.path.join(directory, LOCK_FILE), "a+b")
+                fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            self._lock_depths[key] = depth + 1
+            try:
+                yield
+            finally:
+                self._lock_depths[key] = depth
+                if handle is not None:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                    handle.close()
+
+    @staticmethod
+    def _key(ticker_symbol: str) -> str:
+        """把股票代码转换为安全的目录名"""
+        return re.sub(r"[^A-Za-z0-9.\-]", "_", ticker_symbol.upper())
+
+    def _dir(self, ticker_symbol: str) -> str:
+        return os.path.join(self.root, self._key(ticker_symbol))
+
+    def _read_meta(self, ticker_symbol: str) -> Dict[str, Any]:
+        path = os.path.join(self._dir(ticker_symbol), "meta.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"rows": 0}
+
+    def _write_meta(self, ticker_symbol: str, meta: Dict[str, Any]) -> None:
+        # 先写临时文件再替换，保证读取方看到的总是完整的meta
+        path = os.path.join(self._dir(ticker_symbol), "meta.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def _write_rows(self, ticker_symbol: str, df: pd.DataFrame, keep_rows: int) -> int:
+        """
+        保留前keep_rows行，把df追加到各列文件末尾
+
+        Returns:
+            写入后的总行数
+        """
+        directory = self._dir(ticker_symbol)
+        os.makedirs(directory, exist_ok=True)
+
+        columns = {DATE_FILE: (_to_epoch_ns(df.index), np.int64)}
+        for column, (file_name, dtype) in COLUMNS.items():
+            values = df[column].to_numpy() if column in df.columns else np.zeros(len(df))
+            columns[file_name] = (values, dtype)
+
+        for file_name, (values, dtype) in columns.items():
+            path = os.path.join(directory, file_name)
+            data = np.ascontiguousarray(values, dtype=dtype)
+            if keep_rows == 0:
+                # 整体重写时写入新文件再替换，已映射旧文件的读取方不受影响
+                with open(f"{path}.tmp", "wb") as f:
+                    data.tofile(f)
+                os.replace(f"{path}.tmp", path)
+            else:
+                # 增量写入只覆盖末尾并向后扩展，不截断文件，避免已映射区域失效
+                with open(path, "r+b") as f:
+                    f.seek(keep_rows * np.dtype(dtype).itemsize)
+                    data.tofile(f)
+
+        return keep_rows + len(df)
+
+    def read_arrays(self, ticker_symbol: str, period: str = "max") -> Dict[str, np.ndarray]:
+        """
+        读取本地数据，不触发网络请求
+
+        通过内存映射只读取时间段对应的切片，并在持有锁时复制，返回后其他进程的重写或追加
+        不会改变已返回的数组。
+
+        Args:
+            ticker_symbol: 股票代码
+            period: 时间段 (1d, 5d, 1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max)
+
+        Returns:
+            列名到数组的字典，Date列为UTC纳秒时间戳；没有数据时返回空字典
+        """
+        with self._locked(ticker_symbol, shared=True):
+            meta = self._read_meta(ticker_symbol)
+            rows = meta.get("rows", 0)
+            if rows == 0:
+                return {}
+
+            directory = self._dir(ticker_symbol)
+            dates = np.memmap(os.path.join(directory, DATE_FILE), dtype=np.int64,
+                              mode="r", shape=(rows,))
+            start = self._slice_start(dates, period)
+
+            arrays = {"Date": np.array(dates[start:])}
+            for column, (file_name, dtype) in COLUMNS.items():
+                values = np.memmap(os.path.join(directory, file_name), dtype=dtype,
+                                   mode="r", shape=(rows,))
+                arrays[column] = np.array(values[start:])
+            return arrays
+
+    @staticmethod
+    def _slice_start(dates: np.ndarray, period: str) -> int:
+        """返回时间段在日期数组中的起始位置"""
+        match = _PERIOD_PATTERN.match(period)
+        if match and match.group(2) == "d":
+            # 与yfinance一致，按交易日计数
+            return max(len(dates) - int(match.group(1)), 0)
+
+        start = period_start(period, pd.Timestamp(int(dates[-1])))
+        if start is None:
+            return 0
+        return int(np.searchsorted(dates, start.value, side="left"))
+
+    def read(self, ticker_symbol: str, period: str = "max") -> pd.DataFrame:
+        """
+        读取本地数据并组装为与ticker.history()相同格式的DataFrame
+
+        Args:
+            ticker_symbol: 股票代码
+            period: 时间段
+
+        Returns:
+            历史数据；没有本地数据时返回空DataFrame
+        """
+        # 数组和时区在同一次加锁内读取，避免中途被其他进程整体重写
+        with self._locked(ticker_symbol, shared=True):
+            arrays = self.read_arrays(ticker_symbol, period)
+            if not arrays:
+                return pd.DataFrame()
+            tz = self._read_meta(ticker_symbol).get("tz")
+
+        index = pd.to_datetime(arrays.pop("Date"), utc=tz is not None)
+        if tz is not None:
+            index = index.tz_convert(tz)
+        index.name = "Date"
+
+        return pd.DataFrame(arrays, index=index)
+
+    def last_trading_day(self, ticker_symbol: str) -> Optional[str]:
+        """
+        本地最后一根K线所在的交易日，按交易所时区计算，与上次同步的时间无关
+
+        Args:
+            ticker_symbol: 股票代码
+
+        Returns:
+            ISO格式的日期；没有本地数据时返回None
+        """
+        meta = self._read_meta(ticker_symbol)
+        if meta.get("rows", 0) == 0:
+            return None
+        last_bar = pd.Timestamp(meta["last_date"], tz="UTC")
+        if meta.get("tz") is not None:
+            last_bar = last_bar.tz_convert(meta["tz"])
+        return last_bar.date().isoformat()
+
+    def current_trading_day(self, ticker_symbol: str,
+                            ticker: Optional[yf.Ticker] = None) -> Optional[str]:
+        """
+        先同步已有的本地数据，再返回最后一根K线所在的交易日
+
+        在刷新间隔内同步过时不访问网络，否则只增量下载上次同步之后的K线；
+        同步失败时返回已存储的交易日。没有本地数据时不下载。
+
+        Args:
+            ticker_symbol: 股票代码
+            ticker: 可选的yf.Ticker对象，用于复用已有连接
+
+        Returns:
+            ISO格式的日期；没有本地数据时返回None
+        """
+        with self._locked(ticker_symbol):
+            meta = self._read_meta(ticker_symbol)
+            if meta.get("rows", 0) > 0 and self.fresh_last_date(ticker_symbol) is None:
+                try:
+                    self.update(ticker_symbol, meta.get("covered_period") or "max", ticker)
+                except Exception as e:
+                    logger.warning(f"{ticker_symbol} 同步失败，使用已存储的数据日期: {e}")
+            return self.last_trading_day(ticker_symbol)
+
+    def fresh_last_date(self, ticker_symbol: str) -> Optional[int]:
+        """
+        本地数据在刷新间隔内同步过时，返回最后一根K线的UTC纳秒时间戳
+
+        Args:
+            ticker_symbol: 股票代码
+
+        Returns:
+            最后一根K线的时间戳；没有数据或需要重新同步时返回None
+        """
+        meta = self._read_meta(ticker_symbol)
+        if meta.get("rows", 0) == 0:
+            return None
+        if time.time() - meta.get("synced_at", 0) >= self.refresh_interval:
+            return None
+        return meta["last_date"]
+
+    def update(self, ticker_symbol: str, period: str = "1y",
+               ticker: Optional[yf.Ticker] = None) -> int:
+        """
+        确保本地数据覆盖period，并追加自上次同步以来的新K线
+
+        Args:
+            ticker_symbol: 股票代码
+            period: 需要覆盖的时间段
+            ticker: 可选的yf.Ticker对象，用于复用已有连接
+
+        Returns:
+            本次写入的行数
+        """
+        with self._locked(ticker_symbol):
+            meta = self._read_meta(ticker_symbol)
+            rows = meta.get("rows", 0)
+
+            if rows > 0 and not self._needs_full_fetch(meta, period):
+                if time.time() - meta.get("synced_at", 0) < self.refresh_interval:
+                    return 0
+                return self._append_missing(ticker_symbol, meta, ticker)
+
+            ticker = ticker or yf.Ticker(ticker_symbol)
+            hist = ticker.history(period=period)
+            if hist.empty:
+                return 0
+            return self._replace_all(ticker_symbol, hist, period)
+
+    def _needs_full_fetch(self, meta: Dict[str, Any], period: str) -> bool:
+        """判断本地数据的起点是否早于period要求的起点"""
+        covered = meta.get("covered_period")
+        if covered == "max":
+            return False
+        if period == "max":
+            return True
+        last_date = pd.Timestamp(meta["last_date"])
+        covered_start = meta.get("covered_start")
+        required = period_start(period, last_date)
+        return covered_start is None or required.value < covered_start
+
+    def _replace_all(self, ticker_symbol: str, hist: pd.DataFrame, period: str) -> int:
+        rows = self._write_rows(ticker_symbol, hist, keep_rows=0)
+        last_date = pd.Timestamp(int(_to_epoch_ns(hist.index)[-1]))
+        start = period_start(period, last_date)
+        self._write_meta(ticker_symbol, {
+            "rows": rows,
+            "tz": str(hist.index.tz) if hist.index.tz is not None else None,
+            "covered_period": period,
+            "covered_start": start.value if start is not None else None,
+            "last_date": last_date.value,
+            "synced_at": time.time(),
+        })
+        return rows
+
+    def _append_missing(self, ticker_symbol: str, meta: Dict[str, Any],
+                        ticker: Optional[yf.Ticker]) -> int:
+        """下载最后一根K线及之后的数据，覆盖最后一行并追加新行"""
+        ticker = ticker or yf.Ticker(ticker_symbol)
+        last_date = pd.Timestamp(meta["last_date"], tz="UTC")
+        if meta.get("tz"):
+            last_date = last_date.tz_convert(meta["tz"])
+        fresh = ticker.history(start=last_date.strftime("%Y-%m-%d"))
+        if not fresh.empty:
+            fresh = fresh[_to_epoch_ns(fresh.index) >= meta["last_date"]]
+
+        if fresh.empty:
+            meta["synced_at"] = time.time()
+            self._write_meta(ticker_symbol, meta)
+            return 0
+
+        # 新K线中出现分红或拆股，历史复权价格已变化，需要整体重新下载；
+        # 与已存储的最后一根K线重叠的行在上次同步时已经检查过，不再计入
+        new_rows = fresh[_to_epoch_ns(fresh.index) > meta["last_date"]]
+        events = new_rows.reindex(columns=["Dividends", "Stock Splits"]).fillna(0)
+        if (events.to_numpy() != 0).any():
+            logger.info(f"{ticker_symbol} 出现分红或拆股，重新下载全部历史")
+            hist = ticker.history(period=meta.get("covered_period") or "max")
+            return self._replace_all(ticker_symbol, hist, meta.get("covered_period") or "max")
+
+        # 最后一根K线可能在上次同步时尚未收盘，重新下载后覆盖
+        overlaps = int(_to_epoch_ns(fresh.index)[0]) == meta["last_date"]
+        keep_rows = meta["rows"] - 1 if overlaps else meta["rows"]
+
+        meta["rows"] = self._write_rows(ticker_symbol, fresh, keep_rows)
+        meta["last_date"] = int(_to_epoch_ns(fresh.index)[-1])
+        meta["synced_at"] = time.time()
+        self._write_meta(ticker_symbol, meta)
+        return len(fresh) - int(overlaps)
+
+    def history(self, ticker_symbol: str, period: str = "1y",
+                ticker: Optional[yf.Ticker] = None) -> pd.DataFrame:
+        """
+        获取历史数据：先增量同步，再从本地读取
+
+        Args:
+            ticker_symbol: 股票代码
+            period: 时间段
+            ticker: 可选的yf.Ticker对象
+
+        Returns:
+            与ticker.history(period=period)格式相同的DataFrame
+        """
+        with self._locked(ticker_symbol):
+            self.update(ticker_symbol, period, ticker)
+            return self.read(ticker_symbol, period)
+
+
+_default_store: Optional[OHLCVStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store() -> OHLCVStore:
+    """返回进程内共享的默认存储实例"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = OHLCVStore()
+        return _default_store
@@ -0,0 +1,241 @@
+"""
+投资报告的本地渲染
+
+报告中以数字为主的部分（标题行、公司概况、财务数据、技术指标和同业比较）直接由
+prefetch_analysis_data返回的工具数据生成Markdown表格，LLM只撰写NARRATIVE_SECTIONS
+中的文字部分，最后由render_report按固定顺序合并为完整报告。
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# LLM撰写的文字部分：二级标题及写作要求，报告按此顺序引用
+NARRATIVE_SECTIONS = {
+    "投资要点": "3-5个关键投资理由或风险因素",
+    "财务分析": "解读关键财务指标及趋势，不要重复列出数据表",
+    "技术分析": "解读价格走势和技术指标，不要重复列出指标数值表",
+    "风险因素": "列出潜在风险和不确定性",
+    "投资建议": "第一行写\"投资建议：买入/持有/卖出\"，然后注明目标价位和理由",
+}
+
+# 从投资建议中识别的评级
+RATINGS = ("买入", "增持", "持有", "减持", "卖出")
+
+# 公司简介在概况中保留的最大字符数
+SUMMARY_MAX_CHARS = 300
+
+_SECTION_PATTERN = re.compile(r"^##\s+(.+?)\s*$", re.MULTILINE)
+_RATING_PATTERN = re.compile("|".join(RATINGS))
+
+# 技术指标的显示名称和小数位数
+_INDICATOR_LABELS = (
+    ("current_price", "收盘价", 2),
+    ("sma20", "SMA20", 2),
+    ("sma50", "SMA50", 2),
+    ("sma200", "SMA200", 2),
+    ("rsi", "RSI(14)", 2),
+    ("macd", "MACD", 3),
+    ("signal_line", "信号线", 3),
+    ("macd_histogram", "MACD柱", 3),
+    ("volume", "成交量", 0),
+)
+
+_SIGNAL_LABELS = {
+    "price_above_sma20": "价格高于SMA20",
+    "price_above_sma50": "价格高于SMA50",
+    "price_above_sma200": "价格高于SMA200",
+    "sma20_above_sma50": "SMA20高于SMA50",
+    "rsi_oversold": "RSI超卖（<30）",
+    "rsi_overbought": "RSI超买（>70）",
+    "macd_above_signal": "MACD高于信号线",
+}
+
+
+def format_number(value: Any, digits: int = 2, zero_as_missing: bool = False) -> str:
+    """
+    格式化数值，绝对值超过一亿时以"亿"为单位
+
+    Args:
+        value: 数值，非数值原样转为字符串
+        digits: 保留的小数位数
+        zero_as_missing: 是否把0视为缺失值，工具方法在数据缺失时返回0
+
+    Returns:
+        格式化后的字符串，缺失值为"-"
+    """
+    if value is None or isinstance(value, bool):
+        return "-" if value is None else ("是" if value else "否")
+    if not isinstance(value, (int, float)):
+        return str(value)
+    if value != value or (zero_as_missing and value == 0):  # NaN或视为缺失的0
+        return "-"
+    if abs(value) >= 1e8:
+        return f"{value / 1e8:,.{digits}f}亿"
+    return f"{value:,.{digits}f}"
+
+
+def markdown_table(headers: Sequence[str], rows: List[Sequence[Any]]) -> str:
+    """生成Markdown表格，单元格中的竖线会被转义"""
+    def cell(value: Any) -> str:
+        return str(value).replace("|", "\\|").replace("\n", " ")
+
+    lines = [
+        "| " + " | ".join(cell(header) for header in headers) + " |",
+        "| " + " | ".join("---" for _ in headers) + " |",
+    ]
+    lines.extend("| " + " | ".join(cell(value) for value in row) + " |" for row in rows)
+    return "\n".join(lines)
+
+
+def _valid(section: Any) -> bool:
+    return isinstance(section, dict) and bool(section) and "error" not in section
+
+
+def split_sections(narrative: str) -> Tuple[str, Dict[str, str]]:
+    """
+    按二级标题拆分LLM撰写的文字
+
+    Args:
+        narrative: LLM输出的Markdown
+
+    Returns:
+        (第一个二级标题之前的文字, 标题到正文的有序字典)
+    """
+    matches = list(_SECTION_PATTERN.finditer(narrative))
+    if not matches:
+        return narrative.strip(), {}
+    sections = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        end = following.start() if following else len(narrative)
+        sections[match.group(1)] = narrative[match.end():end].strip()
+    return narrative[:matches[0].start()].strip(), sections
+
+
+def extract_rating(text: str) -> Optional[str]:
+    """从投资建议中识别评级，未找到时返回None"""
+    match = _RATING_PATTERN.search(text or "")
+    return match.group(0) if match else None
+
+
+def render_title(ticker_symbol: str, data: Dict[str, Any], rating: Optional[str]) -> str:
+    """报告标题及当前股价、评级"""
+    info = data.get("stock_info")
+    name = info.get("longName") if _valid(info) else None
+    title = f"# {name}（{ticker_symbol}）投资分析报告" if name and name != "未知" \
+        else f"# {ticker_symbol} 投资分析报告"
+    facts = []
+    if _valid(info) and info.get("currentPrice"):
+        facts.append(f"当前股价：{format_number(info['currentPrice'])} {info.get('currency', '')}")
+    if rating:
+        facts.append(f"投资建议：**{rating}**")
+    return title + ("\n\n" + " | ".join(facts) if facts else "")
+
+
+def render_company_profile(data: Dict[str, Any]) -> str:
+    """公司概况表"""
+    info = data.get("stock_info")
+    if not _valid(info):
+        return "*公司基本信息获取失败*"
+    def number(key: str) -> str:
+        return format_number(info.get(key), zero_as_missing=True)
+
+    rows = [
+        ("行业", f"{info.get('sector', '-')} / {info.get('industry', '-')}"),
+        ("市值", number("marketCap")),
+        ("市盈率（TTM / 预期）", f"{number('trailingPE')} / {number('forwardPE')}"),
+        ("股息率（%）", format_number(info.get("dividendYield"))),
+        ("52周区间", f"{number('fiftyTwoWeekLow')} ~ {number('fiftyTwoWeekHigh')}"),
+        ("Beta", number("beta")),
+    ]
+    table = markdown_table(("项目", "数值"), rows)
+    summary = info.get("businessSummary") or ""
+    if summary and summary != "无数据":
+        if len(summary) > SUMMARY_MAX_CHARS:
+            summary = summary[:SUMMARY_MAX_CHARS] + "..."
+        table += f"\n\n{summary}"
+    return table
+
+
+def render_financials(data: Dict[str, Any]) -> str:
+    """三张报表最近一期的关键指标"""
+    financials = data.get("financial_data")
+    if not _valid(financials):
+        return "*财务数据获取失败*"
+    rows = [
+        (statement, item, format_number(value, zero_as_missing=True))
+        for statement, items in financials.items() if isinstance(items, dict)
+        for item, value in items.items()
+    ]
+    if not rows:
+        return "*暂无财务数据*"
+    return markdown_table(("报表", "项目", "最近一期"), rows)
+
+
+def render_technicals(data: Dict[str, Any]) -> str:
+    """技术指标的最新值和趋势信号"""
+    technicals = data.get("technical_indicators")
+    if not _valid(technicals):
+        return "*技术指标计算失败*"
+    rows = [(label, format_number(technicals[key], digits)) for key, label, digits
+            in _INDICATOR_LABELS if key in technicals]
+    table = markdown_table(("指标", "最新值"), rows)
+    signals = technicals.get("trend_signals") or {}
+    if signals:
+        table += "\n\n" + markdown_table(
+            ("信号", "状态"),
+            [(_SIGNAL_LABELS.get(name, name), "✅" if value else "—")
+             for name, value in signals.items()],
+        )
+    return table
+
+
+def render_peer_comparison(data: Dict[str, Any]) -> str:
+    """与行业平均的比较"""
+    peers = data.get("peer_comparison")
+    if not _valid(peers):
+        return "*同业比较数据获取失败*"
+    def number(key: str) -> str:
+        return format_number(peers.get(key), zero_as_missing=True)
+
+    rows = [
+        ("市盈率", number("pe_ratio"), number("industry_avg_pe")),
+        ("市净率", number("price_to_book"), number("industry_avg_pb")),
+        ("利润率（%）", number("profit_margin"), number("industry_avg_profit_margin")),
+    ]
+    return markdown_table(("指标", "公司", "行业平均"), rows)
+
+
+def render_report(ticker_symbol: str, data: Dict[str, Any], narrative: str) -> str:
+    """
+    合并本地生成的数据部分和LLM撰写的文字部分
+
+    Args:
+        ticker_symbol: 股票代码
+        data: prefetch_analysis_data的返回值
+        narrative: LLM按NARRATIVE_SECTIONS的标题撰写的Markdown
+
+    Returns:
+        完整的Markdown报告；LLM输出中无法识别的二级标题附在报告末尾，
+        输出中没有任何二级标题时全文附在末尾
+    """
+    preamble, sections = split_sections(narrative)
+    matched = bool(sections)
+    rating = extract_rating(sections.get("投资建议", ""))
+
+    def narrative_section(name: str) -> str:
+        return sections.pop(name, "")
+
+    parts = [
+        render_title(ticker_symbol, data, rating),
+        "## 公司概况\n\n" + render_company_profile(data),
+        "## 投资要点\n\n" + narrative_section("投资要点"),
+        "## 财务分析\n\n" + render_financials(data) + "\n\n" + narrative_section("财务分析"),
+        "## 技术分析\n\n" + render_technicals(data) + "\n\n" + narrative_section("技术分析"),
+        "## 同业比较\n\n" + render_peer_comparison(data),
+        "## 风险因素\n\n" + narrative_section("风险因素"),
+        "## 投资建议\n\n" + narrative_section("投资建议"),
+    ]
+    # 有二级标题时，第一个标题之前通常是"以下是报告"之类的过渡语，直接丢弃
+    extra = [preamble] if preamble and not matched else []
+    extra.extend(f"## {name}\n\n{body}" for name, body in sections.items())
+    return "\n\n".join(part.strip() for part in parts + extra) + "\n"
@@ -0,0 +1,244 @@
+"""
+分析报告的持久化存储
+
+生成的报告按(股票代码, 交易日, 模型, 提示词版本)保存在SQLite（WAL模式）中，
+同一交易日内再次分析同一股票时可以直接返回已保存的报告，不必重新调用LLM。
+报告全文建有FTS5索引，可以按关键词检索历史报告；SQLite不支持FTS5时退化为LIKE查询。
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from sqlite_patch import apply_sqlite_patch
+
+# 系统SQLite版本过低时换用pysqlite3，必须在导入sqlite3之前执行
+apply_sqlite_patch()
+import sqlite3
+
+logger = logging.getLogger("report_store")
+
+# 报告库的默认位置
+DEFAULT_REPORT_STORE_PATH = os.environ.get(
+    "REPORT_STORE_PATH", os.path.join(".cache", "reports.sqlite3")
+)
+# 已保存报告直接复用的最长时间（秒），超过后即使是同一交易日也重新生成
+DEFAULT_REPORT_MAX_AGE = float(os.environ.get("REPORT_MAX_AGE", 6 * 60 * 60))
+# 最多保存的报告数，超出时删除最早生成的报告
+DEFAULT_MAX_REPORTS = int(os.environ.get("REPORT_STORE_MAX_REPORTS", 5000))
+
+# 全文索引的分词器，trigram支持中文子串检索（SQLite 3.34+），不可用时依次退化
+_FTS_TOKENIZERS = ("trigram", "unicode61")
+
+
+class ReportStore:
+    """基于SQLite的报告库，支持按键读取最近的报告和全文检索"""
+
+    def __init__(self, path: str = DEFAULT_REPORT_STORE_PATH,
+                 max_age: float = DEFAULT_REPORT_MAX_AGE,
+                 max_reports: int = DEFAULT_MAX_REPORTS):
+        """
+        初始化报告库
+
+        Args:
+            path: SQLite数据库文件路径
+            max_age: 报告可直接复用的最长时间（秒）
+            max_reports: 最多保存的报告数
+        """
+        self.path = path
+        self.max_age = max_age
+        self.max_reports = max_reports
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS reports ("
+            "id INTEGER PRIMARY KEY, ticker TEXT NOT NULL, trading_day TEXT NOT NULL, "
+            "model TEXT NOT NULL, prompt_version TEXT NOT NULL, report TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS reports_key "
+            "ON reports (ticker, trading_day, model, prompt_version)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS reports_created ON reports (created_at)"
+        )
+        self.fts_enabled = self._create_fts()
+
+    def _create_fts(self) -> bool:
+        """创建与reports同步的外部内容全文索引，返回是否可用"""
+        for tokenizer in _FTS_TOKENIZERS:
+            try:
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5("
+                    "ticker, report, content='reports', content_rowid='id', "
+                    f"tokenize='{tokenizer}')"
+                )
+                break
+            except sqlite3.OperationalError:
+                continue
+        else:
+            logger.warning("当前SQLite不支持FTS5，报告检索退化为LIKE查询")
+            return False
+
+        # 用触发器保持全文索引与报告表同步
+        self._conn.executescript("""
+            CREATE TRIGGER IF NOT EXISTS reports_ai AFTER INSERT ON reports BEGIN
+                INSERT INTO reports_fts (rowid, ticker, report)
+                VALUES (new.id, new.ticker, new.report);
+            END;
+            CREATE TRIGGER IF NOT EXISTS reports_ad AFTER DELETE ON reports BEGIN
+                INSERT INTO reports_fts (reports_fts, rowid, ticker, report)
+                VALUES ('delete', old.id, old.ticker, old.report);
+            END;
+        """)
+        # 早期版本用INSERT OR REPLACE覆盖报告，会在索引中留下孤立的行，发现时重建索引；
+        # rank为1时integrity-check同时核对索引与报告表的内容
+        try:
+            self._conn.execute(
+                "INSERT INTO reports_fts (reports_fts, rank) VALUES ('integrity-check', 1)"
+            )
+        except sqlite3.DatabaseError:
+            logger.warning("报告全文索引与报告表不一致，正在重建")
+            self._conn.execute("INSERT INTO reports_fts (reports_fts) VALUES ('rebuild')")
+        return True
+
+    def get(self, ticker_symbol: str, trading_day: str, model: str, prompt_version: str,
+            max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        读取已保存的报告
+
+        Args:
+            ticker_symbol: 股票代码
+            trading_day: 报告所用数据的交易日
+            model: 生成报告的模型
+            prompt_version: 提示词版本
+            max_age: 可复用的最长时间（秒），默认使用初始化时的设置
+
+        Returns:
+            {"report": 报告文本, "created_at": 生成时间戳}，不存在或已过期时返回None
+        """
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT report, created_at FROM reports WHERE ticker = ? AND trading_day = ? "
+                "AND model = ? AND prompt_version = ?",
+                (ticker_symbol.upper(), trading_day, model, prompt_version),
+            ).fetchone()
+            if row is None or time.time() - row[1] >= max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {"report": row[0], "created_at": row[1]}
+
+    def put(self, ticker_symbol: str, trading_day: str, model: str, prompt_version: str,
+            report: str) -> None:
+        """
+        保存报告，相同键的旧报告被替换；超出数量上限时删除最早生成的报告
+
+        Args:
+            ticker_symbol: 股票代码
+            trading_day: 报告所用数据的交易日
+            model: 生成报告的模型
+            prompt_version: 提示词版本
+            report: 报告文本
+        """
+        key = (ticker_symbol.upper(), trading_day, model, prompt_version)
+        with self._lock:
+            # 先显式删除旧报告再插入，删除和插入触发器都会执行，全文索引保持同步；
+            # INSERT OR REPLACE隐式删除旧行时不会执行删除触发器
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM reports WHERE ticker = ? AND trading_day = ? AND model = ? "
+                    "AND prompt_version = ?",
+                    key,
+                )
+                self._conn.execute(
+                    "INSERT INTO reports "
+                    "(ticker, trading_day, model, prompt_version, report, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    key + (report, time.time()),
+                )
+                self._conn.execute(
+                    "DELETE FROM reports WHERE id IN (SELECT id FROM reports "
+                    "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_reports,),
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        按关键词检索报告全文
+
+        Args:
+            query: 关键词，按短语匹配
+            limit: 最多返回的报告数
+
+        Returns:
+            按相关度（不支持全文索引时按生成时间）排序的列表，每项包含ticker、trading_day、
+            model、prompt_version、created_at和snippet（命中位置附近的片段）
+        """
+        query = query.strip()
+        if not query:
+            return []
+        columns = "r.ticker, r.trading_day, r.model, r.prompt_version, r.created_at"
+        with self._lock:
+            # trigram分词器要求关键词至少3个字符，更短时同样用LIKE查询
+            if self.fts_enabled and len(query) >= 3:
+                phrase = '"' + query.replace('"', '""') + '"'
+                rows = self._conn.execute(
+                    f"SELECT {columns}, snippet(reports_fts, 1, '**', '**', '...', 16) "
+                    "FROM reports_fts JOIN reports r ON r.id = reports_fts.rowid "
+                    "WHERE reports_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (phrase, limit),
+                ).fetchall()
+            else:
+                pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%") \
+                    .replace("_", "\\_") + "%"
+                rows = self._conn.execute(
+                    f"SELECT {columns}, substr(r.report, 1, 120) FROM reports r "
+                    "WHERE r.report LIKE ? ESCAPE '\\' OR r.ticker LIKE ? ESCAPE '\\' "
+                    "ORDER BY r.created_at DESC LIMIT ?",
+                    (pattern, pattern, limit),
+                ).fetchall()
+        keys = ("ticker", "trading_day", "model", "prompt_version", "created_at", "snippet")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        """返回报告数和复用命中率"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "fts": self.fts_enabled,
+            }
+
+
+_default_report_store: Optional[ReportStore] = None
+_default_report_store_lock = threading.Lock()
+
+
+def get_default_report_store() -> ReportStore:
+    """返回进程内共享的默认报告库"""
+    global _default_report_store
+    with _default_report_store_lock:
+        if _default_report_store is None:
+            _default_report_store = ReportStore()
+        return _default_report_store
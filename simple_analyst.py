@@ -1,15 +1,25 @@
 import streamlit as st
 import os
+import time
 import yfinance as yf
 import json
+from datetime import date
+
+from caching import SingleFlight
 
 # 尝试导入自定义的DeepSeek API
 try:
-    from deepseek_api import DeepSeekAPI
+    from deepseek_api import DeepSeekAPI, load_model_tiers
 except ImportError:
     # 如果没有，则定义一个简单版本
     import requests
     
+    def load_model_tiers():
+        return {
+            "reasoning": {"model": "deepseek-reasoner", "max_tokens": 4000, "temperature": 0.7},
+            "fast": {"model": "deepseek-chat", "max_tokens": 4000, "temperature": 0.7},
+        }
+    
     class DeepSeekAPI:
         def __init__(self, api_key=None):
             self.api_key = api_key or os.environ.get("DEEPSEEK_API_KEY")
@@ -19,7 +29,8 @@ except ImportError:
                 "Authorization": f"Bearer {self.api_key}"
             }
         
-        def chat(self, messages, model="deepseek-reasoner", temperature=0.7, max_tokens=4000, **kwargs):
+        def chat(self, messages, model="deepseek-reasoner", temperature=0.7, max_tokens=4000,
+                 stream=False, **kwargs):
             url = f"{self.base_url}/chat/completions"
             
             data = {
@@ -27,12 +38,32 @@ except ImportError:
                 "messages": messages,
                 "temperature": temperature,
                 "max_tokens": max_tokens,
+                "stream": stream,
                 **kwargs
             }
             
-            response = requests.post(url, headers=self.headers, json=data)
+            response = requests.post(url, headers=self.headers, json=data, stream=stream)
             response.raise_for_status()
+            if stream:
+                return self._iter_chunks(response)
             return response.json()
+        
+        @staticmethod
+        def _iter_chunks(response):
+            # 解析SSE流，每行"data: {...}"为一个响应块
+            for line in response.iter_lines():
+                line = line.decode("utf-8") if line else ""
+                if not line.startswith("data: "):
+                    continue
+                if line == "data: [DONE]":
+                    break
+                yield json.loads(line[6:])
+
+# 分析使用的模型级别，可通过环境变量SIMPLE_ANALYST_TIER切换，如fast使用deepseek-chat
+ANALYSIS_TIER = os.environ.get("SIMPLE_ANALYST_TIER", "reasoning")
+
+# 合并多个会话对同一股票、同一天的并发分析，只执行一次并共享报告
+ANALYSIS_FLIGHTS = SingleFlight()
 
 # 设置 Streamlit 页面
 st.set_page_config(
@@ -87,19 +118,8 @@ def get_stock_data(ticker_symbol):
     except Exception as e:
         return {"错误": str(e)}
 
-# 分析股票
-def analyze_stock(ticker_symbol, api_key):
-    # 获取股票数据
-    stock_data = get_stock_data(ticker_symbol)
-    
-    # 如果出错，返回错误信息
-    if "错误" in stock_data:
-        return f"获取股票数据时出错: {stock_data['错误']}"
-    
-    # 创建 DeepSeek API 客户端
-    deepseek = DeepSeekAPI(api_key=api_key)
-    
-    # 构建提示
+# 构建分析提示
+def build_messages(ticker_symbol, stock_data):
     stock_info = json.dumps(stock_data, ensure_ascii=False, indent=2)
     
     system_message = """你是一位专业的股票分析师，需要基于提供的股票数据生成专业的投资分析报告。
@@ -120,18 +140,37 @@ def analyze_stock(ticker_symbol, api_key):
 
 根据这些数据进行分析，给出专业的投资建议。"""
     
-    messages = [
+    return [
         {"role": "system", "content": system_message},
         {"role": "user", "content": user_message}
     ]
+
+# 合并并发分析的键：股票代码和当天日期
+def analysis_key(ticker_symbol):
+    return (ticker_symbol.upper(), date.today().isoformat())
+
+# 分析股票，同时到达的相同请求共享同一次执行的结果
+def analyze_stock(ticker_symbol, api_key):
+    return ANALYSIS_FLIGHTS.do(analysis_key(ticker_symbol),
+                               lambda: run_analysis(ticker_symbol, api_key))
+
+# 执行分析
+def run_analysis(ticker_symbol, api_key):
+    # 获取股票数据
+    stock_data = get_stock_data(ticker_symbol)
+    
+    # 如果出错，返回错误信息
+    if "错误" in stock_data:
+        return f"获取股票数据时出错: {stock_data['错误']}"
+    
+    # 创建 DeepSeek API 客户端
+    deepseek = DeepSeekAPI(api_key=api_key)
     
     # 调用 DeepSeek API
     try:
         response = deepseek.chat(
-            messages=messages,
-            model="deepseek-reasoner",
-            temperature=0.7,
-            max_tokens=4000
+            messages=build_messages(ticker_symbol, stock_data),
+            **load_model_tiers()[ANALYSIS_TIER]
         )
         
         # 提取回复内容
@@ -139,6 +178,37 @@ def analyze_stock(ticker_symbol, api_key):
     except Exception as e:
         return f"分析过程中出错: {str(e)}"
 
+# 流式分析股票，同时到达的相同请求共享同一个事件序列
+def analyze_stock_stream(ticker_symbol, api_key):
+    """
+    产生{"type": "reasoning"|"content"|"error", "text": 文本}事件
+    """
+    return ANALYSIS_FLIGHTS.stream(analysis_key(ticker_symbol),
+                                   lambda: run_analysis_stream(ticker_symbol, api_key))
+
+# 流式执行分析，逐步返回思考过程和报告内容
+def run_analysis_stream(ticker_symbol, api_key):
+    stock_data = get_stock_data(ticker_symbol)
+    if "错误" in stock_data:
+        yield {"type": "error", "text": f"获取股票数据时出错: {stock_data['错误']}"}
+        return
+    
+    deepseek = DeepSeekAPI(api_key=api_key)
+    try:
+        stream = deepseek.chat(
+            messages=build_messages(ticker_symbol, stock_data),
+            stream=True,
+            **load_model_tiers()[ANALYSIS_TIER]
+        )
+        for chunk in stream:
+            delta = (chunk.get("choices") or [{}])[0].get("delta") or {}
+            if delta.get("reasoning_content"):
+                yield {"type": "reasoning", "text": delta["reasoning_content"]}
+            if delta.get("content"):
+                yield {"type": "content", "text": delta["content"]}
+    except Exception as e:
+        yield {"type": "error", "text": f"分析过程中出错: {str(e)}"}
+
 # 主应用
 def main():
     # 获取 API 密钥
@@ -158,12 +228,36 @@ def main():
     
     # 当用户提交股票代码
     if submit_button and ticker_symbol:
-        with st.spinner(f"正在分析 {ticker_symbol} 股票..."):
-            report = analyze_stock(ticker_symbol, api_key)
+        status = st.empty()
+        status.info(f"正在分析 {ticker_symbol} 股票...")
+        with st.expander("🧠 思考过程", expanded=False):
+            reasoning_placeholder = st.empty()
         
-        # 显示报告
+        # 边生成边显示报告
         st.markdown("## 📝 AI分析报告")
-        st.markdown(report)
+        report_placeholder = st.empty()
+        reasoning = ""
+        report = ""
+        last_render = 0.0
+        for event in analyze_stock_stream(ticker_symbol, api_key):
+            if event["type"] == "error":
+                report = event["text"]
+                st.error(report)
+                break
+            if event["type"] == "reasoning":
+                reasoning += event["text"]
+            else:
+                report += event["text"]
+            
+            # 限制刷新频率，避免每个token都重绘页面
+            if time.time() - last_render >= 0.1:
+                reasoning_placeholder.markdown(reasoning)
+                report_placeholder.markdown(report)
+                last_render = time.time()
+        
+        status.empty()
+        reasoning_placeholder.markdown(reasoning)
+        report_placeholder.markdown(report)
         
         # 提供下载选项
         st.download_button(
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from caching import LRUCache, ResponseCache, SharedCache, SingleFlight, TieredTTLCache
+
+
+@pytest.fixture
+def response_cache(tmp_path):
+    return ResponseCache(str(tmp_path / "responses.sqlite3"), ttl=3600)
+
+
+def test_make_key_ignores_dict_order():
+    first = ResponseCache.make_key("deepseek-chat", {"a": 1, "b": [1, 2]}, 0.7)
+    second = ResponseCache.make_key("deepseek-chat", {"b": [1, 2], "a": 1}, 0.7)
+
+    assert first == second
+    assert first != ResponseCache.make_key("deepseek-chat", {"a": 1, "b": [2, 1]}, 0.7)
+    assert first != ResponseCache.make_key("deepseek-reasoner", {"a": 1, "b": [1, 2]}, 0.7)
+
+
+def test_response_cache_round_trip_and_expiry(response_cache):
+    key = ResponseCache.make_key("q")
+    response_cache.put(key, {"choices": [{"message": {"content": "回复"}}]})
+
+    assert response_cache.get(key) == {"choices": [{"message": {"content": "回复"}}]}
+
+    response_cache.ttl = 0
+    assert response_cache.get(key) is None
+    assert response_cache.stats()["entries"] == 0
+
+
+def test_lru_cache_spills_evicted_entries_and_reads_them_back(tmp_path):
+    cache = LRUCache(max_bytes=10, spill_dir=str(tmp_path))
+    cache.put("a", "aaaaaa")
+    cache.put("b", "bbbbbb")
+
+    assert cache.stats()["spilled_entries"] == 1
+    assert cache.get("a") == "aaaaaa"
+    assert cache.stats()["spill_hits"] == 1
+    assert cache.get("c") is None
+
+
+def test_lru_cache_reuses_spilled_files_after_restart(tmp_path):
+    cache = LRUCache(max_bytes=10, spill_dir=str(tmp_path))
+    cache.put("a", "aaaaaa")
+    cache.put("b", "bbbbbb")
+
+    restarted = LRUCache(max_bytes=10, spill_dir=str(tmp_path))
+
+    assert restarted.stats()["spilled_entries"] == 1
+    assert restarted.get("a") == "aaaaaa"
+    assert os.listdir(tmp_path) == []
+
+
+def test_lru_cache_bounds_spill_directory_across_restarts(tmp_path):
+    # 每次写入都把上一个条目挤出内存
+    for round_index in range(5):
+        cache = LRUCache(max_bytes=50, spill_dir=str(tmp_path), max_spill_bytes=200)
+        for index in range(10):
+            cache.put(f"{round_index}-{index}", os.urandom(20).hex())
+
+    restarted = LRUCache(max_bytes=50, spill_dir=str(tmp_path), max_spill_bytes=200)
+    on_disk = sum(entry.stat().st_size for entry in os.scandir(tmp_path))
+
+    assert on_disk <= 200
+    assert restarted.stats()["spilled_bytes"] == on_disk
+
+
+def test_shared_cache_round_trips_dataframes_between_instances(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    frame = pd.DataFrame({"Close": [1.0, 2.0]}, index=pd.date_range("2026-10-15", periods=2))
+    SharedCache(path).put("AAPL", frame)
+
+    value, _ = SharedCache(path).get("AAPL", max_age=60)
+
+    pd.testing.assert_frame_equal(value, frame)
+    assert SharedCache(path).get("AAPL", max_age=0) is None
+
+
+def test_shared_cache_load_calls_loader_once(tmp_path):
+    cache = SharedCache(str(tmp_path / "shared.sqlite3"))
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return "value"
+
+    assert cache.load("key", loader, max_age=60)[0] == "value"
+    assert cache.load("key", loader, max_age=60)[0] == "value"
+    assert len(calls) == 1
+
+
+def test_shared_cache_loads_once_per_process_after_lease_times_out(tmp_path):
+    path = str(tmp_path / "shared.sqlite3")
+    # 另一个进程取得租约后没有写入
+    assert SharedCache(path, lease_seconds=60)._try_lease("key")
+    cache = SharedCache(path, lease_seconds=0.3)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.2)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.load("key", loader, 60)[0]))
+               for _ in range(4)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["value"] * 4
+    assert len(calls) == 1
+    assert 0.3 <= time.time() - started < 5
+    assert cache.stats()["waits"] == 3
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("AAPL", slow)))
+               for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    deadline = time.time() + 5
+    while flight.coalesced < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["result"] * 4
+    assert len(calls) == 1
+
+
+def test_tiered_cache_serves_stale_value_while_refreshing():
+    cache = TieredTTLCache({"price": {"open": 60, "closed": 600, "stale": 60}})
+    loader = iter(["old", "new"]).__next__
+
+    assert cache.get("price", "AAPL", loader) == "old"
+    cache._entries[("price", "AAPL")] = ("old", time.time() - 90)
+    assert cache.get("price", "AAPL", loader) == "old"
+
+    deadline = time.time() + 5
+    while cache.stats()["price"]["refreshes"] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert cache.get("price", "AAPL", loader) == "new"
+    assert cache.stats()["price"]["stale_hits"] == 1
@@ -0,0 +1,612 @@
+import asyncio
+import io
+import json
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import deepseek_api
+from caching import ResponseCache
+from deepseek_api import (DEFAULT_MODEL_TIER, MODEL_TIERS, TOOL_CALLING_MODEL, Agent,
+                          AsyncDeepSeekAPI, Crew, DeepSeekAPI, LLMScheduler, OpenAI, Process, Task,
+                          QueueFullError, ToolRunner, load_model_tiers)
+
+
+class FakeResponse:
+    """模拟requests的响应：非流式返回body，流式逐行返回SSE块"""
+
+    def __init__(self, body=None, chunks=()):
+        self.body = body
+        self.chunks = chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def json(self):
+        return self.body
+
+    def iter_lines(self):
+        for chunk in self.chunks:
+            yield ("data: " + json.dumps(chunk, ensure_ascii=False)).encode("utf-8")
+        yield b"data: [DONE]"
+
+
+def _stream_chunks(message):
+    """把完整的助手消息拆成流式增量，文本按字符拆分，工具调用的参数分两段"""
+    chunks = [{"choices": [{"index": 0, "delta": {key: char}}]}
+              for key in ("reasoning_content", "content") for char in message.get(key) or ""]
+    for index, call in enumerate(message.get("tool_calls") or []):
+        arguments = call["function"]["arguments"]
+        half = len(arguments) // 2
+        chunks.append({"choices": [{"index": 0, "delta": {"tool_calls": [{
+            "index": index, "id": call["id"], "type": "function",
+            "function": {"name": call["function"]["name"], "arguments": arguments[:half]},
+        }]}}]})
+        chunks.append({"choices": [{"index": 0, "delta": {"tool_calls": [{
+            "index": index, "function": {"arguments": arguments[half:]},
+        }]}}]})
+    return chunks
+
+
+def _tool_call_reply(data):
+    """收到工具结果后给出最终回复，否则请求调用get_price"""
+    last = data["messages"][-1]
+    if last["role"] == "tool":
+        return {"role": "assistant", "content": "价格为" + json.loads(last["content"])["price"]}
+    return {"role": "assistant", "content": "", "tool_calls": [{
+        "id": "call_1", "type": "function",
+        "function": {"name": "get_price", "arguments": json.dumps({"ticker_symbol": "AAPL"})},
+    }]}
+
+
+def _fake_post(client, reply=_tool_call_reply):
+    """把客户端的HTTP请求替换为按reply生成回复，并记录请求体"""
+    client.requests = []
+    client.reply = reply
+
+    def post(url, data, stream=False):
+        client.requests.append(data)
+        message = client.reply(data)
+        if stream:
+            return FakeResponse(chunks=_stream_chunks(message))
+        return FakeResponse(body={"choices": [{"index": 0, "message": message}]})
+
+    client._post = post
+    return client
+
+
+@pytest.fixture
+def api(tmp_path):
+    client = DeepSeekAPI(api_key="test", base_url="http://deepseek.test",
+                         cache=ResponseCache(str(tmp_path / "responses.sqlite3")))
+    return _fake_post(client)
+
+
+@pytest.fixture
+def runner():
+    calls = []
+
+    def get_price(ticker_symbol: str) -> dict:
+        calls.append(ticker_symbol)
+        return {"price": "123.4"}
+
+    tool = SimpleNamespace(name="get_price", description="获取股价", func=get_price)
+    with ToolRunner([tool]) as tool_runner:
+        tool_runner.calls = calls
+        yield tool_runner
+
+
+MESSAGES = [{"role": "user", "content": "AAPL现在多少钱？"}]
+
+
+def test_cache_key_normalizes_content_and_tracks_freshness():
+    key = DeepSeekAPI._cache_key(MESSAGES, "deepseek-chat", 0.7, 1024, "2026-10-16")
+    padded = [{"role": "user", "content": "  AAPL现在多少钱？\n"}]
+
+    assert key == DeepSeekAPI._cache_key(padded, "deepseek-chat", 0.7, 1024, "2026-10-16")
+    assert key != DeepSeekAPI._cache_key(MESSAGES, "deepseek-chat", 0.7, 1024, "2026-10-17")
+    assert key != DeepSeekAPI._cache_key(MESSAGES, "deepseek-reasoner", 0.7, 1024, "2026-10-16")
+    assert key != DeepSeekAPI._cache_key(MESSAGES, "deepseek-chat", 0.7, 1024, "2026-10-16",
+                                         tools=[{"type": "function"}])
+
+def test_tool_calls_run_and_result_is_sent_back(api, runner):
+    response = api.chat_with_tools(MESSAGES, runner, cache_token="2026-10-16")
+
+    assert response["choices"][0]["message"]["content"] == "价格为123.4"
+    assert runner.calls == ["AAPL"]
+    assert len(api.requests) == 2
+    assert api.requests[0]["tools"][0]["function"]["name"] == "get_price"
+    assert api.requests[1]["messages"][-1] == {
+        "role": "tool", "tool_call_id": "call_1", "content": json.dumps({"price": "123.4"})
+    }
+
+
+def test_cached_tool_calls_replay_as_stream(api, runner):
+    api.chat_with_tools(MESSAGES, runner, cache_token="2026-10-16")
+    api.requests.clear()
+
+    chunks = list(api.chat_with_tools(MESSAGES, runner, stream=True, cache_token="2026-10-16"))
+
+    assert api.requests == []
+    tool_rounds = [chunk for chunk in chunks if "tool_calls" in chunk]
+    assert [call["function"]["name"] for call in tool_rounds[0]["tool_calls"]] == ["get_price"]
+    content = "".join(chunk["choices"][0]["delta"].get("content") or ""
+                      for chunk in chunks if "choices" in chunk)
+    assert content == "价格为123.4"
+
+def test_streamed_tool_calls_are_assembled_and_not_cached(api, runner):
+    chunks = list(api.chat_with_tools(MESSAGES, runner, stream=True))
+
+    tool_round = next(chunk for chunk in chunks if "tool_calls" in chunk)
+    assert tool_round["tool_calls"][0]["function"]["arguments"] == \
+        json.dumps({"ticker_symbol": "AAPL"})
+    assert len(api.requests) == 2
+    # 只有不含工具调用的最终回复被缓存
+    assert api.cache.stats()["entries"] == 1
+
+
+def test_streamed_reply_is_cached_and_replayed(api):
+    api.reply = lambda data: {"role": "assistant", "content": "分析完成"}
+
+    first = list(api.chat(MESSAGES, stream=True))
+    replay = list(api.chat(MESSAGES, stream=True))
+    response = api.chat(MESSAGES)
+
+    assert len(first) == len("分析完成")
+    assert len(api.requests) == 1
+    assert replay[0]["choices"][0]["delta"]["content"] == "分析完成"
+    assert replay[0]["choices"][0]["finish_reason"] == "stop"
+    assert response["choices"][0]["message"]["content"] == "分析完成"
+
+def test_empty_reply_is_not_cached(api):
+    api.reply = lambda data: {"role": "assistant", "content": ""}
+
+    api.chat(MESSAGES)
+    api.chat(MESSAGES)
+
+    assert len(api.requests) == 2
+    assert api.cache.stats()["entries"] == 0
+
+
+def test_cache_messages_replace_volatile_prompt_in_cache_key(api):
+    api.reply = lambda data: {"role": "assistant", "content": "分析完成"}
+    stable = [{"role": "user", "content": "分析AAPL"}]
+
+    api.chat([{"role": "user", "content": "分析AAPL，现价123.4"}], cache_messages=stable)
+    response = api.chat([{"role": "user", "content": "分析AAPL，现价123.5"}],
+                        cache_messages=stable)
+
+    assert len(api.requests) == 1
+    assert api.requests[0]["messages"][0]["content"] == "分析AAPL，现价123.4"
+    assert response["choices"][0]["message"]["content"] == "分析完成"
+
+
+def test_tool_rounds_extend_cache_messages(api, runner):
+    stable = [{"role": "user", "content": "AAPL价格"}]
+
+    api.chat_with_tools([{"role": "user", "content": "AAPL价格，时间10:00"}], runner,
+                        cache_messages=stable)
+    api.requests.clear()
+    response = api.chat_with_tools([{"role": "user", "content": "AAPL价格，时间10:01"}], runner,
+                                   cache_messages=stable)
+
+    assert api.requests == []
+    assert response["choices"][0]["message"]["content"] == "价格为123.4"
+    assert stable == [{"role": "user", "content": "AAPL价格"}]
+
+
+def test_crew_task_cache_key_ignores_volatile_description(tmp_path, monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "test")
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"))
+    requests = []
+
+    def run(price):
+        agent = Agent(role="分析师", goal="分析股票", backstory="资深分析师")
+        task = Task(description=f"分析AAPL，现价{price}", agent=agent, expected_output="分析",
+                    cache_key="分析AAPL")
+        crew = Crew(agents=[agent], tasks=[task], cache=cache, cache_token="2026-10-16")
+        _fake_post(crew.deepseek_api, lambda data: {"role": "assistant", "content": "分析完成"})
+        result = crew.kickoff()
+        requests.extend(crew.deepseek_api.requests)
+        return result
+
+    assert run("123.4") == run("123.5") == "分析完成"
+    assert len(requests) == 1
+
+
+class _FakeServer(ThreadingHTTPServer):
+    """本地的DeepSeek兼容服务：每个请求等待一段时间后返回，记录同时处理中的请求数"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FakeHandler)
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests.append(data)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(0.05)
+        with server.lock:
+            server.in_flight -= 1
+
+        message = {"role": "assistant", "content": "回复" + data["messages"][-1]["content"]}
+        if data.get("stream"):
+            body = b"".join(
+                ("data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n").encode("utf-8")
+                for chunk in _stream_chunks(message)
+            ) + b"data: [DONE]\n\n"
+            content_type = "text/event-stream"
+        else:
+            body = json.dumps({"choices": [{"index": 0, "message": message}]}).encode("utf-8")
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    fake = _FakeServer()
+    yield fake
+    fake.shutdown()
+    fake.server_close()
+
+
+def _ask(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_acreate_works_across_sequential_event_loops(server):
+    completions = OpenAI(api_key="test", base_url=server.url).chat
+    sessions = []
+
+    async def ask(text):
+        response = await completions.acreate(messages=_ask(text))
+        sessions.append(completions._async_api._resources().session)
+        return response["choices"][0]["message"]["content"]
+
+    assert asyncio.run(ask("一")) == "回复一"
+    assert asyncio.run(ask("二")) == "回复二"
+    # 每个事件循环使用自己的会话，循环结束时关闭
+    assert sessions[0] is not sessions[1]
+    assert all(session.closed for session in sessions)
+    assert completions._async_api._loop_resources == {}
+
+
+def test_async_concurrency_stays_within_limit(server):
+    api = AsyncDeepSeekAPI(api_key="test", base_url=server.url, max_concurrency=2)
+
+    async def ask_all():
+        responses = await asyncio.gather(*(api.achat(_ask(str(index))) for index in range(6)))
+        return [response["choices"][0]["message"]["content"] for response in responses]
+
+    for _ in range(2):
+        assert asyncio.run(ask_all()) == [f"回复{index}" for index in range(6)]
+    assert len(server.requests) == 12
+    assert server.max_in_flight == 2
+
+
+def test_achat_uses_scheduler_and_response_cache(server, tmp_path):
+    scheduler = LLMScheduler(max_concurrency=1)
+    api = AsyncDeepSeekAPI(api_key="test", base_url=server.url, scheduler=scheduler,
+                           cache=ResponseCache(str(tmp_path / "responses.sqlite3")))
+
+    async def collect(stream):
+        return "".join([chunk["choices"][0]["delta"].get("content") or ""
+                        async for chunk in stream])
+
+    async def run():
+        await asyncio.gather(*(api.achat(_ask(str(index))) for index in range(3)))
+        streamed = await collect(await api.achat(_ask("流"), stream=True))
+        replayed = await collect(await api.achat(_ask("流"), stream=True))
+        cached = await api.achat(_ask("0"))
+        return streamed, replayed, cached["choices"][0]["message"]["content"]
+
+    assert asyncio.run(run()) == ("回复流", "回复流", "回复0")
+    assert len(server.requests) == 4
+    assert server.max_in_flight == 1
+    assert scheduler.stats()["running"] == 0
+
+
+def test_cancelled_achat_returns_its_scheduler_slot(server):
+    scheduler = LLMScheduler(max_concurrency=1)
+    api = AsyncDeepSeekAPI(api_key="test", base_url=server.url, scheduler=scheduler)
+    # 同步请求占用唯一的名额，异步请求在调度器中排队时被取消
+    held = scheduler.acquire("other")
+
+    async def ask():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(api.achat(_ask("一")), 0.2)
+
+    asyncio.run(ask())
+    scheduler.release(held)
+    deadline = time.time() + 5
+    while scheduler.stats()["running"] and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert scheduler.stats()["running"] == 0
+    assert scheduler.stats()["queued"] == 0
+    assert server.requests == []
+
+
+def _http_response(status, headers=None, body=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response._content = json.dumps(body or {}).encode("utf-8")
+    response.raw = io.BytesIO(response._content)
+    return response
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(deepseek_api.time, "sleep", delays.append)
+    return delays
+
+
+def _replay_session(client, outcomes):
+    """按顺序返回给定的响应或抛出给定的异常，代替共享连接池"""
+    outcomes = iter(outcomes)
+
+    def post(url, **kwargs):
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    client.session = SimpleNamespace(post=post)
+
+
+def test_post_retries_rate_limit_after_retry_after(sleeps):
+    client = DeepSeekAPI(api_key="test")
+    _replay_session(client, [
+        _http_response(429, {"Retry-After": "2"}),
+        requests.exceptions.ConnectionError("reset"),
+        _http_response(200, body={"ok": True}),
+    ])
+
+    response = client._post("http://deepseek.test", {})
+
+    assert response.json() == {"ok": True}
+    assert sleeps[0] == 2.0
+    assert 0 <= sleeps[1] <= client.backoff_factor * 2
+
+
+def test_post_raises_after_max_retries(sleeps):
+    client = DeepSeekAPI(api_key="test", max_retries=2, max_backoff=5)
+    _replay_session(client, [_http_response(503, {"Retry-After": "60"})] * 3)
+
+    with pytest.raises(requests.HTTPError):
+        client._post("http://deepseek.test", {})
+    # Retry-After超过max_backoff时按上限等待
+    assert sleeps == [5, 5]
+
+
+def test_retry_after_accepts_http_date():
+    later = time.time() + 30
+    response = _http_response(429, {"Retry-After": formatdate(later, usegmt=True)})
+
+    assert 25 <= deepseek_api._retry_after_seconds(response) <= 30
+
+
+def test_kickoff_stream_separates_reasoning_from_content(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "test")
+    analyst = Agent(role="分析师", goal="分析股票", backstory="资深分析师", tier="reasoning")
+    writer = Agent(role="撰稿人", goal="撰写报告", backstory="资深撰稿人", tier="fast")
+    analysis = Task(description="分析AAPL", agent=analyst, expected_output="分析")
+    report = Task(description="撰写报告", agent=writer, expected_output="报告", context=[analysis])
+    crew = Crew(agents=[analyst, writer], tasks=[analysis, report])
+
+    def reply(data):
+        if data["model"] == "deepseek-reasoner":
+            return {"role": "assistant", "reasoning_content": "想", "content": "看涨"}
+        return {"role": "assistant", "content": "报告"}
+
+    _fake_post(crew.deepseek_api, reply)
+    events = list(crew.kickoff_stream())
+
+    assert [(event["task"], event["type"], event["text"]) for event in events] == [
+        (0, "reasoning", "想"), (0, "content", "看"), (0, "content", "涨"),
+        (0, "task_complete", "看涨"),
+        (1, "content", "报"), (1, "content", "告"), (1, "task_complete", "报告"),
+    ]
+    assert [event["final"] for event in events] == [False] * 4 + [True] * 3
+    # 下游任务只收到上游的回复内容，不包含思考过程
+    upstream = crew.deepseek_api.requests[1]["messages"][-1]["content"]
+    assert "看涨" in upstream and "想" not in upstream
+
+
+def _crew_tasks():
+    agents = [Agent(role=role, goal="分析", backstory="分析师", tier="fast")
+              for role in ("基本面分析师", "技术面分析师", "撰稿人")]
+    fundamentals = Task(description="分析基本面", agent=agents[0], expected_output="基本面")
+    technicals = Task(description="分析技术面", agent=agents[1], expected_output="技术面")
+    report = Task(description="撰写报告", agent=agents[2], expected_output="报告",
+                  context=[fundamentals, technicals])
+    return agents, [fundamentals, technicals, report]
+
+
+def test_parallel_crew_runs_independent_tasks_concurrently(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "test")
+    agents, tasks = _crew_tasks()
+    crew = Crew(agents=agents, tasks=tasks, process=Process.parallel)
+    # 两个独立任务都到达后才能继续，顺序执行时会超时
+    barrier = threading.Barrier(2, timeout=5)
+
+    def reply(data):
+        prompt = data["messages"][-1]["content"]
+        if prompt.endswith("撰写报告"):
+            return {"role": "assistant", "content": "报告"}
+        barrier.wait()
+        return {"role": "assistant", "content": "结论：" + prompt[-3:]}
+
+    _fake_post(crew.deepseek_api, reply)
+
+    assert crew.kickoff() == "报告"
+    assert [task.output for task in tasks] == ["结论：基本面", "结论：技术面", "报告"]
+    prompt = crew.deepseek_api.requests[-1]["messages"][-1]["content"]
+    assert "结论：基本面" in prompt and "结论：技术面" in prompt
+
+
+def test_crew_rejects_cyclic_and_foreign_context(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "test")
+    agents, tasks = _crew_tasks()
+    tasks[0].context = [tasks[2]]
+    with pytest.raises(ValueError, match="循环依赖"):
+        Crew(agents=agents, tasks=tasks, process=Process.parallel)._dependencies()
+
+    agents, tasks = _crew_tasks()
+    with pytest.raises(ValueError, match="不属于"):
+        Crew(agents=agents, tasks=tasks[1:], process=Process.parallel)._dependencies()
+
+
+def test_crew_compacts_long_upstream_results(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "test")
+    agents, tasks = _crew_tasks()
+    crew = Crew(agents=agents, tasks=tasks)
+    narrative = "公司近年来持续推进业务转型，管理层对未来发展保持信心。" * 300
+
+    def reply(data):
+        if data["messages"][-1]["content"].endswith("撰写报告"):
+            return {"role": "assistant", "content": "报告"}
+        return {"role": "assistant", "content": f"## 结论\n{narrative}\n市盈率：28.5"}
+
+    _fake_post(crew.deepseek_api, reply)
+    crew.kickoff()
+
+    prompt = crew.deepseek_api.requests[-1]["messages"][-1]["content"]
+    assert "市盈率：28.5" in prompt and narrative not in prompt
+    assert crew.usage_metrics["context_tokens_saved"] > 0
+
+
+def test_load_model_tiers_merges_environment_and_overrides(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_MODEL_TIERS", json.dumps({
+        "fast": {"max_tokens": 2000}, "draft": {"model": "deepseek-chat"}}))
+
+    tiers = load_model_tiers({"fast": {"temperature": 0.2}})
+
+    assert tiers["fast"] == {"model": "deepseek-chat", "max_tokens": 2000, "temperature": 0.2}
+    # 新增的级别以默认级别为基础
+    assert tiers["draft"]["model"] == "deepseek-chat"
+    assert tiers["draft"]["max_tokens"] == MODEL_TIERS[DEFAULT_MODEL_TIER]["max_tokens"]
+    assert tiers["reasoning"] == MODEL_TIERS["reasoning"]
+
+
+def test_crew_routes_tasks_by_tier(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "test")
+    monkeypatch.delenv("DEEPSEEK_MODEL_TIERS", raising=False)
+    tool = SimpleNamespace(name="get_price", description="获取股价", func=lambda: "1")
+    analyst = Agent(role="分析师", goal="分析", backstory="分析师")
+    researcher = Agent(role="研究员", goal="检索", backstory="研究员", tools=[tool])
+    tasks = [Task(description="分析", agent=analyst, expected_output="分析"),
+             Task(description="检索", agent=researcher, expected_output="检索"),
+             Task(description="撰写", agent=analyst, expected_output="报告", tier="fast")]
+    crew = Crew(agents=[analyst, researcher], tasks=tasks,
+                model_tiers={"fast": {"max_tokens": 1500}})
+    _fake_post(crew.deepseek_api, lambda data: {"role": "assistant", "content": "完成"})
+
+    crew.kickoff()
+
+    assert [(data["model"], data["max_tokens"]) for data in crew.deepseek_api.requests] == [
+        ("deepseek-reasoner", 4000),
+        # 带工具的智能体不能使用推理模型
+        (TOOL_CALLING_MODEL, 4000),
+        ("deepseek-chat", 1500),
+    ]
+    assert crew.tier_metrics["reasoning"]["calls"] == 2
+    assert crew.tier_metrics["fast"]["calls"] == 1
+    with pytest.raises(ValueError, match="未知的模型级别"):
+        Crew(agents=[analyst], tasks=[Task(description="x", agent=analyst, expected_output="x",
+                                           tier="missing")])
+
+
+def test_scheduler_orders_by_priority_and_rotates_sessions():
+    scheduler = LLMScheduler(max_concurrency=1, max_queue_depth=8, max_session_queue_depth=3)
+    held = scheduler.acquire("other")
+    granted = []
+    threads = []
+
+    def request(label, session_id, priority):
+        ticket = scheduler.acquire(session_id, priority)
+        granted.append(label)
+        scheduler.release(ticket)
+
+    # 逐个入队，保证排队顺序确定
+    for label, session_id, priority in (("A1", "A", LLMScheduler.INTERACTIVE),
+                                        ("A2", "A", LLMScheduler.INTERACTIVE),
+                                        ("A3", "A", LLMScheduler.INTERACTIVE),
+                                        ("C1", "C", LLMScheduler.BATCH),
+                                        ("B1", "B", LLMScheduler.INTERACTIVE)):
+        queued = scheduler.stats()["queued"]
+        thread = threading.Thread(target=request, args=(label, session_id, priority))
+        thread.start()
+        threads.append(thread)
+        deadline = time.time() + 5
+        while scheduler.stats()["queued"] == queued and time.time() < deadline:
+            time.sleep(0.01)
+
+    assert scheduler.status("A") == {"queued": 3, "position": 0,
+                                     "estimated_wait": scheduler.service_time}
+    assert scheduler.status("B")["position"] == 1
+    assert scheduler.status("C")["position"] == 4
+    # 单个会话的排队请求数达到上限时立即拒绝
+    with pytest.raises(QueueFullError):
+        scheduler.acquire("A")
+
+    scheduler.release(held)
+    for thread in threads:
+        thread.join(5)
+
+    assert granted == ["A1", "B1", "A2", "A3", "C1"]
+    assert scheduler.stats()["rejected"] == 1
+    assert scheduler.stats()["running"] == 0
+
+
+def test_scheduler_rejects_when_queue_is_full():
+    scheduler = LLMScheduler(max_concurrency=1, max_queue_depth=1)
+    held = scheduler.acquire("A")
+    positions = []
+    waiter = threading.Thread(target=lambda: scheduler.release(
+        scheduler.acquire("B", on_wait=lambda position, wait: positions.append(position))))
+    waiter.start()
+    deadline = time.time() + 5
+    while not scheduler.stats()["queued"] and time.time() < deadline:
+        time.sleep(0.01)
+
+    with pytest.raises(QueueFullError):
+        scheduler.acquire("C")
+    scheduler.release(held)
+    waiter.join(5)
+
+    assert positions == [0]
+    assert scheduler.stats()["queued"] == 0
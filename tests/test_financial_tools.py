@@ -0,0 +1,143 @@
+import base64
+import json
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import pytest
+
+pytest.importorskip("crewai")
+
+import financial_tools
+from financial_tools import (TickerSession, YFinanceStockTool, aggregate_ohlcv, decimate_series,
+                             level_of_detail, lttb_indices, render_chart)
+
+
+def _daily(days, tz=None, end="2026-10-16"):
+    index = pd.bdate_range(end=end, periods=days, name="Date").as_unit("ns")
+    if tz is not None:
+        index = index.tz_localize(tz)
+    close = 100 + np.arange(days, dtype=float)
+    return pd.DataFrame({"Open": close - 0.5, "High": close + 1, "Low": close - 1,
+                         "Close": close, "Volume": np.full(days, 1e6)}, index=index)
+
+
+def test_historical_data_batch_aligns_panel_and_collects_errors(monkeypatch):
+    requested = []
+
+    def history(self, period="1y"):
+        requested.append(self.ticker_symbol)
+        if self.ticker_symbol == "BAD":
+            raise RuntimeError("网络错误")
+        if self.ticker_symbol == "EMPTY":
+            return pd.DataFrame()
+        tz = "Asia/Shanghai" if self.ticker_symbol.endswith(".SS") else "America/New_York"
+        return _daily(5, tz)
+
+    monkeypatch.setattr(TickerSession, "history", history)
+
+    result = YFinanceStockTool.get_historical_data_batch(
+        ["AAPL", "600519.SS", "BAD", "EMPTY", "AAPL"], period="1mo")
+
+    assert sorted(requested) == ["600519.SS", "AAPL", "BAD", "EMPTY"]
+    assert set(result["errors"]) == {"BAD", "EMPTY"}
+    assert "网络错误" in result["errors"]["BAD"]
+    data = result["data"]
+    assert list(data.columns.get_level_values("Ticker").unique()) == ["AAPL", "600519.SS"]
+    # 不同时区的K线按本地交易日对齐到同一行
+    assert data.index.tz is None
+    assert len(data) == 5
+    assert data[("600519.SS", "Close")].tolist() == data[("AAPL", "Close")].tolist()
+
+
+def test_historical_data_batch_without_data_returns_empty_panel(monkeypatch):
+    monkeypatch.setattr(TickerSession, "history", lambda self, period="1y": pd.DataFrame())
+
+    result = YFinanceStockTool.get_historical_data_batch(["EMPTY"])
+
+    assert result["data"].empty
+    assert result["errors"] == {"EMPTY": "无历史数据"}
+
+
+def _candlestick(df):
+    return go.Figure(go.Candlestick(x=df.index, open=df["Open"], high=df["High"],
+                                    low=df["Low"], close=df["Close"]))
+
+
+def _decode(array):
+    return np.frombuffer(base64.b64decode(array["bdata"]), dtype=array["dtype"])
+
+
+def test_render_chart_json_uses_typed_arrays():
+    df = _daily(30, "America/New_York")
+
+    figure = json.loads(render_chart(_candlestick(df), output="json"))
+
+    trace = figure["data"][0]
+    np.testing.assert_array_equal(_decode(trace["close"]), df["Close"].to_numpy())
+    # 日期轴为交易所本地时间的毫秒时间戳
+    expected = df.index.tz_localize(None).as_unit("ms").asi8
+    np.testing.assert_array_equal(_decode(trace["x"]), expected.astype(float))
+    assert figure["layout"]["xaxis"]["type"] == "date"
+
+
+def test_render_chart_compact_references_plotlyjs(monkeypatch, tmp_path):
+    fig = _candlestick(_daily(30))
+    full = render_chart(fig, output="html")
+
+    compact = render_chart(fig, output="compact")
+    monkeypatch.setattr(financial_tools, "PLOTLYJS_SOURCE", "static")
+    monkeypatch.setattr(financial_tools, "STATIC_DIR", str(tmp_path))
+    static = render_chart(fig, output="compact")
+
+    assert f'<script src="{financial_tools.plotlyjs_src()}">' in static
+    assert financial_tools.plotlyjs_src().startswith("/app/static/plotly-")
+    assert len(list(tmp_path.iterdir())) == 1
+    assert "cdn.plot.ly" in compact
+    # 不内嵌plotly.js，只包含图表数据
+    assert len(compact) < len(full) / 50
+
+
+def test_lttb_keeps_endpoints_and_spikes():
+    x = np.arange(1000, dtype=float)
+    y = np.sin(x / 50)
+    y[437] = 10.0
+
+    indices = lttb_indices(x, y, 100)
+
+    assert len(indices) == 100
+    assert indices[0] == 0 and indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+    assert 437 in indices
+    assert len(lttb_indices(x[:50], y[:50], 100)) == 50
+
+
+def test_aggregate_ohlcv_builds_weekly_bars():
+    df = _daily(10, "America/New_York")
+
+    weekly = aggregate_ohlcv(df, "W")
+
+    assert len(weekly) == 2
+    assert weekly.index[0] == df.index[0]
+    first = df.iloc[:5]
+    assert weekly.iloc[0].to_dict() == {
+        "Open": first["Open"].iloc[0], "High": first["High"].max(), "Low": first["Low"].min(),
+        "Close": first["Close"].iloc[-1], "Volume": first["Volume"].mean(),
+    }
+
+
+def test_level_of_detail_bounds_points_by_width():
+    df = _daily(2500)
+
+    lod = level_of_detail(df, width_px=400)
+
+    # 400像素最多显示100根K线，最近一半保留日K线
+    assert len(lod["recent"]) == 50
+    assert lod["recent"].index[-1] == df.index[-1]
+    assert 0 < len(lod["older"]) <= lod["budget"] == 50
+    assert lod["label"] in ("周线", "月线", "季线", "年线")
+    assert level_of_detail(df.iloc[-80:], width_px=400)["older"].empty
+
+    series = decimate_series(df["Close"].iloc[:-50], lod["budget"])
+    assert len(series) == 50
+    assert series.index[0] == df.index[0]
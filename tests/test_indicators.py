@@ -0,0 +1,153 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from indicators import (IndicatorState, compute_indicators, lookback_period, required_bars,
+                        resolve, scan_universe)
+
+
+def _close_matrix(tickers=4, days=300, seed=7):
+    rng = np.random.default_rng(seed)
+    close = 100 + np.cumsum(rng.normal(0, 1.5, (tickers, days)), axis=1)
+    # 最后一只股票上市较晚，前面的日期没有数据
+    close[-1, :120] = np.nan
+    return close
+
+
+def _pandas_indicators(close):
+    """与calculate_technical_indicators原来的pandas实现相同"""
+    close = pd.Series(close)
+    delta = close.diff()
+    gain = delta.where(delta > 0, 0).rolling(window=14).mean()
+    loss = -delta.where(delta < 0, 0).rolling(window=14).mean()
+    macd = close.ewm(span=12, adjust=False).mean() - close.ewm(span=26, adjust=False).mean()
+    signal_line = macd.ewm(span=9, adjust=False).mean()
+    return {
+        "sma20": close.rolling(window=20).mean(),
+        "sma50": close.rolling(window=50).mean(),
+        "sma200": close.rolling(window=200).mean(),
+        "rsi": 100 - (100 / (1 + gain / loss)),
+        "macd": macd,
+        "signal_line": signal_line,
+        "macd_histogram": macd - signal_line,
+    }
+
+
+def test_matrix_matches_pandas_per_ticker():
+    close = _close_matrix()
+    names = ["sma20", "sma50", "sma200", "rsi", "macd", "signal_line", "macd_histogram"]
+    matrix = compute_indicators({"close": close}, names)
+
+    for row in range(close.shape[0]):
+        # 上市较晚的股票与只用其上市后的数据调用pandas的结果一致
+        listed = np.isfinite(close[row])
+        expected = _pandas_indicators(close[row][listed])
+        assert np.isnan(matrix["rsi"][row][~listed]).all()
+        for name in names:
+            np.testing.assert_allclose(matrix[name][row][listed], expected[name].to_numpy(),
+                                       rtol=1e-9, atol=1e-9, equal_nan=True, err_msg=name)
+
+
+def _holiday_matrix(tickers=4, days=320, seed=11):
+    """模拟按日期外连接的多交易所面板：每只股票在各自的休市日缺少数据"""
+    close = _close_matrix(tickers, days, seed)
+    rng = np.random.default_rng(seed)
+    for row in range(tickers):
+        close[row, rng.choice(np.arange(130, days - 1), size=12, replace=False)] = np.nan
+    # 第一只股票在最后一个日期休市
+    close[0, -1] = np.nan
+    return close
+
+
+def test_matrix_skips_holiday_gaps_per_ticker():
+    close = _holiday_matrix()
+    names = ["sma20", "sma50", "sma200", "rsi", "macd", "signal_line", "macd_histogram"]
+    matrix = compute_indicators({"close": close}, names)
+
+    for row in range(close.shape[0]):
+        valid = np.isfinite(close[row])
+        # 与只用该股票自己的交易日调用pandas的结果一致，休市日为NaN
+        expected = _pandas_indicators(close[row][valid])
+        for name in names:
+            assert np.isnan(matrix[name][row][~valid]).all(), name
+            np.testing.assert_allclose(matrix[name][row][valid], expected[name].to_numpy(),
+                                       rtol=1e-9, atol=1e-9, equal_nan=True, err_msg=name)
+
+
+def test_scan_universe_uses_each_tickers_last_valid_bar():
+    close = _holiday_matrix()
+    result = scan_universe(close)
+
+    for row in range(close.shape[0]):
+        series = close[row][np.isfinite(close[row])]
+        latest = {name: values.iloc[-1] for name, values in _pandas_indicators(series).items()}
+        assert result["current_price"][row] == series[-1]
+        assert result["sma200"][row] == pytest.approx(latest["sma200"], rel=1e-9, nan_ok=True)
+        assert result["trend_signals"]["price_above_sma50"][row] == (series[-1] > latest["sma50"])
+
+
+def test_scan_universe_trend_signals_match_latest_values():
+    close = _close_matrix()
+    result = scan_universe(close)
+
+    for row in range(close.shape[0]):
+        series = close[row][np.isfinite(close[row])]
+        latest = {name: values.iloc[-1] for name, values in _pandas_indicators(series).items()}
+        signals = {name: values[row] for name, values in result["trend_signals"].items()}
+        assert signals["price_above_sma20"] == (close[row, -1] > latest["sma20"])
+        assert signals["price_above_sma200"] == (close[row, -1] > latest["sma200"])
+        assert signals["macd_above_signal"] == (latest["macd"] > latest["signal_line"])
+        assert signals["rsi_overbought"] == (latest["rsi"] > 70)
+
+
+def test_resolve_orders_dependencies_once():
+    order = resolve(["macd_histogram", "signal_line", "rsi14"])
+
+    assert order.index("ema12") < order.index("macd") < order.index("signal_line")
+    assert order.index("signal_line") < order.index("macd_histogram")
+    assert order.count("macd") == 1
+    assert "rsi" in order
+
+
+def test_lookback_period_covers_required_bars():
+    assert lookback_period(["rsi"]) == "1mo"
+    assert lookback_period(["sma200"]) == "1y"
+    assert required_bars(["sma50"]) == 50
+    with pytest.raises(ValueError):
+        required_bars(["unknown"])
+
+
+def test_incremental_state_matches_batch():
+    close = _close_matrix(days=400)[0]
+    volume = np.arange(len(close), dtype=float)
+    state = IndicatorState.from_history(close[:250], volume[:250])
+    for bar_close, bar_volume in zip(close[250:], volume[250:]):
+        latest = state.update(bar_close, bar_volume)
+
+    expected = {name: series.iloc[-1] for name, series in _pandas_indicators(close).items()}
+    for name, value in expected.items():
+        assert latest[name] == pytest.approx(value, rel=1e-9, abs=1e-9), name
+    assert latest["current_price"] == close[-1]
+    assert latest["volume"] == volume[-1]
+
+
+def test_update_last_and_serialization_match_batch():
+    close = _close_matrix(days=260)[0]
+    state = IndicatorState.from_history(close[:-1])
+    state.update(close[-1] + 5.0)
+    # 盘中刷新的当日K线最终按收盘价修正
+    state.update_last(close[-1])
+    restored = IndicatorState.from_dict(state.to_dict())
+
+    expected = {name: series.iloc[-1] for name, series in _pandas_indicators(close).items()}
+    for current in (state.latest(), restored.latest()):
+        for name, value in expected.items():
+            assert current[name] == pytest.approx(value, rel=1e-9, abs=1e-9), name
+
+
+def test_incremental_state_rejects_invalid_close():
+    state = IndicatorState()
+    with pytest.raises(ValueError):
+        state.update(math.nan)
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ohlcv_store import OHLCVStore
+
+
+class FakeTicker:
+    """按给定的完整行情返回history()结果，并记录每次请求"""
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.calls = []
+
+    def history(self, period=None, start=None):
+        self.calls.append({"period": period, "start": start})
+        if start is not None:
+            start = pd.Timestamp(start).tz_localize(self.frame.index.tz)
+            return self.frame[self.frame.index >= start].copy()
+        bars = {"1mo": 21, "3mo": 63, "6mo": 126, "1y": 252}.get(period, len(self.frame))
+        return self.frame.iloc[-bars:].copy()
+
+
+def _market(days, tz="America/New_York", end="2026-10-16"):
+    index = pd.bdate_range(end=end, periods=days, tz=tz, name="Date").as_unit("ns")
+    close = 100 + np.arange(days, dtype=float)
+    return pd.DataFrame({
+        "Open": close - 0.5, "High": close + 1, "Low": close - 1, "Close": close,
+        "Volume": np.full(days, 1e6), "Dividends": 0.0, "Stock Splits": 0.0,
+    }, index=index)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return OHLCVStore(str(tmp_path / "ohlcv"), refresh_interval=0)
+
+
+def test_first_sync_downloads_period(store):
+    market = _market(300)
+    ticker = FakeTicker(market)
+
+    df = store.history("AAPL", "1y", ticker)
+
+    assert ticker.calls == [{"period": "1y", "start": None}]
+    assert len(df) == 252
+    pd.testing.assert_frame_equal(df, market.iloc[-252:], check_freq=False)
+
+
+def test_incremental_sync_appends_new_bars_and_overwrites_last(store):
+    market = _market(300)
+    ticker = FakeTicker(market.iloc[:-3].copy())
+    # 上次同步时最后一根K线尚未收盘
+    ticker.frame.iloc[-1, ticker.frame.columns.get_loc("Close")] = 1.0
+    store.history("AAPL", "1y", ticker)
+
+    ticker.frame = market
+    ticker.calls.clear()
+    df = store.history("AAPL", "1y", ticker)
+
+    assert [call["period"] for call in ticker.calls] == [None]
+    assert ticker.calls[0]["start"] == market.index[-4].strftime("%Y-%m-%d")
+    assert store._read_meta("AAPL")["rows"] == 252 + 3
+    pd.testing.assert_frame_equal(df, store.read("AAPL", "1y"))
+    pd.testing.assert_frame_equal(store.read("AAPL").iloc[-4:], market.iloc[-4:],
+                                  check_freq=False)
+
+
+def test_dividend_on_stored_last_bar_does_not_refetch(store):
+    market = _market(300)
+    market.iloc[-3, market.columns.get_loc("Dividends")] = 0.25
+    ticker = FakeTicker(market.iloc[:-2].copy())
+    store.history("AAPL", "1y", ticker)
+
+    ticker.frame = market
+    ticker.calls.clear()
+    store.history("AAPL", "1y", ticker)
+
+    assert all(call["period"] is None for call in ticker.calls)
+
+
+def test_dividend_on_new_bar_refetches_history(store):
+    market = _market(300)
+    ticker = FakeTicker(market.iloc[:-2].copy())
+    store.history("AAPL", "1y", ticker)
+
+    market.iloc[-1, market.columns.get_loc("Dividends")] = 0.25
+    ticker.frame = market
+    ticker.calls.clear()
+    store.history("AAPL", "1y", ticker)
+
+    assert [call["period"] for call in ticker.calls] == [None, "1y"]
+    assert store._read_meta("AAPL")["rows"] == 252
+
+
+def test_longer_period_triggers_full_download(store):
+    market = _market(600)
+    ticker = FakeTicker(market)
+    store.history("AAPL", "6mo", ticker)
+
+    ticker.calls.clear()
+    df = store.history("AAPL", "1y", ticker)
+
+    assert ticker.calls == [{"period": "1y", "start": None}]
+    assert len(df) == 252
+
+
+def test_read_arrays_are_not_changed_by_later_writes(store):
+    market = _market(300)
+    ticker = FakeTicker(market.iloc[:-3].copy())
+    ticker.frame.iloc[-1, ticker.frame.columns.get_loc("Close")] = 1.0
+    store.history("AAPL", "1y", ticker)
+    arrays = store.read_arrays("AAPL")
+
+    # 下一次同步在原文件中覆盖最后一根K线并追加新K线
+    ticker.frame = market
+    store.history("AAPL", "1y", ticker)
+
+    assert len(arrays["Date"]) == len(arrays["Close"]) == 252
+    assert arrays["Close"][-1] == 1.0
+
+
+def test_last_trading_day_uses_exchange_timezone(store):
+    # 上海的K线时间为当地零点，对应UTC的前一天
+    ticker = FakeTicker(_market(30, tz="Asia/Shanghai"))
+
+    assert store.last_trading_day("600519.SS") is None
+    store.history("600519.SS", "1mo", ticker)
+
+    assert store.last_trading_day("600519.SS") == "2026-10-16"
+
+
+def test_current_trading_day_syncs_stale_data_first(store):
+    market = _market(300)
+    ticker = FakeTicker(market.iloc[:-1].copy())
+    assert store.current_trading_day("AAPL", ticker) is None
+    store.history("AAPL", "1y", ticker)
+
+    # 新交易日的K线已经发布，本地数据超过刷新间隔
+    ticker.frame = market
+    ticker.calls.clear()
+
+    assert store.current_trading_day("AAPL", ticker) == "2026-10-16"
+    assert ticker.calls == [{"period": None, "start": market.index[-2].strftime("%Y-%m-%d")}]
+
+
+def test_current_trading_day_skips_network_within_refresh_interval(tmp_path):
+    store = OHLCVStore(str(tmp_path / "ohlcv"), refresh_interval=3600)
+    market = _market(300)
+    ticker = FakeTicker(market.iloc[:-1].copy())
+    store.history("AAPL", "1y", ticker)
+
+    ticker.frame = market
+    ticker.calls.clear()
+
+    assert store.current_trading_day("AAPL", ticker) == "2026-10-15"
+    assert ticker.calls == []
@@ -0,0 +1,67 @@
+import re
+
+from report_renderer import (NARRATIVE_SECTIONS, extract_rating, format_number, markdown_table,
+                             render_report, split_sections)
+
+
+DATA = {
+    "stock_info": {"longName": "Apple Inc.", "currentPrice": 230.5, "currency": "USD",
+                   "sector": "Technology", "industry": "Consumer Electronics",
+                   "marketCap": 3.5e12, "trailingPE": 35.2, "forwardPE": 0},
+    "financial_data": {"利润表": {"总收入": 3.9e11}},
+    "technical_indicators": {"current_price": 230.5, "rsi": 61.234,
+                             "trend_signals": {"price_above_sma50": True}},
+    "peer_comparison": {"error": "获取同业数据失败"},
+}
+
+NARRATIVE = """以下是报告的文字部分：
+
+## 投资要点
+- 服务业务持续增长
+
+## 投资建议
+投资建议：买入，目标价260美元
+
+## 补充说明
+估值已反映部分预期
+"""
+
+
+def test_format_number_and_table():
+    assert format_number(3.5e12) == "35,000.00亿"
+    assert format_number(0, zero_as_missing=True) == "-"
+    assert format_number(float("nan")) == "-"
+    assert format_number(True) == "是"
+    assert markdown_table(("a", "b"), [("x|y", 1)]) == "| a | b |\n| --- | --- |\n| x\\|y | 1 |"
+
+
+def test_split_sections_and_rating():
+    preamble, sections = split_sections(NARRATIVE)
+
+    assert preamble == "以下是报告的文字部分："
+    assert list(sections) == ["投资要点", "投资建议", "补充说明"]
+    assert extract_rating(sections["投资建议"]) == "买入"
+    assert extract_rating("暂无结论") is None
+
+
+def test_render_report_merges_local_tables_and_narrative():
+    report = render_report("AAPL", DATA, NARRATIVE)
+
+    headings = re.findall(r"^## (.+)$", report, re.MULTILINE)
+    assert headings == ["公司概况", "投资要点", "财务分析", "技术分析", "同业比较", "风险因素",
+                        "投资建议", "补充说明"]
+    assert set(NARRATIVE_SECTIONS) <= set(headings)
+    assert report.startswith("# Apple Inc.（AAPL）投资分析报告\n\n当前股价：230.50 USD | 投资建议：**买入**")
+    assert "| 市盈率（TTM / 预期） | 35.20 / - |" in report
+    assert "| 利润表 | 总收入 | 3,900.00亿 |" in report
+    assert "| RSI(14) | 61.23 |" in report
+    assert "*同业比较数据获取失败*" in report
+    assert "以下是报告" not in report
+
+
+def test_render_report_keeps_unstructured_narrative():
+    report = render_report("AAPL", {}, "模型没有按标题输出的分析")
+
+    assert report.startswith("# AAPL 投资分析报告")
+    assert report.rstrip().endswith("模型没有按标题输出的分析")
+    assert "*公司基本信息获取失败*" in report
@@ -0,0 +1,77 @@
+import sqlite3
+
+import pytest
+
+from report_store import ReportStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ReportStore(str(tmp_path / "reports.sqlite3"), max_age=3600, max_reports=3)
+
+
+def _integrity_check(store):
+    store._conn.execute("INSERT INTO reports_fts (reports_fts, rank) VALUES ('integrity-check', 1)")
+
+
+def test_get_returns_report_for_same_key(store):
+    store.put("aapl", "2026-10-16", "deepseek-chat", "1", "报告正文")
+
+    stored = store.get("AAPL", "2026-10-16", "deepseek-chat", "1")
+
+    assert stored["report"] == "报告正文"
+    assert store.get("AAPL", "2026-10-16", "deepseek-chat", "2") is None
+    assert store.get("AAPL", "2026-10-17", "deepseek-chat", "1") is None
+
+
+def test_get_respects_max_age(store):
+    store.put("AAPL", "2026-10-16", "m", "1", "报告")
+
+    assert store.get("AAPL", "2026-10-16", "m", "1", max_age=0) is None
+
+
+def test_reput_same_key_replaces_report_and_keeps_index_consistent(store):
+    store.put("AAPL", "2026-10-16", "m", "1", "营收增长强劲，投资建议：买入")
+    store.put("AAPL", "2026-10-16", "m", "1", "服务业务放缓，投资建议：持有")
+
+    assert store.stats()["entries"] == 1
+    assert store.get("AAPL", "2026-10-16", "m", "1")["report"].endswith("持有")
+    _integrity_check(store)
+    if store.fts_enabled:
+        assert store.search("营收增长") == []
+    assert [row["ticker"] for row in store.search("业务放缓")] == ["AAPL"]
+
+
+def test_search_matches_chinese_substrings_and_short_queries(store):
+    store.put("AAPL", "2026-10-16", "m", "1", "苹果 服务业务增长")
+    store.put("MSFT", "2026-10-16", "m", "1", "微软 云业务增长")
+
+    assert {row["ticker"] for row in store.search("业务增长")} == {"AAPL", "MSFT"}
+    assert [row["ticker"] for row in store.search("ms")] == ["MSFT"]
+    assert store.search("  ") == []
+
+
+def test_put_evicts_oldest_reports(store):
+    for index, ticker in enumerate(("A", "B", "C", "D")):
+        store.put(ticker, "2026-10-16", "m", "1", f"报告{index}")
+
+    assert store.stats()["entries"] == 3
+    assert store.get("A", "2026-10-16", "m", "1") is None
+    _integrity_check(store)
+
+
+def test_orphaned_index_rows_are_rebuilt_on_open(tmp_path):
+    path = str(tmp_path / "reports.sqlite3")
+    store = ReportStore(path)
+    if not store.fts_enabled:
+        pytest.skip("SQLite不支持FTS5")
+    store.put("AAPL", "2026-10-16", "m", "1", "旧报告")
+    # 模拟早期版本INSERT OR REPLACE留下的孤立索引行
+    store._conn.execute(
+        "INSERT OR REPLACE INTO reports (ticker, trading_day, model, prompt_version, report, "
+        "created_at) VALUES ('AAPL', '2026-10-16', 'm', '1', '新报告', 0)"
+    )
+    with pytest.raises(sqlite3.DatabaseError):
+        _integrity_check(store)
+
+    _integrity_check(ReportStore(path))
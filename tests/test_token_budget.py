@@ -0,0 +1,49 @@
+from token_budget import (DEFAULT_CONTEXT_BUDGET, compact_text, context_budget,
+                          estimate_message_tokens, estimate_tokens)
+
+
+def test_estimate_tokens_weights_cjk_characters():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("股票分析") == round(4 * 0.6)
+    assert estimate_tokens("AAPL stock") == round(10 * 0.3)
+    assert estimate_message_tokens([{"role": "user", "content": "股票分析"}]) == 2 + 4
+
+
+def test_context_budget_falls_back_to_default():
+    assert context_budget("deepseek-reasoner") < context_budget("deepseek-chat")
+    assert context_budget("unknown-model") == DEFAULT_CONTEXT_BUDGET
+
+
+def test_compact_text_keeps_text_within_budget_unchanged():
+    assert compact_text("## 结论\n建议买入", 100) == ("## 结论\n建议买入", 0)
+
+
+def test_compact_text_drops_narrative_and_keeps_findings():
+    narrative = "公司近年来持续推进业务转型，管理层在多个场合表达了对未来发展的信心" * 3
+    text = "\n".join([
+        "## 估值", narrative, "市盈率：28.5", "- 营收同比增长12%", "- 品牌影响力较强",
+        "## 建议", narrative, "综合评级为买入，目标价210美元",
+    ])
+
+    compacted, saved = compact_text(text, 60)
+
+    assert compacted.splitlines() == [
+        "## 估值", "市盈率：28.5", "- 营收同比增长12%", "- 品牌影响力较强",
+        "## 建议", "综合评级为买入，目标价210美元",
+    ]
+    assert saved == estimate_tokens(text) - estimate_tokens(compacted)
+    # 预算更紧时先丢弃不含数字的列表项
+    compacted, _ = compact_text(text, 30)
+    assert "- 品牌影响力较强" not in compacted.splitlines()
+    assert "- 营收同比增长12%" in compacted.splitlines()
+    assert estimate_tokens(compacted) <= 30
+
+
+def test_compact_text_truncates_text_without_structure():
+    text = "这是一段没有任何结构的叙述性文字" * 50
+
+    compacted, saved = compact_text(text, 100)
+
+    assert text.startswith(compacted)
+    assert estimate_tokens(compacted) <= 100 < estimate_tokens(text)
+    assert saved > 0
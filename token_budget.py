@@ -0,0 +1,125 @@
+"""
+令牌估算与上下文压缩
+
+链式任务中，上游任务（如推理模型的分析）的完整输出会作为下游任务的上下文，
+长篇的叙述性文字会显著增加下游调用的输入令牌数和延迟。这里提供：
+
+- 令牌数估算：按DeepSeek文档给出的经验比例，1个中文字符约0.6个令牌，
+  1个英文字符约0.3个令牌，不依赖分词器
+- 按下游模型设置的上下文预算
+- 上下文压缩：超出预算时保留标题、列表、表格和含数字的结论性内容，丢弃叙述性段落
+"""
+
+import re
+from typing import Dict, List, Tuple
+
+# 中文字符和其他字符的令牌估算比例
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+
+# 每条消息的格式开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 下游任务接收的上游上下文的令牌预算，推理模型会自行展开思考，给较小的预算
+CONTEXT_BUDGETS = {
+    "deepseek-reasoner": 2000,
+    "deepseek-chat": 4000,
+}
+DEFAULT_CONTEXT_BUDGET = 3000
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+_HEADING_PATTERN = re.compile(r"^#{1,6}\s")
+_LIST_PATTERN = re.compile(r"^([-*+]|\d+[.)、])\s*")
+_KEY_VALUE_PATTERN = re.compile(r"^[^\s：:]{1,20}[：:]\s*\S")
+_NUMBER_PATTERN = re.compile(r"\d")
+
+# 行的保留优先级，压缩时先丢弃优先级低的行；叙述性文字为0，直接丢弃
+_HEADING, _FINDING, _LIST_ITEM, _NARRATIVE = 3, 2, 1, 0
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的令牌数
+
+    Args:
+        text: 文本
+
+    Returns:
+        估算的令牌数
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return int(round(cjk * CJK_TOKENS_PER_CHAR + (len(text) - cjk) * OTHER_TOKENS_PER_CHAR))
+
+
+def estimate_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """
+    估算对话消息列表的输入令牌数
+
+    Args:
+        messages: 对话消息列表
+
+    Returns:
+        估算的令牌数
+    """
+    return sum(estimate_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+               for message in messages)
+
+
+def context_budget(model: str) -> int:
+    """返回下游模型可接收的上游上下文令牌预算"""
+    return CONTEXT_BUDGETS.get(model, DEFAULT_CONTEXT_BUDGET)
+
+
+def _line_priority(line: str) -> int:
+    """按行的内容判断保留优先级"""
+    stripped = line.strip()
+    if _HEADING_PATTERN.match(stripped):
+        return _HEADING
+    if stripped.startswith("|") or _KEY_VALUE_PATTERN.match(stripped):
+        return _FINDING
+    if _LIST_PATTERN.match(stripped):
+        return _FINDING if _NUMBER_PATTERN.search(stripped) else _LIST_ITEM
+    if _NUMBER_PATTERN.search(stripped) and len(stripped) <= 80:
+        return _FINDING
+    return _NARRATIVE
+
+
+def compact_text(text: str, budget: int) -> Tuple[str, int]:
+    """
+    把上游输出压缩到令牌预算以内
+
+    未超出预算时原样返回。否则先丢弃叙述性段落，只保留标题、列表、表格、
+    键值对和含数字的短句；仍超出预算时按优先级从后往前继续丢弃。
+
+    Args:
+        text: 上游任务的输出
+        budget: 令牌预算
+
+    Returns:
+        (压缩后的文本, 节省的令牌数)
+    """
+    original = estimate_tokens(text)
+    if original <= budget:
+        return text, 0
+
+    lines = [(line, _line_priority(line)) for line in text.splitlines() if line.strip()]
+    kept = [(line, priority, estimate_tokens(line) + 1) for line, priority in lines
+            if priority > _NARRATIVE]
+    total = sum(tokens for _, _, tokens in kept)
+
+    for priority in (_LIST_ITEM, _FINDING, _HEADING):
+        for index in range(len(kept) - 1, -1, -1):
+            if total <= budget:
+                break
+            if kept[index][1] == priority:
+                total -= kept[index][2]
+                kept.pop(index)
+
+    if kept:
+        compacted = "\n".join(line for line, _, _ in kept)
+    else:
+        # 没有可提取的结构化内容时按比例截取开头部分
+        compacted = text[:int(len(text) * budget / original)]
+    return compacted, max(original - estimate_tokens(compacted), 0)